@@ -0,0 +1,230 @@
+"""
+    Approximate nearest neighbour index
+
+    author: Zeyu Li <zyli@cs.ucla.edu> or <zeyuli@g.ucla.edu>
+
+    An IVF-PQ index over the answerer embeddings (`au_embeddings`).
+    It pre-selects a few hundred candidate answerers by inner product
+    so that only these candidates are re-ranked by the CNN of `RecSys`.
+"""
+
+import os
+import time
+
+import numpy as np
+
+
+def kmeans(x, k, n_iter=20, seed=0):
+    """Plain Lloyd's k-means
+
+    Args:
+        x  -  n x d float array
+        k  -  the number of centroids, capped by n
+        n_iter  -  the number of iterations
+        seed  -  random seed of the initialization
+    Return:
+        centroids  -  k x d float array
+        assign  -  n int array, the centroid of each row
+    """
+    rand = np.random.RandomState(seed)
+    k = min(k, x.shape[0])
+    centroids = x[rand.choice(x.shape[0], k, replace=False)].copy()
+    assign = np.zeros(x.shape[0], dtype=np.int64)
+    for _ in range(n_iter):
+        assign = nearest_centroid(x, centroids)
+        counts = np.bincount(assign, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # Re-seed the empty clusters by random points
+        if empty.any():
+            centroids[empty] = x[rand.choice(x.shape[0], empty.sum())]
+    return centroids, assign
+
+
+def nearest_centroid(x, centroids, chunk=65536):
+    """Index of the closest centroid (L2) of each row in x"""
+    c_norm = (centroids ** 2).sum(axis=1)
+    assign = np.empty(x.shape[0], dtype=np.int64)
+    for start in range(0, x.shape[0], chunk):
+        block = x[start: start + chunk]
+        dist = c_norm[None, :] - 2 * block.dot(centroids.T)
+        assign[start: start + chunk] = dist.argmin(axis=1)
+    return assign
+
+
+class IVFPQIndex:
+    """Inverted file index with product quantized residuals
+
+    Vectors are assigned to `n_list` coarse centroids, and the residual
+    to the centroid is split into `n_sub` sub-vectors, each quantized to
+    one of 2^`n_bits` codewords. The inner product with a query is then
+        <q, c> + sum_m <q_m, codebook_m[code_m]>
+    which is computed from small lookup tables.
+
+    Args:
+        n_list  -  the number of inverted lists
+        n_sub  -  the number of sub-quantizers, must divide the dimension
+        n_bits  -  bits per sub-quantizer code
+        n_probe  -  the number of lists visited per query
+        seed  -  random seed of k-means
+    """
+
+    def __init__(self, n_list=64, n_sub=8, n_bits=8, n_probe=8, seed=0):
+        self.n_list = n_list
+        self.n_sub = n_sub
+        self.n_bits = n_bits
+        self.n_probe = n_probe
+        self.seed = seed
+
+        self.centroids = None
+        self.codebooks = None
+        self.codes = None
+        self.ids = None
+        self.list_ptr = None
+
+    def build(self, vectors, ids):
+        """Train the quantizers and add all vectors
+
+        Args:
+            vectors  -  n x d float array, the answerer embeddings
+            ids  -  n int array, the answerer id of each row
+        Return:
+            self
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        n, dim = vectors.shape
+        if dim % self.n_sub:
+            raise ValueError("Dimension {} is not divisible by n_sub {}"
+                             .format(dim, self.n_sub))
+        dsub = dim // self.n_sub
+
+        self.centroids, assign = kmeans(vectors, self.n_list, seed=self.seed)
+        residual = vectors - self.centroids[assign]
+
+        ksub = min(2 ** self.n_bits, n)
+        code_type = np.uint8 if ksub <= 256 else np.uint16
+        self.codebooks = np.zeros((self.n_sub, ksub, dsub), dtype=np.float32)
+        codes = np.zeros((n, self.n_sub), dtype=code_type)
+        for m in range(self.n_sub):
+            sub = residual[:, m * dsub: (m + 1) * dsub]
+            self.codebooks[m], codes[:, m] = kmeans(
+                sub, ksub, seed=self.seed + m + 1)
+
+        # Store the codes ordered by inverted list
+        order = np.argsort(assign, kind="mergesort")
+        self.codes = codes[order]
+        self.ids = np.asarray(ids)[order]
+        self.list_ptr = np.zeros(len(self.centroids) + 1, dtype=np.int64)
+        self.list_ptr[1:] = np.cumsum(
+            np.bincount(assign, minlength=len(self.centroids)))
+        return self
+
+    def search(self, query, k):
+        """Search the `k` vectors of largest inner product with `query`
+
+        Args:
+            query  -  d float array
+            k  -  the number of candidates to return
+        Return:
+            ids  -  the candidate ids, best first
+            scores  -  the approximated inner products
+        """
+        query = np.asarray(query, dtype=np.float32)
+        coarse = self.centroids.dot(query)
+        n_probe = min(self.n_probe, len(coarse))
+        probe = np.argpartition(-coarse, n_probe - 1)[:n_probe]
+
+        dsub = query.shape[0] // self.n_sub
+        lut = np.einsum("mkd,md->mk", self.codebooks,
+                        query.reshape(self.n_sub, dsub))
+        sub_index = np.arange(self.n_sub)
+
+        cand_ids, cand_scores = [], []
+        for lst in probe:
+            lo, hi = self.list_ptr[lst], self.list_ptr[lst + 1]
+            if lo == hi:
+                continue
+            codes = self.codes[lo:hi].astype(np.int64)
+            cand_scores.append(coarse[lst] + lut[sub_index, codes].sum(axis=1))
+            cand_ids.append(self.ids[lo:hi])
+
+        if not cand_ids:
+            return self.ids[:0], np.zeros(0, dtype=np.float32)
+        cand_ids = np.concatenate(cand_ids)
+        cand_scores = np.concatenate(cand_scores)
+        if k < len(cand_scores):
+            top = np.argpartition(-cand_scores, k - 1)[:k]
+        else:
+            top = np.arange(len(cand_scores))
+        top = top[np.argsort(-cand_scores[top], kind="mergesort")]
+        return cand_ids[top], cand_scores[top]
+
+    def save(self, path):
+        """Save the index as a `.npz` file"""
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        with open(path, "wb") as fout:
+            np.savez(fout, centroids=self.centroids, codebooks=self.codebooks,
+                     codes=self.codes, ids=self.ids, list_ptr=self.list_ptr,
+                     params=np.array([self.n_list, self.n_sub, self.n_bits,
+                                      self.n_probe, self.seed]))
+
+    @classmethod
+    def load(cls, path):
+        """Load an index saved by `save`"""
+        data = np.load(path)
+        n_list, n_sub, n_bits, n_probe, seed = data["params"].tolist()
+        index = cls(n_list=n_list, n_sub=n_sub, n_bits=n_bits,
+                    n_probe=n_probe, seed=seed)
+        index.centroids = data["centroids"]
+        index.codebooks = data["codebooks"]
+        index.codes = data["codes"]
+        index.ids = data["ids"]
+        index.list_ptr = data["list_ptr"]
+        return index
+
+
+def recall_at_k(exact_top, approx_top):
+    """Fraction of the exact top-k found in the approximated top-k"""
+    if not len(exact_top):
+        return 1.0
+    return len(set(exact_top) & set(approx_top)) / len(exact_top)
+
+
+def benchmark(queries, exhaustive_fn, candidate_fn, rerank_fn,
+              k=10, candidate_sizes=(50, 100, 300, 1000)):
+    """Recall-vs-latency of ANN pre-selection against exhaustive scoring
+
+    Args:
+        queries  -  the list of queries, passed to the functions below
+        exhaustive_fn  -  query -> (ids, scores) of all answerers
+        candidate_fn  -  (query, size) -> candidate ids from the index
+        rerank_fn  -  (query, ids) -> scores of these candidates
+        k  -  recall is measured on the top-k
+        candidate_sizes  -  the candidate sizes to try
+    Return:
+        list of (candidate size, recall@k, ms per query), starting with
+            (None, 1.0, ms per query) for the exhaustive scoring
+    """
+    exact_tops = []
+    start = time.time()
+    for query in queries:
+        ids, scores = exhaustive_fn(query)
+        exact_tops.append(ids[np.argsort(-scores, kind="mergesort")[:k]])
+    exhaustive_ms = 1000 * (time.time() - start) / max(len(queries), 1)
+    results = [(None, 1.0, exhaustive_ms)]
+
+    for size in candidate_sizes:
+        recall = 0.0
+        start = time.time()
+        for query, exact_top in zip(queries, exact_tops):
+            ids = candidate_fn(query, size)
+            scores = np.asarray(rerank_fn(query, ids))
+            approx_top = ids[np.argsort(-scores, kind="mergesort")[:k]]
+            recall += recall_at_k(exact_top, approx_top)
+        ms = 1000 * (time.time() - start) / max(len(queries), 1)
+        results.append((size, recall / max(len(queries), 1), ms))
+    return results
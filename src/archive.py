@@ -0,0 +1,168 @@
+"""
+    Dump archives
+
+    Author:
+        Zeyu Li <zyli@cs.ucla.edu> or <zeyuli@ucla.edu>
+
+    Description:
+        Stream a member of a StackExchange `.7z` dump, e.g. Posts.xml,
+        without extracting it to disk. The member is decompressed block
+        by block into a binary file object which lxml parses directly.
+
+        Readers, tried in this order by "auto":
+            "libarchive"  -  the optional libarchive-c binding
+            "7z"  -  a `7z e -so` (p7zip or 7-Zip) subprocess pipe
+            "bsdtar"  -  a `bsdtar -xOf` (libarchive) subprocess pipe
+"""
+
+import os
+import io
+import glob
+import shutil
+import tempfile
+import subprocess
+from contextlib import contextmanager
+
+# Command lines writing a member to stdout, by executable
+PIPE_COMMANDS = {"7z": ["e", "-so", "-bd"], "7za": ["e", "-so", "-bd"],
+                 "7zz": ["e", "-so", "-bd"], "bsdtar": ["-xOf"]}
+
+
+def find_archive(folder, member="Posts.xml"):
+    """The .7z archive holding `member` for the dataset in `folder`
+
+    Looks for <folder>/*.7z and <folder>.7z. The split dumps of large
+        sites, e.g. stackoverflow.com-Posts.7z, are preferred over the
+        others when they are named after the member.
+
+    Return:
+        the path of the archive, None if there is none
+    """
+    folder = os.path.join(folder, "")
+    candidates = sorted(glob.glob(folder + "*.7z"))
+    if os.path.exists(folder[:-1] + ".7z"):
+        candidates.append(folder[:-1] + ".7z")
+    if not candidates:
+        return None
+    stem = os.path.splitext(member)[0].lower()
+    named = [path for path in candidates
+             if os.path.basename(path).lower().endswith("-{}.7z".format(stem))]
+    return (named or candidates)[0]
+
+
+def locate(folder, member="Posts.xml"):
+    """`member` extracted in `folder`, else the archive holding it, else None"""
+    path = os.path.join(folder, member)
+    if os.path.exists(path):
+        return path
+    return find_archive(folder, member)
+
+
+def available_reader(reader="auto"):
+    """Resolve "auto" to the first available reader
+
+    Return:
+        "libarchive", or the executable of a subprocess pipe
+    """
+    if reader in ("auto", "libarchive"):
+        try:
+            import libarchive
+            return "libarchive"
+        except ImportError:
+            if reader == "libarchive":
+                raise
+    if reader == "auto":
+        for executable in ["7z", "7za", "7zz", "bsdtar"]:
+            if shutil.which(executable):
+                return executable
+        raise IOError("No .7z reader found, install libarchive-c, "
+                      "p7zip or bsdtar, or extract the archive")
+    if reader == "7z":
+        for executable in ["7z", "7za", "7zz"]:
+            if shutil.which(executable):
+                return executable
+    if reader in PIPE_COMMANDS and shutil.which(reader):
+        return reader
+    raise IOError("The .7z reader {} is not available".format(reader))
+
+
+class BlockStream(io.RawIOBase):
+    """Binary file object over an iterator of byte blocks"""
+
+    def __init__(self, blocks):
+        self.blocks = iter(blocks)
+        self.block = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while not self.block:
+            self.block = next(self.blocks, None)
+            if self.block is None:
+                self.block = b""
+                return 0
+        size = min(len(buf), len(self.block))
+        buf[:size] = self.block[:size]
+        self.block = self.block[size:]
+        return size
+
+
+@contextmanager
+def open_member(archive, member="Posts.xml", reader="auto",
+                buffer_size=1 << 20):
+    """Open a member of a .7z archive as a streaming binary file
+
+    Nothing is written to disk. A subprocess pipe is killed if the
+        caller stops before the end of the member, otherwise a failure
+        of the tool is raised as IOError.
+
+    Args:
+        archive  -  the path of the .7z archive
+        member  -  the path of the member in the archive
+        reader  -  "auto", "libarchive", "7z" or "bsdtar"
+        buffer_size  -  the read buffer size
+    """
+    reader = available_reader(reader)
+    if reader == "libarchive":
+        import libarchive
+        with libarchive.file_reader(archive) as entries:
+            for entry in entries:
+                if os.path.normpath(entry.pathname) == os.path.normpath(member):
+                    yield io.BufferedReader(BlockStream(entry.get_blocks()),
+                                            buffer_size)
+                    return
+        raise IOError("{} not found in {}".format(member, archive))
+
+    command = [reader] + PIPE_COMMANDS[reader] + [archive, member]
+    with tempfile.TemporaryFile() as stderr:
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                stderr=stderr, bufsize=buffer_size)
+        try:
+            yield proc.stdout
+            # lxml stops at the closing tag, only whitespace may be left
+            finished = len(proc.stdout.read(1 << 16)) < 1 << 16
+        except BaseException:
+            proc.kill()
+            proc.wait()
+            raise
+        finally:
+            proc.stdout.close()
+        if not finished:
+            proc.kill()
+        if proc.wait() != 0 and finished:
+            stderr.seek(0)
+            raise IOError("{} failed: {}".format(
+                " ".join(command), stderr.read().decode("utf-8", "replace")))
+
+
+def extract_member(archive, folder, member="Posts.xml", reader="auto",
+                   buffer_size=1 << 20):
+    """Extract a member of a .7z archive into `folder`, return its path"""
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    path = os.path.join(folder, os.path.basename(member))
+    with open_member(archive, member, reader, buffer_size) as fin, \
+            open(path, "wb") as fout:
+        shutil.copyfileobj(fin, fout, buffer_size)
+    return path
@@ -0,0 +1,260 @@
+"""
+    Columnar store
+
+    Author:
+        Zeyu Li <zyli@cs.ucla.edu> or <zeyuli@ucla.edu>
+
+    Description:
+        An append-only columnar table kept in a folder, one file per
+        column, so that rows can be written while streaming and every
+        column can be memory-mapped by NumPy without any decoding.
+
+        Column kinds:
+            "int"   - int64, `MISSING` for absent values  (<name>.i64)
+            "text"  - utf-8 bytes and int64 offsets  (<name>.txt, <name>.off)
+            "ints"  - ragged int64 lists, values and offsets
+                      (<name>.val, <name>.off)
+"""
+
+import os
+from array import array
+
+import numpy as np
+
+try:
+    import ujson as json
+except:
+    import json
+
+MISSING = np.iinfo(np.int64).min
+
+
+def to_int(value):
+    """Parse an id attribute, `MISSING` if absent"""
+    if value is None or value == "":
+        return MISSING
+    return int(value)
+
+
+class ColumnWriter:
+    """Write a columnar table row by row
+
+    Args:
+        folder  -  the folder of the table, created if not exists
+        schema  -  list of (column name, kind)
+        flush_rows  -  the number of rows buffered in memory
+        append  -  append rows to an existing table of the same schema
+    """
+
+    def __init__(self, folder, schema, flush_rows=65536, append=False):
+        self.folder = os.path.join(folder, "")
+        self.schema = [tuple(column) for column in schema]
+        self.flush_rows = flush_rows
+        self.rows = 0
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+
+        append = append and exists(self.folder)
+        if append:
+            with open(self.folder + "meta.json", "r") as fin:
+                meta = json.loads(fin.read())
+            if [tuple(column) for column in meta["schema"]] != self.schema:
+                raise ValueError("Schema of {} does not match".format(self.folder))
+            self.rows = meta["rows"]
+            # A writer killed during an append leaves bytes past the
+            # committed rows, new rows would be misaligned after them
+            for path, size in committed_sizes(self.folder, self.schema,
+                                              self.rows).items():
+                if os.path.getsize(path) < size:
+                    raise IOError("{} is shorter than its {} rows"
+                                  .format(path, self.rows))
+                os.truncate(path, size)
+        elif os.path.exists(self.folder + "meta.json"):
+            # The table is incomplete until `close` writes the metadata
+            os.remove(self.folder + "meta.json")
+        mode = "ab" if append else "wb"
+
+        self.files, self.buffers, self.offsets = {}, {}, {}
+        for name, kind in self.schema:
+            if kind == "int":
+                self.files[name] = open(self.folder + name + ".i64", mode)
+                self.buffers[name] = array("q")
+            elif kind in ("text", "ints"):
+                suffix = ".txt" if kind == "text" else ".val"
+                offset = read_offset(self.folder + name + ".off", self.rows) \
+                    if append else 0
+                self.files[name] = open(self.folder + name + suffix, mode)
+                self.files[name + ".off"] = open(self.folder + name + ".off", mode)
+                self.buffers[name] = bytearray() if kind == "text" else array("q")
+                self.buffers[name + ".off"] = array("q", [] if append else [0])
+                self.offsets[name] = offset
+            else:
+                raise ValueError("Unknown column kind {}".format(kind))
+        # The sizes to roll an aborted append back to
+        self.sizes = {key: os.path.getsize(fout.name)
+                      for key, fout in self.files.items()} if append else None
+
+    def append(self, row):
+        """Append a row, a dict from column name to value
+
+        Absent int columns are `MISSING`, absent text is "" and absent
+            lists are empty.
+        """
+        for name, kind in self.schema:
+            value = row.get(name)
+            if kind == "int":
+                self.buffers[name].append(MISSING if value is None else value)
+            elif kind == "text":
+                data = (value or "").encode("utf-8")
+                self.buffers[name] += data
+                self.offsets[name] += len(data)
+                self.buffers[name + ".off"].append(self.offsets[name])
+            else:
+                value = value or []
+                self.buffers[name].extend(value)
+                self.offsets[name] += len(value)
+                self.buffers[name + ".off"].append(self.offsets[name])
+        self.rows += 1
+        if self.rows % self.flush_rows == 0:
+            self.flush()
+
+    def flush(self):
+        for key, buf in self.buffers.items():
+            self.files[key].write(buf if isinstance(buf, bytearray) else buf.tobytes())
+            del buf[:]
+
+    def close(self, complete=True):
+        """Flush all columns and write the metadata
+
+        Args:
+            complete  -  False when writing failed: the metadata is not
+                written, so the table does not exist, and an append is
+                rolled back to the rows before it
+        """
+        self.flush()
+        for fout in self.files.values():
+            fout.close()
+        if not complete:
+            for key, size in (self.sizes or {}).items():
+                os.truncate(self.files[key].name, size)
+            return
+        # Replaced at once, a crash never leaves a partial meta.json
+        with open(self.folder + "meta.json.tmp", "w") as fout:
+            fout.write(json.dumps({"rows": self.rows,
+                                   "schema": [list(x) for x in self.schema]}))
+        os.replace(self.folder + "meta.json.tmp", self.folder + "meta.json")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(complete=exc_type is None)
+
+
+class TextColumn:
+    """Lazy decoding view of a "text" column"""
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return bytes(self.data[self.offsets[i]: self.offsets[i + 1]]).decode("utf-8")
+
+    def __iter__(self):
+        data, offsets = self.data, self.offsets.tolist()
+        for lo, hi in zip(offsets[:-1], offsets[1:]):
+            yield bytes(data[lo:hi]).decode("utf-8")
+
+
+class ListColumn:
+    """View of an "ints" column, values and offsets"""
+
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.values[self.offsets[i]: self.offsets[i + 1]]
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+
+def read_offset(path, i):
+    """The `i`-th int64 of an offsets file"""
+    with open(path, "rb") as fin:
+        fin.seek(8 * i)
+        data = fin.read(8)
+    if len(data) < 8:
+        raise IOError("{} has no offset {}".format(path, i))
+    return array("q", data)[0]
+
+
+def committed_sizes(folder, schema, rows):
+    """The sizes of the column files holding the first `rows` rows
+
+    Return:
+        dict from file path to size in bytes
+    """
+    sizes = {}
+    for name, kind in schema:
+        if kind == "int":
+            sizes[folder + name + ".i64"] = 8 * rows
+            continue
+        offset = read_offset(folder + name + ".off", rows)
+        sizes[folder + name + ".off"] = 8 * (rows + 1)
+        if kind == "text":
+            sizes[folder + name + ".txt"] = offset
+        else:
+            sizes[folder + name + ".val"] = 8 * offset
+    return sizes
+
+
+def exists(folder):
+    """Whether a complete table is in `folder`"""
+    return os.path.exists(os.path.join(folder, "meta.json"))
+
+
+def mmap(path, dtype, count):
+    if not count:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=(count,))
+
+
+def read_columns(folder, names):
+    """Memory-map the columns `names` of a table
+
+    Args:
+        folder  -  the folder of the table
+        names  -  the column names to read
+    Return:
+        dict from name to np.ndarray ("int"), TextColumn or ListColumn
+    """
+    folder = os.path.join(folder, "")
+    if not exists(folder):
+        raise IOError("Columnar table {} does NOT exist".format(folder))
+    with open(folder + "meta.json", "r") as fin:
+        meta = json.loads(fin.read())
+    rows, kinds = meta["rows"], dict(meta["schema"])
+
+    columns = {}
+    for name in names:
+        kind = kinds[name]
+        if kind == "int":
+            columns[name] = mmap(folder + name + ".i64", np.int64, rows)
+            continue
+        offsets = mmap(folder + name + ".off", np.int64, rows + 1)
+        if kind == "text":
+            data = mmap(folder + name + ".txt", np.uint8, int(offsets[-1]))
+            columns[name] = TextColumn(data, offsets)
+        else:
+            values = mmap(folder + name + ".val", np.int64, int(offsets[-1]))
+            columns[name] = ListColumn(values, offsets)
+    return columns
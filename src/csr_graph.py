@@ -0,0 +1,183 @@
+"""
+    CSR graph
+
+    Author:
+        Zeyu Li <zyli@cs.ucla.edu> or <zeyuli@ucla.edu>
+
+    Description:
+        The R, Q, A network as a compressed sparse row (CSR) adjacency
+        over integer node indices, replacing the string-keyed NetworkX
+        graph. The nodes of a type take a contiguous range of indices,
+        in the order of `TYPES`, sorted by entity id in the range. The
+        neighbors of a node are sorted, so they are grouped by type.
+
+        The typed-neighbor index `type_ptr` keeps where the slice of
+        every type starts in every neighbor list, so a walk step to a
+        neighbor of a given type is one random index into a slice, O(1)
+        however large the degree.
+
+        A saved graph is a folder of .npy files, memory-mapped by `load`:
+            offsets.npy  -  the first index of every type, then the count
+            ids.npy  -  the entity id of every node
+            indptr.npy, indices.npy  -  the adjacency
+            type_ptr.npy  -  the typed-neighbor index
+"""
+
+import os
+import bisect
+
+import numpy as np
+
+import textio
+
+TYPES = ["Q", "R", "A"]
+TYPE_INDEX = {node_type: t for t, node_type in enumerate(TYPES)}
+
+# The relation files of the edges, and the types of their two columns
+RELATIONS = [("Q_R", "Q", "R"), ("Q_A", "Q", "A")]
+
+FILES = ["offsets", "ids", "indptr", "indices", "type_ptr"]
+
+
+def load_relation(folder, name):
+    """A "<id> <id>" relation as an N x 2 int64 array
+
+    Memory-maps <name>.npy if `extract_relations` wrote it.
+    """
+    if os.path.exists(folder + name + ".npy"):
+        return np.load(folder + name + ".npy", mmap_mode="r")
+    with textio.open_text(folder + name + ".txt", "r") as fin:
+        return np.array(fin.read().split(), dtype=np.int64).reshape(-1, 2)
+
+
+def exists(folder):
+    return all(os.path.exists(os.path.join(folder, name + ".npy"))
+               for name in FILES)
+
+
+class CSRGraph:
+    """Undirected typed graph in CSR form
+
+    Args:
+        offsets  -  the first node index of every type, then the node count
+        ids  -  the entity id of every node
+        indptr  -  the neighbors of node i are indices[indptr[i]:indptr[i+1]]
+        indices  -  the sorted neighbor lists
+        type_ptr  -  n x (len(TYPES) + 1), the neighbors of type TYPES[t]
+            of node i are indices[type_ptr[i, t]:type_ptr[i, t + 1]],
+            computed if not given
+    """
+
+    def __init__(self, offsets, ids, indptr, indices, type_ptr=None):
+        self.offsets = offsets
+        self.ids = ids
+        self.indptr = indptr
+        self.indices = indices
+        self.type_starts = [int(x) for x in offsets]
+        if type_ptr is None:
+            type_ptr = self.build_type_ptr()
+        self.type_ptr = type_ptr
+
+    def build_type_ptr(self):
+        """The typed-neighbor index, from the type of every neighbor"""
+        n_nodes, n_types = self.number_of_nodes(), len(TYPES)
+        rows = np.repeat(np.arange(n_nodes), np.diff(self.indptr))
+        types = np.searchsorted(self.offsets, self.indices, side="right") - 1
+        counts = np.bincount(rows * n_types + types,
+                             minlength=n_nodes * n_types)
+        type_ptr = np.empty((n_nodes, n_types + 1), dtype=np.int64)
+        type_ptr[:, 0] = self.indptr[:-1]
+        np.cumsum(counts.reshape(n_nodes, n_types), axis=1, out=type_ptr[:, 1:])
+        type_ptr[:, 1:] += self.indptr[:-1, None]
+        return type_ptr
+
+    @classmethod
+    def from_relations(cls, folder, relations=RELATIONS):
+        """Build the graph of the relation files in `folder`
+
+        Duplicate edges are merged, as in a simple graph.
+        """
+        pairs = [(load_relation(folder, name), left, right)
+                 for name, left, right in relations]
+        type_ids = []
+        for node_type in TYPES:
+            columns = [np.asarray(edges[:, col])
+                       for edges, left, right in pairs
+                       for col, col_type in enumerate([left, right])
+                       if col_type == node_type]
+            type_ids.append(np.unique(np.concatenate(columns)) if columns
+                            else np.zeros(0, dtype=np.int64))
+        offsets = np.cumsum([0] + [len(x) for x in type_ids]).astype(np.int64)
+        n_nodes = int(offsets[-1])
+
+        def node_index(entity_ids, node_type):
+            t = TYPE_INDEX[node_type]
+            return offsets[t] + np.searchsorted(type_ids[t], entity_ids)
+
+        src, dst = [], []
+        for edges, left, right in pairs:
+            u = node_index(edges[:, 0], left)
+            v = node_index(edges[:, 1], right)
+            src += [u, v]
+            dst += [v, u]
+        # Sorting the encoded edges sorts every neighbor list as well
+        keys = np.unique(np.concatenate(src) * n_nodes + np.concatenate(dst))
+        src, dst = np.divmod(keys, n_nodes)
+
+        indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=n_nodes), out=indptr[1:])
+        dtype = np.int32 if n_nodes < 2 ** 31 else np.int64
+        return cls(offsets, np.concatenate(type_ids), indptr, dst.astype(dtype))
+
+    def save(self, folder):
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        for name in FILES:
+            np.save(os.path.join(folder, name + ".npy"), getattr(self, name))
+
+    @classmethod
+    def load(cls, folder, mmap_mode="r"):
+        """Load a graph written by `save`, memory-mapping the arrays"""
+        # Plain ndarray views of the maps index faster than np.memmap
+        arrays = [np.asarray(np.load(os.path.join(folder, name + ".npy"),
+                                     mmap_mode=mmap_mode)) for name in FILES]
+        return cls(*arrays)
+
+    def number_of_nodes(self):
+        return len(self.ids)
+
+    def number_of_edges(self):
+        return len(self.indices) // 2
+
+    def nodes(self, node_type=None):
+        """The node indices of `node_type`, all if None"""
+        if node_type is None:
+            return np.arange(self.number_of_nodes())
+        t = TYPE_INDEX[node_type]
+        return np.arange(self.offsets[t], self.offsets[t + 1])
+
+    def type_of(self, node):
+        return TYPES[bisect.bisect_right(self.type_starts, node) - 1]
+
+    def neighbors(self, node, node_type=None):
+        """The neighbor indices of `node`, only of `node_type` if given"""
+        lo, hi = self.neighbor_range(node, node_type)
+        return self.indices[lo: hi]
+
+    def neighbor_range(self, node, node_type=None):
+        """(lo, hi) such that indices[lo:hi] are the neighbors of `node`"""
+        if node_type is None:
+            return int(self.indptr[node]), int(self.indptr[node + 1])
+        t = TYPE_INDEX[node_type]
+        return int(self.type_ptr[node, t]), int(self.type_ptr[node, t + 1])
+
+    def name(self, node):
+        """The node name used in walks, e.g. "Q_12" """
+        return "{}_{}".format(self.type_of(node), self.ids[node])
+
+    def names(self, nodes):
+        """The names of an array of nodes"""
+        nodes = np.asarray(nodes)
+        types = np.searchsorted(self.offsets, nodes, side="right") - 1
+        return ["{}_{}".format(TYPES[t], i)
+                for t, i in zip(types.tolist(), self.ids[nodes].tolist())]
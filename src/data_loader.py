@@ -16,12 +16,49 @@ import copy
 
 from collections import Counter
 
+import textio
+from csr_graph import CSRGraph
+import csr_graph
+from generate_walk import load_walk_shards, window_pairs
+
 data_index = 0
 test_index = 0
 
+
+def prune_word2vec(model, sentences):
+    """
+    Keep only the word vectors of words appearing in `sentences`
+
+    args:
+        model  -  the word2vec model
+        sentences  -  iterable of sentences, words split by " "
+
+    return:
+        words  -  the sorted list of kept words
+        vectors  -  len(words) x 300 np.array
+    """
+    words = sorted({word for sentence in sentences
+                    for word in sentence.strip().split(" ")
+                    if word in model.vocab})
+    if not words:
+        return words, np.zeros((0, 300), dtype=np.float32)
+    return words, np.asarray(model[words], dtype=np.float32)
+
 class DataLoader():
+    """
+    args:
+        window_size  -  if given, generate the training pairs of every
+                        batch from the walk matrix with this window,
+                        instead of reading the pair corpus
+        shrink_window  -  shrink the window of every token at random,
+                          see `generate_walk.window_pairs`
+    """
+    # The number of walks turned into pairs at a time
+    WALK_BLOCK = 1024
+
     def __init__(self, dataset, ID,
-                 include_content, coverage, length, answer_sample_ratio):
+                 include_content, coverage, length, answer_sample_ratio,
+                 window_size=None, shrink_window=True):
         print("Initializing data_loader ...")
         self.ANS_SAMPLE_SIZE = 5
         self.PAD_LEN = 256
@@ -30,6 +67,8 @@ class DataLoader():
         self.include_content = include_content
         self.process = True
         self.answer_sample_ratio = answer_sample_ratio
+        self.window_size = window_size
+        self.shrink_window = shrink_window
 
         self.corpus_path =\
             os.getcwd() + "/corpus/" + "{}_{}_{}.txt".format(
@@ -39,10 +78,22 @@ class DataLoader():
             os.getcwd() + "/metapath/" + "{}_{}_{}.txt".format(
                 self.dataset, str(coverage), str(length))
 
+        # The walk shards of `MetaPathGenerator.generate_walk_matrix`
+        self.walks_dir = self.mpwalks_path[:-len(".txt")] + "/"
+
         self.DATA_DIR = os.getcwd() + "/data/parsed/{}/".format(self.dataset)
 
-        print("\tLoading dataset ..." + self.corpus_path)
-        self.data = self.__read_data()
+        self.weights, self.cum_weights = None, None
+        if window_size:
+            print("\tLoading walks ..." + self.walks_dir)
+            self.graph = CSRGraph.load(self.DATA_DIR + "graph/")
+            self.walks = load_walk_shards(self.walks_dir)
+            self.walk_order = np.random.permutation(len(self.walks))
+            self.pair_buffer = np.zeros((0, 2), dtype=np.int32)
+            self.data = None
+        else:
+            print("\tLoading dataset ..." + self.corpus_path)
+            self.data = self.__read_data()
 
         print("\tCounting dataset ...")
         self.count = self.__count_dataset()
@@ -79,13 +130,22 @@ class DataLoader():
         read metapath dataset,
             load the dataset into data
 
+        a weighted corpus, see `MetaPathGenerator.stream_pairs`, has a
+            weight after every distinct pair, kept in self.weights
+
         return:
             data  -  the metapath dataset
         """
-        with open(self.corpus_path, "r") as fin:
+        with textio.open_text(self.corpus_path, "r") as fin:
             lines = fin.readlines()
             data = [line.strip().split(" ") for line in lines]
-            return data
+        if data and len(data[0]) == 3:
+            self.weights = np.array([int(row.pop()) for row in data],
+                                    dtype=np.int64)
+            self.cum_weights = np.cumsum(self.weights)
+            print("\t\t{} distinct pairs of weight {}".format(
+                len(data), self.cum_weights[-1]))
+        return data
 
     def __count_dataset(self):
         """
@@ -96,9 +156,16 @@ class DataLoader():
         returns:
             count  - the sorted list of
         """
+        if self.window_size:
+            nodes = self.walks[self.walks >= 0]
+            counts = np.bincount(nodes, minlength=self.graph.number_of_nodes())
+            nodes = np.flatnonzero(counts)
+            nodes = nodes[np.argsort(-counts[nodes], kind="mergesort")]
+            return list(zip(self.graph.names(nodes), counts[nodes].tolist()))
+
         count_dict = {}
         counter = Counter()
-        with open(self.mpwalks_path, "r") as fin:
+        with textio.open_text(self.mpwalks_path, "r") as fin:
             lines = fin.readlines()
             for line in lines:
                 line = line.strip().split(" ")
@@ -148,17 +215,33 @@ class DataLoader():
             vpos         -  the v vector positions (1d tensor)
             npos         -  the negative samples positions (2d tensor)
         """
+        if self.window_size:
+            return self.__get_walk_batch(batch_size, neg_ratio)
+
         data = self.data
         global data_index
 
-        if batch_size + data_index < len(data):
-            batch_pairs = data[data_index: data_index + batch_size]
+        # A weighted corpus is sampled in proportion to the weights, an
+        #   epoch draws as many pairs as the total weight
+        total = len(data) if self.weights is None \
+            else int(self.cum_weights[-1])
+        start = data_index
+        if batch_size + data_index < total:
+            size = batch_size
             data_index += batch_size
         else:
-            batch_pairs = data[data_index:]
+            size = total - data_index
             data_index = 0
             self.process = False
 
+        if self.weights is None:
+            batch_pairs = data[start: start + size]
+        else:
+            draws = np.searchsorted(self.cum_weights,
+                                    np.random.randint(total, size=size),
+                                    side="right")
+            batch_pairs = [data[i] for i in draws]
+
         u, v = zip(*batch_pairs)
         upos = self.__separate_entity(u)
         vpos = self.__separate_entity(v)
@@ -170,6 +253,42 @@ class DataLoader():
         aqr, accqr = self.get_answer_sample(upos, self.ANS_SAMPLE_SIZE)
         return upos, vpos, npos, aqr, accqr
 
+    def __get_walk_batch(self, batch_size, neg_ratio):
+        """
+        `get_train_batch` over pairs generated from the walks
+
+        blocks of walks are taken in a random order, turned into pairs
+            by `window_pairs` and shuffled, an epoch is a pass over all
+            walks. the self pairs are dropped, the pairs are not down
+            sampled.
+        """
+        global data_index
+        while len(self.pair_buffer) < batch_size \
+                and data_index < len(self.walk_order):
+            rows = self.walk_order[data_index: data_index + self.WALK_BLOCK]
+            data_index += len(rows)
+            pairs = window_pairs(self.walks[np.sort(rows)], self.window_size,
+                                 np.random if self.shrink_window else None)
+            pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+            pairs = pairs[np.random.permutation(len(pairs))]
+            self.pair_buffer = np.concatenate([self.pair_buffer, pairs])
+
+        batch_pairs = self.pair_buffer[:batch_size]
+        self.pair_buffer = self.pair_buffer[batch_size:]
+        if not len(self.pair_buffer) and data_index >= len(self.walk_order):
+            data_index = 0
+            self.walk_order = np.random.permutation(len(self.walks))
+            self.process = False
+
+        upos = self.__separate_nodes(batch_pairs[:, 0])
+        vpos = self.__separate_nodes(batch_pairs[:, 1])
+        neg_samples = np.random.choice(
+            self.sample_table,
+            size=int(len(batch_pairs) * neg_ratio))
+        npos = self.__separate_entity(neg_samples)
+        aqr, accqr = self.get_answer_sample(upos, self.ANS_SAMPLE_SIZE)
+        return upos, vpos, npos, aqr, accqr
+
     def get_test_batch(self, test_prop):
         """
         Build a batch for test
@@ -290,6 +409,16 @@ class DataLoader():
             sep[ent_type][index] = ent_id
         return sep.astype(np.int64)
 
+    def __separate_nodes(self, nodes):
+        """
+        `__separate_entity` of an array of node indices of the graph
+        """
+        rows = np.array([{"A": 1, "Q": 2, "R": 0}[x] for x in csr_graph.TYPES])
+        types = np.searchsorted(self.graph.offsets, nodes, side="right") - 1
+        sep = np.zeros(shape=(3, len(nodes)), dtype=np.int64)
+        sep[rows[types], np.arange(len(nodes))] = self.graph.ids[nodes]
+        return sep
+
     def __question_len_emb(self, qid):
         """
         given qid, return the concatenated word vectors
@@ -301,20 +430,33 @@ class DataLoader():
             qvec  -  the vector of the question, numpy.ndarray
             q_len  -  the length of that question
         """
+        if qid:
+            return self.sentence_len_emb(self.question_text[qid])
+        return self.sentence_len_emb("")
+
+    def sentence_len_emb(self, sentence):
+        """
+        given a normalized sentence, return the concatenated word vectors
+
+        args:
+            sentence  -  words split by " "
+
+        return:
+            q_len  -  the length of the sentence
+            qvecs  -  the padded word vectors, PAD_LEN x 300 list
+        """
         q_len = 0
         qvecs = [[0.0] * 300 for _ in range(self.PAD_LEN)]
-        if qid:
-            question = self.question_text[qid]
-            question = [x for x in question.strip().split(" ")
-                          if x in self.w2vmodel.vocab]
-            if question:
-                qvecs = self.w2vmodel[question].tolist()
-                q_len = len(question)
-                if q_len > self.PAD_LEN:
-                    qvecs = qvecs[:self.PAD_LEN]
-                else:
-                    pad_size = self.PAD_LEN - q_len
-                    qvecs += [[0.0] * 300 for _ in range(pad_size)]
+        question = [x for x in sentence.strip().split(" ")
+                      if x in self.w2vmodel.vocab]
+        if question:
+            qvecs = self.w2vmodel[question].tolist()
+            q_len = len(question)
+            if q_len > self.PAD_LEN:
+                qvecs = qvecs[:self.PAD_LEN]
+            else:
+                pad_size = self.PAD_LEN - q_len
+                qvecs += [[0.0] * 300 for _ in range(pad_size)]
         return q_len, qvecs
 
     def __load_word2vec(self):
@@ -325,6 +467,11 @@ class DataLoader():
             model  -  dictionary, ("word", [word-vector]),
                       loaded word2vec model
         """
+        # The vectors of question words only, see `pipeline.run_prepare`
+        pruned = self.DATA_DIR + "w2v_pruned.kv"
+        if os.path.exists(pruned):
+            return gensim.models.KeyedVectors.load(pruned, mmap="r")
+
         PATH = os.getcwd() + "/word2vec_model/" +\
                 "GoogleNews-vectors-negative300.bin"
         model = gensim.models.KeyedVectors.load_word2vec_format(
@@ -345,14 +492,14 @@ class DataLoader():
 
         qid2sen = {}
 
-        with open(qtfile, "r") as fin_t:
+        with textio.open_text(qtfile, "r") as fin_t:
             lines = fin_t.readlines()
             for line in lines:
                 id, title = line.split(" ", 1)
                 qid2sen[int(id)] = title.strip()
 
         if self.include_content:
-            with open(qcfile, "r") as fin_c:
+            with textio.open_text(qcfile, "r") as fin_c:
                 lines = fin_c.readlines()
                 for line in lines:
                     id, content = line.split(" ", 1)
@@ -373,9 +520,17 @@ class DataLoader():
             len(lines)  -  How many users are there in the network
         """
         uid_file = self.DATA_DIR + "QA_ID.txt"
+        uid_array = self.DATA_DIR + "QA_ID.npy"
         self.uid2ind[0] = 0
         self.ind2uid[0] = 0
-        with open(uid_file, "r") as fin:
+        if os.path.exists(uid_array):
+            # Sorted user ids, the index of a user is its position + 1
+            uids = np.load(uid_array, mmap_mode="r").tolist()
+            self.uid2ind.update(zip(uids, range(1, len(uids) + 1)))
+            self.ind2uid.update(zip(range(1, len(uids) + 1), uids))
+            print("data_loader: user_count", len(uids))
+            return len(uids)
+        with textio.open_text(uid_file, "r") as fin:
             lines = fin.readlines()
             for line in lines:
                 ind, uid = line.strip().split(" ")
@@ -385,6 +540,21 @@ class DataLoader():
             print("data_loader: user_count", len(lines))
             return len(lines)
 
+    def __load_relation(self, name):
+        """
+        Load a "<id> <id>" relation file as an N x 2 int64 array,
+            memory-mapping <name>.npy if `extract_relations` wrote it
+
+        args:
+            name  -  the relation, e.g. "Q_R"
+        """
+        array_file = self.DATA_DIR + name + ".npy"
+        if os.path.exists(array_file):
+            return np.load(array_file, mmap_mode="r")
+        with textio.open_text(self.DATA_DIR + name + ".txt", "r") as fin:
+            rows = [[int(x) for x in line.strip().split(" ")] for line in fin]
+        return np.array(rows, dtype=np.int64).reshape(-1, 2)
+
     def __load_rqa(self):
         """
         Loading files to create
@@ -395,34 +565,16 @@ class DataLoader():
         Return:
             (No return) Just modify the above three dict inplace.
         """
-        QR_input = self.DATA_DIR + "Q_R.txt"
-        QACC_input = self.DATA_DIR + "Q_ACC.txt"
-        QA_input = self.DATA_DIR + "Q_A.txt"
-
-        aid_set = set()
-
-        with open(QR_input, "r") as fin:
-            lines = fin.readlines()
-            for line in lines:
-                Q, R = [int(x) for x in line.strip().split(" ")]
-                self.q2r[Q] = R
-
-        with open(QACC_input, "r") as fin:
-            lines = fin.readlines()
-            for line in lines:
-                Q, Acc = [int(x) for x in line.strip().split(" ")]
-                self.q2acc[Q] = Acc
+        self.q2r.update(self.__load_relation("Q_R").tolist())
+        self.q2acc.update(self.__load_relation("Q_ACC").tolist())
 
-        with open(QA_input, "r") as fin:
-            lines = fin.readlines()
-            for line in lines:
-                Q, A = [int(x) for x in line.strip().split(" ")]
-                aid_set.add(A)
-                if Q not in self.q2a:
-                    self.q2a[Q] = [A]
-                else:
-                    self.q2a[Q].append(A)
-        self.all_aid = list(aid_set)
+        qa = self.__load_relation("Q_A")
+        for Q, A in qa.tolist():
+            if Q not in self.q2a:
+                self.q2a[Q] = [A]
+            else:
+                self.q2a[Q].append(A)
+        self.all_aid = np.unique(qa[:, 1]).tolist()
 
     def __get_question_embeddings(self):
         """
@@ -450,7 +602,7 @@ class DataLoader():
         """
         test_file = self.DATA_DIR + "test.txt"
         test_set = []
-        with open(test_file, "r") as fin:
+        with textio.open_text(test_file, "r") as fin:
             lines = fin.readlines()
             for line in lines:
                 test_data = [int(x) for x in line.strip().split()]
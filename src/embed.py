@@ -53,7 +53,8 @@ class Embed(nn.Module):
             torch.zeros(self.lstm_layers, batch_size, self.emb_dim))
         c = Variable(
             torch.zeros(self.lstm_layers, batch_size, self.emb_dim))
-        if torch.cuda.is_available():
+        # Follow the device of the model, a CPU copy may be used for inference
+        if self.ru_embeddings.weight.is_cuda:
             (h, c) = (h.cuda(), c.cuda())
         return h, c
 
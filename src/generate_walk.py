@@ -5,20 +5,367 @@
         Zeyu Li <zyli@cs.ucla.edu> or <zeyuli@ucla.edu>
 
     Description:
-        Generating random walks on our Uq, Ua, and Q network using NetworkX.
+        Generating random walks on our Uq, Ua, and Q network, stored as
+        a CSR adjacency, see `csr_graph`.
 
 
 """
 
 import os, sys
-import networkx as nx
+import time
 import random
+import shutil
+import hashlib
 import numpy as np
 import math
+from multiprocessing import Pool
 
-from collections import Counter
 import itertools
 
+import textio
+from csr_graph import CSRGraph
+import csr_graph
+
+
+def walk_width(length, pattern=None):
+    """The number of nodes of a walk of `length` following `pattern`
+
+    A meta-path walk only stops after a whole pattern, so it has the
+        smallest multiple of len(pattern) - 1 steps not below `length`.
+    """
+    if not pattern:
+        return length + 1
+    period = len(pattern) - 1
+    return 1 + int(math.ceil(length / period)) * period
+
+
+def lockstep_walks(graph, starts, length, pattern=None, alpha=0.0, rng=None):
+    """Advance one walker per start node in lockstep
+
+    Every step moves all walkers at once with array operations on the
+        CSR graph: a walker of `pattern` draws a neighbor of the next
+        type of the pattern from the typed-neighbor index, otherwise
+        any neighbor. With probability `alpha`, or when the current
+        node has no neighbor of the next type, a walker restarts from
+        its start node and the pattern starts over.
+
+    Args:
+        graph - the `CSRGraph`
+        starts - the start node indices
+        length - the walk length, see `walk_width`
+        pattern - the meta-path, e.g. "AQRQA", None for plain random walks
+        alpha - the probability of restart
+        rng - np.random.RandomState
+
+    Return:
+        walks - len(starts) x `walk_width` int32 matrix of node indices
+    """
+    rng = rng or np.random.RandomState()
+    starts = np.asarray(starts, dtype=np.int64)
+    n_walkers = len(starts)
+    walks = np.empty((n_walkers, walk_width(length, pattern)), dtype=np.int32)
+    walks[:, 0] = starts
+    indptr, indices, type_ptr = graph.indptr, graph.indices, graph.type_ptr
+    if pattern:
+        types = np.array([csr_graph.TYPE_INDEX[x] for x in pattern])
+        period = len(pattern) - 1
+        pos = np.ones(n_walkers, dtype=np.int64)
+
+    cur = starts
+    for step in range(1, walks.shape[1]):
+        if pattern:
+            t = types[pos]
+            lo, hi = type_ptr[cur, t], type_ptr[cur, t + 1]
+        else:
+            lo, hi = indptr[cur], indptr[cur + 1]
+        restart = hi == lo
+        if alpha > 0:
+            restart |= rng.random_sample(n_walkers) < alpha
+        choice = lo + (rng.random_sample(n_walkers) * (hi - lo)).astype(np.int64)
+        cur = np.where(restart, starts, indices[np.where(restart, 0, choice)])
+        walks[:, step] = cur
+        if pattern:
+            pos = np.where(restart, 1, pos % period + 1)
+    return walks
+
+
+# The graph of a walk worker process, set by `init_walker`
+_graph = None
+
+
+def shard_seed(seed, *keys):
+    """A 32-bit seed derived from the global seed and the shard keys"""
+    key = repr((seed,) + keys).encode()
+    return int(hashlib.sha1(key).hexdigest()[:8], 16)
+
+
+def init_walker(graph_dir):
+    global _graph
+    _graph = CSRGraph.load(graph_dir)
+
+
+def walk_shard(task, graph=None):
+    """Walk a shard and write its walks to the shard file
+
+    Args:
+        task - (start nodes, length, pattern, alpha, seed, path)
+        graph - the `CSRGraph`, that of the worker if None
+    """
+    starts, length, pattern, alpha, seed, path = task
+    walks = lockstep_walks(graph or _graph, starts, length, pattern, alpha,
+                           np.random.RandomState(seed))
+    np.save(path, walks)
+    return path
+
+
+def report_shards(done, total):
+    if done == total or done % max(1, total // 10) == 0:
+        print("Finished {} of {} shards".format(done, total))
+
+
+def load_walk_shards(shard_dir):
+    """Concatenate the shard files of `shard_dir` in their name order
+
+    Return:
+        int32 walk matrix, rows padded by -1 to the widest shard
+    """
+    blocks = [np.load(os.path.join(shard_dir, name), mmap_mode="r")
+              for name in sorted(os.listdir(shard_dir))
+              if name.endswith(".npy")]
+    width = max([block.shape[1] for block in blocks] or [0])
+    walk_matrix = np.full((sum(len(block) for block in blocks), width), -1,
+                          dtype=np.int32)
+    row = 0
+    for block in blocks:
+        walk_matrix[row: row + len(block), :block.shape[1]] = block
+        row += len(block)
+    return walk_matrix
+
+
+class ShardWalks:
+    """Lazy walks of the shard files, as lines of node names
+
+    Iterating reads the shards of `generate_walk_matrix` block by block
+        in the order of `load_walk_shards`, so neither the walk matrix
+        nor the lines are ever all in memory.
+
+    Args:
+        shard_dir - the folder of the shard files
+        names - np.array of node names, by node index
+        block_rows - the number of walks read at a time
+    """
+
+    def __init__(self, shard_dir, names, block_rows=1 << 14):
+        self.shard_dir = shard_dir
+        self.names = names
+        self.block_rows = block_rows
+
+    def __len__(self):
+        return sum(len(np.load(os.path.join(self.shard_dir, name), mmap_mode="r"))
+                   for name in os.listdir(self.shard_dir)
+                   if name.endswith(".npy"))
+
+    def __iter__(self):
+        names = self.names
+        for block in iter_shard_blocks(self.shard_dir, self.block_rows):
+            for row in block:
+                yield " ".join(names[row[row >= 0]])
+
+
+def pairs_per_walk(width, window_size):
+    """The largest number of pairs of a walk of `width` nodes"""
+    return sum(width - abs(d) for d in context_offsets(window_size)
+               if abs(d) < width)
+
+
+def context_offsets(window_size):
+    """The offsets of the context of a position, as `path_to_pairs`
+
+    `window_size` nodes on the left and `window_size` - 1 on the right.
+    """
+    return list(range(-window_size, 0)) + list(range(1, window_size))
+
+
+def window_pairs(walks, window_size, rng=None):
+    """The (token, context) pairs of a block of walks
+
+    The same pairs as `path_to_pairs`, in another order, over node
+        indices. The -1 padding of the walk matrix is skipped.
+
+    Args:
+        walks - int matrix of node indices, a walk per row
+        window_size - the sliding window size
+        rng - shrink the window of every token to a size drawn
+            uniformly from 1 to `window_size` by this
+            np.random.RandomState (or np.random), as word2vec does
+
+    Return:
+        pairs - N x 2 int32 array of (token, context)
+    """
+    walks = np.asarray(walks)
+    if rng is not None:
+        sizes = rng.randint(1, window_size + 1, size=walks.shape)
+    blocks = []
+    for d in context_offsets(window_size):
+        if abs(d) >= walks.shape[1]:
+            continue
+        if d < 0:
+            token, context = walks[:, -d:], walks[:, :d]
+        else:
+            token, context = walks[:, :-d], walks[:, d:]
+        keep = (token >= 0) & (context >= 0)
+        if rng is not None:
+            # The offsets of `context_offsets` of the shrunk size
+            size = sizes[:, -d:] if d < 0 else sizes[:, :-d]
+            keep &= (size >= -d) if d < 0 else (size > d)
+        blocks.append(np.stack([token[keep], context[keep]], axis=1))
+    if not blocks:
+        return np.zeros((0, 2), dtype=np.int32)
+    return np.concatenate(blocks).astype(np.int32, copy=False)
+
+
+def iter_shard_blocks(shard_dir, block_rows):
+    """Blocks of at most `block_rows` walks of the shard files"""
+    for name in sorted(os.listdir(shard_dir)):
+        if not name.endswith(".npy"):
+            continue
+        shard = np.load(os.path.join(shard_dir, name), mmap_mode="r")
+        for lo in range(0, len(shard), block_rows):
+            yield np.asarray(shard[lo: lo + block_rows])
+
+
+def iter_text_blocks(path, index, block_rows):
+    """Blocks of at most `block_rows` walks of a metapath text file
+
+    Args:
+        index - dict from node name to node index
+    Return:
+        int32 matrices of node indices, padded by -1
+    """
+    with textio.open_text(path, "r") as fin:
+        while True:
+            walks = [[index[token] for token in line.split()]
+                     for line in itertools.islice(fin, block_rows)]
+            if not walks:
+                return
+            block = np.full((len(walks), max(len(walk) for walk in walks)), -1,
+                            dtype=np.int32)
+            for row, walk in enumerate(walks):
+                block[row, :len(walk)] = walk
+            yield block
+
+
+def scatter_pairs(chunks, tmp_dir, n_buckets, assign):
+    """Append every pair of a stream to a bucket file
+
+    Args:
+        chunks - iterator of N x 2 int32 arrays of pairs
+        tmp_dir - the folder of the bucket files
+        n_buckets - the number of buckets
+        assign - function from a chunk to the bucket of every pair
+
+    Return:
+        paths - the bucket files, raw int32
+    """
+    paths = [tmp_dir + "{:05d}.bin".format(b) for b in range(n_buckets)]
+    for chunk in chunks:
+        buckets = assign(chunk)
+        order = np.argsort(buckets, kind="mergesort")
+        bounds = np.searchsorted(buckets[order], np.arange(n_buckets + 1))
+        chunk = chunk[order]
+        for b in np.flatnonzero(np.diff(bounds)):
+            with open(paths[b], "ab") as fout:
+                chunk[bounds[b]: bounds[b + 1]].tofile(fout)
+    return paths
+
+
+def iter_buckets(paths):
+    """The pairs of the bucket files, one at a time, removing each file"""
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        pairs = np.fromfile(path, dtype=np.int32).reshape(-1, 2)
+        os.remove(path)
+        yield pairs
+
+
+def pair_keys(pairs):
+    """Hash of every pair, the same for all copies of the pair"""
+    keys = (pairs[:, 0].astype(np.uint64) << np.uint64(32)) \
+        | pairs[:, 1].astype(np.uint32).astype(np.uint64)
+    return (keys * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(33)
+
+
+def external_shuffle(chunks, tmp_dir, n_buckets, rng):
+    """Shuffle a stream of pairs larger than the memory
+
+    The pairs are scattered to `n_buckets` random bucket files, then
+        every bucket is loaded, permuted and yielded in turn, so only
+        one chunk or one bucket is ever in memory. The concatenation of
+        the yielded chunks is a uniform random permutation.
+
+    Args:
+        chunks - iterator of N x 2 int32 arrays of pairs
+        tmp_dir - an empty folder for the bucket files
+        n_buckets - the number of buckets
+        rng - np.random.RandomState
+
+    Return:
+        iterator of the shuffled N x 2 int32 chunks
+    """
+    paths = scatter_pairs(chunks, tmp_dir, n_buckets,
+                          lambda chunk: rng.randint(n_buckets, size=len(chunk)))
+    for pairs in iter_buckets(paths):
+        yield pairs[rng.permutation(len(pairs))]
+
+
+def encode_pairs(pairs):
+    """Encode N x 2 non-negative int32 pairs as int64 codes"""
+    return (pairs[:, 0].astype(np.int64) << 32) | pairs[:, 1].astype(np.int64)
+
+
+def decode_pairs(codes):
+    """The N x 2 int32 pairs of `encode_pairs` codes"""
+    return np.stack([codes >> 32, codes & 0xFFFFFFFF], axis=1).astype(np.int32)
+
+
+def count_pairs(pairs):
+    """The distinct pairs of an N x 2 array, sorted, and their counts"""
+    codes, counts = np.unique(encode_pairs(pairs), return_counts=True)
+    return decode_pairs(codes), counts
+
+
+def down_sample_weights(pairs):
+    """Down sampling of an N x 2 array of pairs, as weights
+
+    1. Remove all the self pairs such as "A_11 A_11"
+    2. Weigh a pair seen count times by ceil(log(count)), so the pairs
+        seen once are removed
+
+    Return:
+        pairs - the distinct kept pairs, N x 2 int32, sorted
+        weights - int64, the number of copies of every pair
+    """
+    pairs, counts = count_pairs(pairs[pairs[:, 0] != pairs[:, 1]])
+    weights = np.ceil(np.log(counts)).astype(np.int64)
+    keep = weights > 0
+    return pairs[keep], weights[keep]
+
+
+def down_sample_pairs(pairs):
+    """The pairs of `down_sample_weights`, repeated by their weights"""
+    pairs, weights = down_sample_weights(pairs)
+    return np.repeat(pairs, weights, axis=0)
+
+
+def write_pair_lines(fout, names, pairs, weights=None):
+    """Write pairs of node indices as "<token> <context>[ <weight>]" lines"""
+    if not len(pairs):
+        return
+    columns = [names[pairs[:, 0]].tolist(), names[pairs[:, 1]].tolist()]
+    if weights is not None:
+        columns.append([str(w) for w in weights.tolist()])
+    fout.write("\n".join(" ".join(row) for row in zip(*columns)) + "\n")
 
 
 class MetaPathGenerator:
@@ -30,16 +377,23 @@ class MetaPathGenerator:
         num_walks   - the number of random walks start from each node
     """
 
-    def __init__(self, dataset, length=100, coverage=10000):
+    def __init__(self, dataset, length=100, coverage=10000, build_graph=True):
         self._walk_length = length
         self._coverage = coverage
         self._dataset = dataset
-        self.G = nx.Graph()
+        self.graph = None
+        self.graph_dir = os.getcwd() + "/data/parsed/" + dataset + "/graph/"
+        # The per-shard walk files of `generate_walk_matrix`
+        self.shard_dir = os.getcwd() + "/metapath/{}_{}_{}/".format(
+            dataset, coverage, length)
 
         self.walks = []
+        self.walk_matrix = None
         self.pairs = []
 
-        self.initialize()
+        # Turning pairs from written walks doesn't need the graph
+        if build_graph:
+            self.initialize()
 
     def initialize(self):
         """ Initialize Graph
@@ -47,33 +401,22 @@ class MetaPathGenerator:
         Initialize graph with Uq-Q pairs and Q-Ua pairs.
         We use following Uppercase letter
 
-        Args:
-            QR_file - Input file containing Q-R pairs
-            QA_file - Input file containing Q-A pairs
-
+        The CSR graph is built from Q_R and Q_A once and saved to the
+        graph/ folder, later runs memory-map it. `extract_relations`
+        removes the folder when it rewrites the relations.
         """
 
         DATA_DIR = os.getcwd() + "/data/parsed/" + self._dataset + "/"
-        QR_file = DATA_DIR + "Q_R.txt"
-        QA_file = DATA_DIR + "Q_A.txt"
-        G = self.G
-        # Read in Uq-Q pairs
-        with open(QR_file, "r") as fin:
-            lines = fin.readlines()
-            RQ_edge_list = []
-            for line in lines:
-                unit = line.strip().split()
-                RQ_edge_list.append(["Q_" + unit[0],
-                                     "R_" + unit[1]])
-            G.add_edges_from(RQ_edge_list)
-        with open(QA_file, "r") as fin:
-            lines = fin.readlines()
-            QA_edge_list = []
-            for line in lines:
-                unit = line.strip().split()
-                QA_edge_list.append(["Q_" + unit[0],
-                                     "A_" + unit[1]])
-            G.add_edges_from(QA_edge_list)
+        if csr_graph.exists(self.graph_dir):
+            self.graph = CSRGraph.load(self.graph_dir)
+            return
+        self.graph = CSRGraph.from_relations(DATA_DIR)
+        self.graph.save(self.graph_dir)
+
+    def check_graph(self, caller):
+        graph = self.graph
+        if graph is None or not graph.number_of_edges():
+            sys.exit("Graph should be initialized before {}()!".format(caller))
 
     def get_nodelist(self, type=None):
         """ Get specific type or all nodes of nodelist in the graph
@@ -83,19 +426,14 @@ class MetaPathGenerator:
                    If set as `None`, then all types of nodes would be returned.
 
         Return:
-            nodelist - the list of node with `type`
+            nodelist - the list of node indices with `type`, the names
+                are given by `CSRGraph.name`
         """
-        G = self.G
-
-        if not G.number_of_edges() or not G.number_of_nodes():
-            sys.exit("Graph should be initialized before get_nodelist()!")
-
-        if not type:
-            return list(G.nodes)
-        return [node for node in list(G.nodes)
-                if node[0] == type]
+        self.check_graph("get_nodelist")
+        return self.graph.nodes(type).tolist()
 
-    def generate_metapaths(self, patterns, alpha):
+    def generate_metapaths(self, patterns, alpha, lockstep=True, seed=0,
+                           workers=1):
         """ Generate Random Walk
 
         Generating random walk from the Tripartite graph
@@ -106,24 +444,35 @@ class MetaPathGenerator:
         Args:
             meta_pattern - the pattern that guides the walk generation
             alpha - probability of restart
+            lockstep - generate by `generate_walk_matrix` and keep the
+                walks in its shard files, see `shard_walks`, otherwise
+                one walk at a time
+            seed - the random seed, the same seed gives the same walks
+            workers - the number of processes of `generate_walk_matrix`
 
         Return:
             walks - a set of generated random walks
         """
-        G = self.G
+        if lockstep:
+            self.generate_walk_matrix(patterns, alpha, seed, workers,
+                                      load=False)
+            self.walks = self.shard_walks()
+            return
+
+        # Only the text of these walks is written, see `stream_pairs`
+        self.remove_shards()
         num_walks, walk_len = self._coverage, self._walk_length
-        rand = random.Random(0)
 
         print("Generating Meta-paths ...")
 
-        if not G.number_of_edges() or not G.number_of_nodes():
-            sys.exit("Graph should be initialized before generate_walks()!")
+        self.check_graph("generate_walks")
 
         walks = []
 
         for meta_pattern in patterns:  # Generate by patterns
             print("\tNow generating meta-paths from pattern: \"{}\" ..."
                   .format(meta_pattern))
+            rand = random.Random(shard_seed(seed, meta_pattern))
             start_entity_type = meta_pattern[0]
             start_node_list = self.get_nodelist(start_entity_type)
             for cnt in range(num_walks):  # Iterate the node set for cnt times
@@ -138,31 +487,41 @@ class MetaPathGenerator:
                         self.__meta_path_walk(
                             start=start_node,
                             alpha=alpha,
-                            pattern=meta_pattern))
+                            pattern=meta_pattern,
+                            rand=rand))
 
         print("Done!")
         self.walks = walks
         return
 
-    def generate_metapaths_2(self):
+    def generate_metapaths_2(self, lockstep=True, seed=0, workers=1):
         """ Generate Random Walk
 
         Generating random walk from the Tripartite graph
         Args:
-            meta_pattern - the pattern that guides the walk generation
-            alpha - probability of restart
+            lockstep - generate by `generate_walk_matrix` and keep the
+                walks in its shard files, see `shard_walks`, otherwise
+                one walk at a time
+            seed - the random seed, the same seed gives the same walks
+            workers - the number of processes of `generate_walk_matrix`
 
         Return:
             walks - a set of generated random walks
         """
-        G = self.G
+        if lockstep:
+            self.generate_walk_matrix(None, 0.0, seed, workers,
+                                      load=False)
+            self.walks = self.shard_walks()
+            return
+
+        # Only the text of these walks is written, see `stream_pairs`
+        self.remove_shards()
         num_walks, walk_len = self._coverage, self._walk_length
-        rand = random.Random(0)
+        rand = random.Random(shard_seed(seed, "deepwalk"))
 
         print("Generating Meta-paths ...")
 
-        if not G.number_of_edges() or not G.number_of_nodes():
-            sys.exit("Graph should be initialized before generate_walks()!")
+        self.check_graph("generate_walks")
 
         walks = []
 
@@ -176,60 +535,178 @@ class MetaPathGenerator:
                 if ind % 3000 == 0:
                     print("Finished {:.2f}".format(ind/total))
                 walks.append(
-                    self.__random_walk(start=start_node))
+                    self.__random_walk(start=start_node, rand=rand))
 
         print("Done!")
         self.walks = walks
         return
 
-    def __random_walk(self, start=None):
+    def generate_walk_matrix(self, patterns=None, alpha=0.0, seed=0,
+                             workers=1, shard_size=1 << 16, load=True):
+        """ Generate all walks in lockstep, see `lockstep_walks`
+
+        Every coverage round walks once from every start node of a
+        pattern, in a random order. A round is split into shards of
+        `shard_size` start nodes, which a pool of `workers` processes
+        walks and writes to one .npy file each in `shard_dir`. The
+        order of a round and the random state of a shard only depend on
+        (seed, pattern, round, shard), see `shard_seed`, so the walks
+        are bit-identical for any number of workers.
+
+        Args:
+            patterns - the meta-paths, None for plain random walks from
+                all nodes (as `generate_metapaths_2`)
+            alpha - probability of restart
+            seed - the global random seed
+            workers - the number of processes
+            shard_size - the number of walkers of a shard
+            load - concatenate the shards into `walk_matrix`
+
+        Return:
+            walk_matrix - int32 matrix of node indices, a walk per row,
+                padded by -1 when the patterns give different widths,
+                None if not `load`
+        """
+        self.check_graph("generate_walks")
+        print("Generating Meta-paths ...")
+        self.remove_shards()
+        os.makedirs(self.shard_dir)
+
+        tasks = []
+        for ind, pattern in enumerate(patterns or [None]):
+            name = pattern or "deepwalk"
+            print("\tNow generating meta-paths from {} ..."
+                  .format("pattern: \"{}\"".format(pattern) if pattern
+                          else "deepwalk"))
+            start_node_list = self.get_nodelist(pattern[0] if pattern else None)
+            for cnt in range(self._coverage):
+                order = np.random.RandomState(
+                    shard_seed(seed, name, cnt)).permutation(start_node_list)
+                for shard, lo in enumerate(range(0, len(order), shard_size)):
+                    tasks.append((order[lo: lo + shard_size], self._walk_length,
+                                  pattern, alpha,
+                                  shard_seed(seed, name, cnt, shard),
+                                  self.shard_dir + "{:02d}_{}_{:05d}_{:05d}.npy"
+                                  .format(ind, name, cnt, shard)))
+
+        if workers > 1:
+            with Pool(workers, initializer=init_walker,
+                      initargs=(self.graph_dir,)) as pool:
+                for done, _ in enumerate(pool.imap_unordered(walk_shard, tasks)):
+                    report_shards(done + 1, len(tasks))
+        else:
+            for done, task in enumerate(tasks):
+                walk_shard(task, self.graph)
+                report_shards(done + 1, len(tasks))
+
+        print("Done!")
+        self.walk_matrix = load_walk_shards(self.shard_dir) if load else None
+        return self.walk_matrix
+
+    def remove_shards(self):
+        """Remove the shard files of earlier walks"""
+        if os.path.exists(self.shard_dir):
+            shutil.rmtree(self.shard_dir)
+
+    def benchmark_walks(self, patterns=None, alpha=0.0, sample_size=2000,
+                        seed=0):
+        """Walks per second of the lockstep and the one-at-a-time walkers
+
+        The one-at-a-time walker runs from `sample_size` start nodes,
+            the lockstep walker from all start nodes of one round.
+
+        Args:
+            patterns - the meta-paths, None for plain random walks
+            seed - the random seed of the start nodes and both walkers
+
+        Return:
+            dict from pattern to (one-at-a-time, lockstep) walks per second
+        """
+        self.check_graph("benchmark_walks")
+        rng = np.random.RandomState(seed)
+        rand = random.Random(seed)
+        results = {}
+        for pattern in (patterns or [None]):
+            starts = self.get_nodelist(pattern[0] if pattern else None)
+            sample = rng.choice(starts, min(sample_size, len(starts)),
+                                replace=False).tolist()
+            start = time.time()
+            for node in sample:
+                try:
+                    if pattern:
+                        self.__meta_path_walk(start=node, alpha=alpha,
+                                              pattern=pattern, rand=rand)
+                    else:
+                        self.__random_walk(start=node, rand=rand)
+                except ValueError:
+                    # A dead end, the lockstep walker restarts instead
+                    pass
+            single = len(sample) / max(time.time() - start, 1e-9)
+
+            start = time.time()
+            lockstep_walks(self.graph, rng.permutation(starts),
+                           self._walk_length, pattern, alpha, rng)
+            lockstep = len(starts) / max(time.time() - start, 1e-9)
+            results[pattern] = (single, lockstep)
+            print("\t{}: one at a time {:.0f} walks/s, lockstep {:.0f} walks/s, "
+                  "speedup {:.1f}x".format(pattern or "deepwalk", single,
+                                           lockstep, lockstep / single))
+        return results
+
+    def shard_walks(self):
+        """The walks of the shard files as lazy lines of node names"""
+        names = np.array(self.graph.names(self.graph.nodes()))
+        return ShardWalks(self.shard_dir, names)
+
+    def __random_walk(self, start=None, rand=None):
         """Single Random Walk Generator
 
         Args:
-            rand - an random object to generate random numbers
             start - starting node
+            rand - an random object to generate random numbers,
+                unseeded if None
 
         Return:
             walk - the single walk generated
         """
-        G = self.G
-        rand = random.Random()
+        graph = self.graph
+        indptr, indices = graph.indptr, graph.indices
+        rand = rand or random.Random()
         walk = [start]
         cur_node = start
         while len(walk) <= self._walk_length:
-            possible_next_nodes = [neighbor
-                                   for neighbor in G.neighbors(cur_node)]
-            next_node = rand.choice(possible_next_nodes)
+            next_node = indices[rand.randrange(indptr[cur_node],
+                                               indptr[cur_node + 1])]
             walk.append(next_node)
             cur_node = next_node
 
-        return " ".join(walk)
+        return " ".join(graph.names(walk))
 
-    def __meta_path_walk(self, start=None, alpha=0.0, pattern=None):
+    def __meta_path_walk(self, start=None, alpha=0.0, pattern=None, rand=None):
         """Single Walk Generator
 
         Generating a single random walk that follows a meta path of `pattern`
 
         Args:
-            rand - an random object to generate random numbers
             start - starting node
             alpha - probability of restarts
             pattern - (string) the pattern according to which to generate walks
-            walk_len - (int) the length of the generated walk
+            rand - an random object to generate random numbers,
+                unseeded if None
 
         Return:
             walk - the single walk generated
 
         """
-        def type_of(node_id):
-            return node_id[0]
-
-        rand = random.Random()
+        rand = rand or random.Random()
         # Checking pattern is correctly initialized
         if not pattern:
             sys.exit("Pattern is not specified when generating meta-path walk")
 
-        G = self.G
+        graph = self.graph
+        indices, type_ptr = graph.indices, graph.type_ptr
+        # The slice of the next type in the typed-neighbor index
+        next_types = [csr_graph.TYPE_INDEX[x] for x in pattern]
         n, pat_ind = 1, 1
 
         walk = [start]
@@ -245,11 +722,10 @@ class MetaPathGenerator:
             # Decide whether to restart
             if rand.random() >= alpha:
                 # Find all possible next neighbors
-                possible_next_node = [neighbor
-                                      for neighbor in G.neighbors(cur_node)
-                                      if type_of(neighbor) == pattern[pat_ind]]
+                t = next_types[pat_ind]
                 # Random choose next node
-                next_node = rand.choice(possible_next_node)
+                next_node = indices[rand.randrange(type_ptr[cur_node, t],
+                                                   type_ptr[cur_node, t + 1])]
             else:
                 next_node = walk[0]
 
@@ -257,11 +733,14 @@ class MetaPathGenerator:
             cur_node = next_node
             pat_ind += 1
 
-        return " ".join(walk)
+        return " ".join(graph.names(walk))
 
     def write_metapaths(self):
         """Write Metapaths to files
 
+        The walks of the lockstep generation are streamed from the
+            shard files, see `ShardWalks`.
+
         Args:
             walks - The walks generated by `generate_walks`
         """
@@ -273,12 +752,20 @@ class MetaPathGenerator:
                  + str(self._coverage) + "_" + str(self._walk_length) + ".txt"
         if not os.path.exists(DATA_DIR):
             os.mkdir(DATA_DIR)
-        with open(OUTPUT, "w") as fout:
+        with textio.open_text(OUTPUT, "w") as fout:
             for walk in self.walks:
                 print("{}".format(walk), file=fout)
 
         print("Done!")
 
+    def load_metapaths(self):
+        """Load the walks written by `write_metapaths`"""
+        INPUT = os.getcwd() + "/metapath/" + self._dataset + "_" \
+                + str(self._coverage) + "_" + str(self._walk_length) + ".txt"
+        with textio.open_text(INPUT, "r") as fin:
+            self.walks = [line.strip() for line in fin]
+        return
+
     def path_to_pairs(self, window_size):
         """Convert all metapaths to pairs of nodes
 
@@ -323,32 +810,135 @@ class MetaPathGenerator:
                  str(self._coverage) + "_" + str(self._walk_length) + ".txt"
         if not os.path.exists(DATA_DIR):
             os.mkdir(DATA_DIR)
-        with open(OUTPUT, "w") as fout:
+        with textio.open_text(OUTPUT, "w") as fout:
             for pair in self.pairs:
                 print("{} {}".format(pair[0], pair[1]), file=fout)
         return
 
     def down_sample(self):
         """Down sampling the training sets
-        
+
         1. Remove all the duplicate tuples such as "A_11 A_11"
         2. Take log of all tuples as a down sampling
+
+        The pairs are encoded as integers and down sampled by
+            `down_sample_pairs`, then shuffled by a single permutation.
         """
+        if not len(self.pairs):
+            return
+        index = {}
+        tokens = itertools.chain.from_iterable(self.pairs)
+        pairs = np.fromiter((index.setdefault(token, len(index))
+                             for token in tokens),
+                            dtype=np.int32, count=2 * len(self.pairs))
+        names = np.array(list(index))
+        pairs = down_sample_pairs(pairs.reshape(-1, 2))
+        pairs = pairs[np.random.permutation(len(pairs))]
+        self.pairs = list(zip(names[pairs[:, 0]].tolist(),
+                              names[pairs[:, 1]].tolist()))
+
+    def stream_pairs(self, window_size, down_sample=True, weighted=False,
+                     seed=0, bucket_pairs=1 << 20):
+        """Write the shuffled pair corpus of the walks with bounded memory
+
+        The streaming counterpart of `path_to_pairs`, `down_sample` and
+        `write_pairs`. The walks are read in blocks from the shard files
+        of `generate_walk_matrix`, else from the metapath file, and their
+        pairs are shuffled on disk by `external_shuffle`. One at a time
+        generation writes no shard files and removes those of earlier
+        walks, so the shards are always those of the last walks. To down
+        sample, the pairs are first partitioned by `pair_keys`, so that all
+        copies of a pair are counted in the same bucket. The peak memory
+        is about `bucket_pairs` pairs whatever the size of the corpus.
+
+        A weighted corpus has a line "<token> <context> <weight>" per
+        distinct pair instead of `weight` shuffled copies of the pair,
+        the DataLoader samples the pairs in proportion to the weights.
+        It is written right from the partitioned buckets, unshuffled.
 
-        pairs = self.pairs
-        pairs = [(pair[0], pair[1])
-                 for pair in pairs
-                 if pair[0] != pair[1]]
-        cnt = Counter(pairs)
-        down_cnt = [[pair] * math.ceil(math.log(count))
-                    for pair, count in cnt.items()]
-        self.pairs = list(itertools.chain(*down_cnt))
-        np.random.shuffle(self.pairs)
+        Args:
+            window_size - the sliding window size
+            down_sample - down sample the pairs as `down_sample`
+            weighted - write a weighted corpus, the weight of a pair is
+                that of `down_sample_weights`, else its count
+            seed - the random seed of the shuffle
+            bucket_pairs - the number of pairs of a block or a bucket
+        """
+        print("Writing Generated Pairs to files ...")
+        if self.graph is None:
+            self.initialize()
+        names = np.array(self.graph.names(self.graph.nodes()))
+        name = "{}_{}_{}".format(self._dataset, self._coverage,
+                                 self._walk_length)
+        DATA_DIR = os.getcwd() + "/corpus/"
+        OUTPUT = DATA_DIR + name + ".txt"
+        tmp_dir = DATA_DIR + name + ".tmp/"
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+
+        shards = [x for x in os.listdir(self.shard_dir) if x.endswith(".npy")] \
+            if os.path.exists(self.shard_dir) else []
+        if shards:
+            heads = [np.load(self.shard_dir + x, mmap_mode="r") for x in shards]
+            n_walks = sum(len(head) for head in heads)
+            width = max(head.shape[1] for head in heads)
+            del heads
+        else:
+            path = os.getcwd() + "/metapath/" + name + ".txt"
+            if not textio.exists(path):
+                sys.exit("Walks haven't been created.")
+            with textio.open_text(path, "r") as fin:
+                n_walks, width = 0, 0
+                for line in fin:
+                    n_walks += 1
+                    width = max(width, line.count(" ") + 1)
+
+        per_walk = max(1, pairs_per_walk(width, window_size))
+        block_rows = max(1, bucket_pairs // per_walk)
+        n_buckets = max(1, int(math.ceil(n_walks * per_walk / bucket_pairs)))
+        if shards:
+            blocks = iter_shard_blocks(self.shard_dir, block_rows)
+        else:
+            index = {node: i for i, node in enumerate(names.tolist())}
+            blocks = iter_text_blocks(path, index, block_rows)
+        chunks = (window_pairs(block, window_size) for block in blocks)
+
+        if not os.path.exists(DATA_DIR):
+            os.mkdir(DATA_DIR)
+        count = 0
+        rng = np.random.RandomState(seed)
+        if down_sample or weighted:
+            os.makedirs(tmp_dir + "keys/")
+            paths = scatter_pairs(chunks, tmp_dir + "keys/", n_buckets,
+                                  lambda chunk: pair_keys(chunk) % n_buckets)
+            buckets = iter_buckets(paths)
+
+        if weighted:
+            with textio.open_text(OUTPUT, "w") as fout:
+                for pairs in buckets:
+                    if down_sample:
+                        pairs, weights = down_sample_weights(pairs)
+                    else:
+                        pairs, weights = count_pairs(pairs)
+                    write_pair_lines(fout, names, pairs, weights)
+                    count += len(pairs)
+        else:
+            if down_sample:
+                chunks = (down_sample_pairs(pairs) for pairs in buckets)
+            with textio.open_text(OUTPUT, "w") as fout:
+                for pairs in external_shuffle(chunks, tmp_dir, n_buckets, rng):
+                    write_pair_lines(fout, names, pairs)
+                    count += len(pairs)
+        shutil.rmtree(tmp_dir)
+        print("\tWrote {} pairs in {} buckets".format(count, n_buckets))
+        return count
 
 if __name__ == "__main__":
     if len(sys.argv) < 4 + 1:
         print("\t Usage:{} "
               "[name of dataset] [length] [num_walk] [window_size]"
+              " [bench (optional)]"
               .format(sys.argv[0], file=sys.stderr))
         sys.exit(1)
     dataset = sys.argv[1]
@@ -358,13 +948,16 @@ if __name__ == "__main__":
     
     gw = MetaPathGenerator(length=length, coverage=num_walk, dataset=dataset)
 
+    if len(sys.argv) > 5 and sys.argv[5] == "bench":
+        gw.benchmark_walks()
+        gw.benchmark_walks(patterns=["AQRQA", "AQA"])
+        sys.exit(0)
+
     # Uncomment the first line for metapath-based
     # gw.generate_metapaths(patterns=["AQRQA"], alpha=0)
     gw.generate_metapaths_2()
-    gw.path_to_pairs(window_size=window_size)
-    gw.down_sample()
     gw.write_metapaths()
-    gw.write_pairs()
+    gw.stream_pairs(window_size=window_size, weighted=True)
 
 
 
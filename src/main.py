@@ -7,6 +7,34 @@ from optparse import OptionParser
 
 # :os.environ["CUDA_VISIBLE_DEVICES"] = "1,2,3"
 
+def build_pder(options):
+    """Build the PDER model from the parsed options"""
+    return PDER(
+        dataset=options.dataset,
+        embedding_dim=options.embedding_dim,
+        epoch_num=options.epoch_num,
+        batch_size=options.batch_size,
+        # window_size=options.window_size,
+        neg_sample_ratio=options.neg_ratio,
+        lstm_layers=options.lstm_layers,
+        include_content=options.include_content,
+        lr=options.learning_rate,
+        cnn_channel=options.cnn_channel,
+        lambda_=options.lambda_,
+        prec_k=options.prec_k,
+        test_ratio=options.test_ratio,
+        # test_prop=options.proportion_test,
+        # neg_test_ratio=options.neg_test_ratio,
+        mp_length=options.length,
+        mp_coverage=options.coverage,
+        id=options.id,
+        answer_sample_ratio=options.answer_sample_ratio,
+        # Pairs of the walks generated while training, see DataLoader
+        window_size=options.window_size if options.walk_pairs else None,
+        shrink_window=not options.fixed_window
+    )
+
+
 def runPDER(options):
 
     # Check validity of parameters
@@ -19,7 +47,9 @@ def runPDER(options):
         preprocess_(dataset=options.dataset,
                     threshold=options.test_threshold,
                     prop_test=options.proportion_test,
-                    sample_size=options.test_size)
+                    sample_size=options.test_size,
+                    workers=options.preprocess_workers,
+                    html_parser=options.html_parser)
 
     # preprocessing
     if options.gen_mp:
@@ -27,72 +57,39 @@ def runPDER(options):
             length=options.length,
             coverage=options.coverage,
             dataset=options.dataset)
-        walks = mp_generator.generate_metapaths(
+        mp_generator.generate_metapaths(
             patterns=options.meta_paths.split(" "),
-            alpha=options.alpha)
-        mp_generator.write_metapaths(walks)
+            alpha=options.alpha,
+            workers=options.walk_workers)
+        mp_generator.write_metapaths()
 
-    # init data_loader
-    pder_model = PDER(
-        dataset=options.dataset,
-        embedding_dim=options.embedding_dim,
-        epoch_num=options.epoch_num,
-        batch_size=options.batch_size,
-        # window_size=options.window_size,
-        neg_sample_ratio=options.neg_ratio,
-        lstm_layers=options.lstm_layers,
-        include_content=options.include_content,
-        lr=options.learning_rate,
-        cnn_channel=options.cnn_channel,
-        lambda_=options.lambda_,
-        prec_k=options.prec_k,
-        test_ratio=options.test_ratio,
-        # test_prop=options.proportion_test,
-        # neg_test_ratio=options.neg_test_ratio,
-        mp_length=options.length,
-        mp_coverage=options.coverage,
-        id=options.id,
-        answer_sample_ratio=options.answer_sample_ratio
-    )
+        # The pair corpus read by DataLoader
+        if not options.walk_pairs:
+            mp_generator.stream_pairs(window_size=options.window_size,
+                                      weighted=True)
 
-    pder_model.run()
-    pder_model.test()
+    # init data_loader
+    pder_model = build_pder(options)
 
+    if options.checkpoint:
+        pder_model.load_model(options.checkpoint)
+    else:
+        pder_model.run()
+        pder_model.test()
 
+    if options.build_index:
+        pder_model.build_index()
 
-if __name__ == '__main__':
-    """Generating random walks and output to file
-    
-    [a, b, c, d, e, f, g, h, i, [j], k, 
-     l, m, n, o, p, q, r, [s], t, u, v,
-     [w], x, y, z]
+    if options.bench_index:
+        pder_model.benchmark_index(k=options.prec_k)
 
-    Args:
-        -d, --dataset (str)
-        -l, --length (int)
-        -c, --coverage (int)
-        -a, --alpha (int)
-        -m, --meta-paths (str, split by " ")
-        -p, --preprocess (bool)
-        -w, --window-size (size)
-        -g, --gen-metapaths (bool)
-        -n, --neg-ratio (float)
-        -e, --embedding-dim (int)
-        -y, --lstm-layers (int)
-        -o, --epoch-number (int)
-        -b, --batch-size (int)
-        -u, --include-content (bool)
-        -r, --learning-rate (float)
-        -t, --test-threshold (int)
-        -f, --proportion-test (float)
-        -v, --cnn-channel (int)
-        -j, --answer_sample_ratio
+    if options.quantize:
+        pder_model.compare_quantized()
 
-    Returns:
-        do everything
 
-    """
 
+def get_parser():
+    """Build the option parser of PDER, see `__main__` for options"""
     parser = OptionParser()
     parser.add_option("-d", "--dataset", type="string",
                       dest="dataset", default="3dprinting",
@@ -123,6 +120,15 @@ if __name__ == '__main__':
                       dest="window_size", default=5,
                       help="The window size of the meta-path model.")
 
+    parser.add_option("--walk-pairs", default=False,
+                      dest="walk_pairs", action="store_true",
+                      help="Generate the pairs of each batch from the walks "
+                           "instead of reading the pair corpus.")
+
+    parser.add_option("--fixed-window", default=False,
+                      dest="fixed_window", action="store_true",
+                      help="Do not shrink the window at random with --walk-pairs.")
+
     parser.add_option("-g", "--gen-metapaths", default=False,
                       dest="gen_mp", action="store_true",
                       help="Decide whether to generate new metapaths.")
@@ -191,7 +197,80 @@ if __name__ == '__main__':
                       dest="answer_sample_ratio", default=0.5,
                       help="The ratio of sample answer")
 
+    parser.add_option("--checkpoint", type="string",
+                      dest="checkpoint", default=None,
+                      help="Load this `rs` checkpoint instead of training.")
+
+    parser.add_option("--build-index", default=False,
+                      dest="build_index", action="store_true",
+                      help="Build the ANN index over answerer embeddings.")
+
+    parser.add_option("--bench-index", default=False,
+                      dest="bench_index", action="store_true",
+                      help="Benchmark recall vs latency of the ANN index.")
+
+    parser.add_option("--quantize", default=False,
+                      dest="quantize", action="store_true",
+                      help="Compare int8 dynamic quantization with fp32 on CPU.")
+
+    parser.add_option("--preprocess-workers", type="int",
+                      dest="preprocess_workers", default=1,
+                      help="The number of processes used in preprocessing.")
+
+    parser.add_option("--html-parser", type="choice", choices=["bs4", "lxml"],
+                      dest="html_parser", default="bs4",
+                      help="The HTML to text extractor of post bodies.")
+
+    parser.add_option("--walk-workers", type="int",
+                      dest="walk_workers", default=1,
+                      help="The number of processes generating walks.")
+
+    return parser
+
+
+if __name__ == '__main__':
+    """Generating random walks and output to file
+    
+    [a, b, c, d, e, f, g, h, i, [j], k, 
+     l, m, n, o, p, q, r, [s], t, u, v,
+     [w], x, y, z]
+
+    Args:
+        -d, --dataset (str)
+        -l, --length (int)
+        -c, --coverage (int)
+        -a, --alpha (int)
+        -m, --meta-paths (str, split by " ")
+        -p, --preprocess (bool)
+        -w, --window-size (size)
+        -g, --gen-metapaths (bool)
+        -n, --neg-ratio (float)
+        -e, --embedding-dim (int)
+        -y, --lstm-layers (int)
+        -o, --epoch-number (int)
+        -b, --batch-size (int)
+        -u, --include-content (bool)
+        -r, --learning-rate (float)
+        -t, --test-threshold (int)
+        -f, --proportion-test (float)
+        -v, --cnn-channel (int)
+        -j, --answer_sample_ratio
+        --checkpoint (str)
+        --build-index (bool)
+        --bench-index (bool)
+        --quantize (bool)
+        --preprocess-workers (int)
+        --html-parser (str, "bs4" or "lxml")
+        --walk-workers (int)
+        --walk-pairs (bool)
+        --fixed-window (bool)
+
+    Returns:
+        do everything
+
+    """
 
+    parser = get_parser()
     (options, args) = parser.parse_args()
 
     runPDER(options)
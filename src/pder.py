@@ -7,8 +7,12 @@
 """
 
 import os
+import copy
+import time
 import datetime
+import random
 
+import numpy as np
 import torch
 from torch.autograd import Variable
 import torch.optim as optim
@@ -19,6 +23,7 @@ from skipgram import SkipGram
 from recsys import RecSys
 from data_loader import DataLoader
 from utils import Utils
+from ann_index import IVFPQIndex, benchmark
 
 
 class PDER:
@@ -26,7 +31,8 @@ class PDER:
                  batch_size, neg_sample_ratio,
                  lstm_layers, include_content, lr, cnn_channel,
                  test_ratio, lambda_, prec_k,
-                 mp_length, mp_coverage, id, answer_sample_ratio):
+                 mp_length, mp_coverage, id, answer_sample_ratio,
+                 window_size=None, shrink_window=True):
 
         self.dataset = dataset
         self.embedding_dim = embedding_dim
@@ -45,6 +51,8 @@ class PDER:
                              , coverage=mp_coverage
                              , length=mp_length
                              , answer_sample_ratio=answer_sample_ratio
+                             , window_size=window_size
+                             , shrink_window=shrink_window
                              )
 
         self.utils = Utils(dataset=dataset
@@ -70,6 +78,201 @@ class PDER:
                              , embeddings=self.embedding_manager
                              )
 
+        self.index = None
+        self.all_aid = np.array(sorted(self.dl.all_aid))
+
+    def load_model(self, path):
+        """Load a `rs` checkpoint, embeddings are loaded along with it"""
+        self.utils.load_model(model=self.recsys, path=path)
+        if torch.cuda.is_available():
+            self.recsys.cuda()
+
+    def encode_question(self, qid):
+        """Encode question `qid` of the dataset, return 1 x emb_dim"""
+        dl = self.dl
+        rank_q = Variable(torch.FloatTensor([dl.q2emb(qid)]))
+        rank_q_len = Variable(torch.LongTensor([dl.q2len(qid)]))
+        if torch.cuda.is_available():
+            rank_q, rank_q_len = rank_q.cuda(), rank_q_len.cuda()
+        self.recsys.eval()
+        with torch.no_grad():
+            return self.recsys.encode_question(rank_q, rank_q_len)
+
+    def score_answerers(self, rid, q_emb, aids, chunk=4096):
+        """Score answerers `aids` for question `q_emb` raised by `rid`
+
+        Args:
+            rid  -  the raiser id
+            q_emb  -  1 x emb_dim question encoding
+            aids  -  array of answerer ids
+            chunk  -  the number of answerers scored in one pass
+        Return:
+            scores  -  np.array of the scores of `aids`
+        """
+        dl, emb, recsys = self.dl, self.embedding_manager, self.recsys
+        recsys.eval()
+        rind = Variable(torch.LongTensor(dl.uid2index([rid])))
+        if torch.cuda.is_available():
+            rind = rind.cuda()
+        scores = []
+        with torch.no_grad():
+            emb_r = emb.ru_embeddings(rind)
+            for start in range(0, len(aids), chunk):
+                aind = Variable(torch.LongTensor(
+                    dl.uid2index(aids[start: start + chunk])))
+                if torch.cuda.is_available():
+                    aind = aind.cuda()
+                size = aind.size(0)
+                score = recsys.score(emb_r.expand(size, self.embedding_dim),
+                                     q_emb.expand(size, self.embedding_dim),
+                                     emb.au_embeddings(aind))
+                scores.append(score.cpu().numpy())
+        if not scores:
+            return np.zeros(0, dtype=np.float32)
+        return np.concatenate(scores)
+
+    def index_query(self, rid, q_emb):
+        """The query vector of the ANN index, R embedding + Q encoding"""
+        dl, emb = self.dl, self.embedding_manager
+        rind = Variable(torch.LongTensor(dl.uid2index([rid])))
+        if torch.cuda.is_available():
+            rind = rind.cuda()
+        with torch.no_grad():
+            query = emb.ru_embeddings(rind) + q_emb
+        return query.squeeze(0).cpu().numpy()
+
+    def build_index(self, n_list=64, n_sub=8, n_probe=8):
+        """Build the ANN index over `au_embeddings` of all answerers,
+            and save it next to the model checkpoints
+        """
+        print("Building ANN index over {} answerers ...".format(len(self.all_aid)))
+        weight = self.embedding_manager.au_embeddings.weight.data.cpu().numpy()
+        vectors = weight[self.dl.uid2index(self.all_aid)]
+        self.index = IVFPQIndex(n_list=n_list, n_sub=n_sub, n_probe=n_probe)
+        self.index.build(vectors, self.all_aid)
+        self.index.save(self.utils.index_file)
+        print("Saved index to {}".format(self.utils.index_file))
+
+    def load_index(self):
+        """Load the ANN index saved by `build_index` if any"""
+        if os.path.exists(self.utils.index_file):
+            self.index = IVFPQIndex.load(self.utils.index_file)
+        return self.index
+
+    def route(self, rid, q_emb, top_k=10, candidate_size=300):
+        """Recommend answerers for a question
+
+        Candidates are pre-selected by the ANN index if it is loaded,
+        otherwise all answerers are scored.
+
+        Args:
+            rid  -  the raiser id
+            q_emb  -  1 x emb_dim question encoding
+            top_k  -  the number of answerers to return
+            candidate_size  -  the number of candidates to re-rank
+        Return:
+            list of (aid, score), best first
+        """
+        if self.index is not None:
+            aids, _ = self.index.search(self.index_query(rid, q_emb),
+                                        candidate_size)
+        else:
+            aids = self.all_aid
+        scores = self.score_answerers(rid, q_emb, aids)
+        top = np.argsort(-scores, kind="mergesort")[:top_k]
+        return [(int(aids[i]), float(scores[i])) for i in top]
+
+    def benchmark_index(self, k=10, candidate_sizes=(50, 100, 300, 1000),
+                        n_queries=200):
+        """Recall@k and latency of ANN pre-selection vs exhaustive scoring
+
+        The queries are the questions of the test set. Results are printed
+            and written to the performance folder.
+        """
+        if self.index is None and self.load_index() is None:
+            self.build_index()
+        testset = self.dl.testset
+        testset = random.sample(testset, min(n_queries, len(testset)))
+        queries = [(rid, self.encode_question(qid))
+                   for rid, qid, _, _ in testset]
+
+        results = benchmark(
+            queries=queries,
+            exhaustive_fn=lambda q: (self.all_aid,
+                                     self.score_answerers(q[0], q[1], self.all_aid)),
+            candidate_fn=lambda q, size: self.index.search(
+                self.index_query(q[0], q[1]), size)[0],
+            rerank_fn=lambda q, ids: self.score_answerers(q[0], q[1], ids),
+            k=k, candidate_sizes=candidate_sizes)
+
+        if not os.path.exists(self.utils.PERF_DIR):
+            os.mkdir(self.utils.PERF_DIR)
+        bench_file = self.utils.PERF_DIR + "ann_{}_{}.txt".format(self.dataset, self.id)
+        with open(bench_file, "w") as fout:
+            print("candidates,recall@{},ms_per_query".format(k), file=fout)
+            for size, recall, ms in results:
+                size = "all" if size is None else size
+                print("\tcandidates={}, recall@{}={:.4f}, {:.3f} ms/query"
+                      .format(size, k, recall, ms))
+                print("{},{:.6f},{:.6f}".format(size, recall, ms), file=fout)
+        return results
+
+    def quantize(self):
+        """A CPU copy of RecSys with int8 dynamic quantization
+
+        The LSTM encoder and the linear layers are quantized. Dynamic
+            quantization does not cover Conv2d, so the CNN stays fp32.
+        """
+        model = copy.deepcopy(self.recsys).cpu()
+        model.eval()
+        return torch.quantization.quantize_dynamic(
+            model, {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+
+    def compare_quantized(self):
+        """Compare the fp32 and int8 RecSys on CPU
+
+        Reports the speedup of scoring the test set and the change of
+            MRR, hit@K and precision@1. Results are printed and written
+            to the performance folder.
+        """
+        dl = self.dl
+        fp32 = copy.deepcopy(self.recsys).cpu()
+        fp32.eval()
+        int8 = self.quantize()
+
+        test_data = []
+        for rid, qid, _, aid_list in dl.get_test_batch(test_prop=None):
+            test_data.append([Variable(torch.LongTensor(dl.uid2index(aid_list))),
+                              Variable(torch.LongTensor(dl.uid2index([rid] * len(aid_list)))),
+                              Variable(torch.FloatTensor(dl.q2emb(qid))),
+                              dl.q2len(qid)])
+
+        results = {}
+        for name, model in [("fp32", fp32), ("int8", int8)]:
+            start = time.time()
+            with torch.no_grad():
+                for data in test_data:
+                    model.test(test_data=data)
+            elapsed = time.time() - start
+            MRR, hit_K, prec_1, _ = self.test(model=model)
+            results[name] = (elapsed, MRR, hit_K, prec_1)
+
+        if not os.path.exists(self.utils.PERF_DIR):
+            os.mkdir(self.utils.PERF_DIR)
+        quant_file = self.utils.PERF_DIR + "quant_{}_{}.txt".format(self.dataset, self.id)
+        with open(quant_file, "w") as fout:
+            print("model,seconds,MRR,hit_K,pa1", file=fout)
+            for name in ["fp32", "int8"]:
+                elapsed, MRR, hit_K, prec_1 = results[name]
+                print("\t{}: {:.3f}s, MRR={:.4f}, hitK={:.4f}, pa1={:.4f}"
+                      .format(name, elapsed, MRR, hit_K, prec_1))
+                print("{},{:.6f},{:.6f},{:.6f},{:.6f}"
+                      .format(name, elapsed, MRR, hit_K, prec_1), file=fout)
+        (t32, m32, h32, p32), (t8, m8, h8, p8) = results["fp32"], results["int8"]
+        print("\tspeedup={:.2f}x, dMRR={:+.4f}, dhitK={:+.4f}, dpa1={:+.4f}"
+              .format(t32 / max(t8, 1e-9), m8 - m32, h8 - h32, p8 - p32))
+        return results
+
     def run(self):
         dl, utils = self.dl, self.utils
         recsys, skipgram = self.recsys, self.skipgram
@@ -231,9 +434,16 @@ class PDER:
 
         print("Optimization Finished!")
 
-    def test(self, test_prop=None):
-        model, dl = self.recsys, self.dl
+    def test(self, test_prop=None, model=None):
+        """Evaluate MRR, hit@K and precision@1 on the test set
+
+        Args:
+            test_prop  -  the proportion of test set to use, None for all
+            model  -  the RecSys to evaluate, default `self.recsys`
+        """
+        model, dl = model or self.recsys, self.dl
         model.eval()
+        use_cuda = model.embedding_manager.ru_embeddings.weight.is_cuda
         MRR, hit_K, prec_1 = 0, 0, 0
 
         test_batch = dl.get_test_batch(test_prop=test_prop)
@@ -249,13 +459,14 @@ class PDER:
             rank_q_len = dl.q2len(qid)
             rank_q = Variable(torch.FloatTensor(dl.q2emb(qid)))
 
-            if torch.cuda.is_available():
+            if use_cuda:
                 rank_a = rank_a.cuda()
                 rank_r = rank_r.cuda()
                 rank_q = rank_q.cuda()
 
             model.eval()
-            score = model.test(test_data=[rank_a, rank_r, rank_q, rank_q_len])
+            with torch.no_grad():
+                score = model.test(test_data=[rank_a, rank_r, rank_q, rank_q_len])
             all_scores += score
             RR, hit, prec = self.utils.performance_metrics(aid_list
                                                            , score
@@ -0,0 +1,455 @@
+"""
+    Pipeline
+
+    author: Zeyu Li <zyli@cs.ucla.edu> or <zeyuli@g.ucla.edu>
+
+    The end-to-end pipeline as a DAG of cached stages:
+
+        split -> qa -> text ------------------------> prepare -> train
+                    -> test -> relations -> walks -> pairs ------^
+
+    Every stage is keyed by a hash of its parameters and the content of
+    its input files. The key is stamped in .pipeline/<dataset>/ after
+    the stage succeeds, and a stage is only re-run when its key changed
+    or one of its outputs is missing. Stages whose inputs are ready run
+    in parallel in a process pool.
+
+    Run:
+        python src/pipeline.py [PDER options] --jobs 3
+        python src/pipeline.py [PDER options] --dry-run
+        python src/pipeline.py [PDER options] --force walks
+"""
+
+import os, sys
+import time
+import shutil
+import random
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+
+import archive
+import textio
+
+try:
+    import ujson as json
+except:
+    import json
+
+STAGES = ["split", "qa", "text", "test", "relations", "walks", "pairs",
+          "prepare", "train"]
+
+
+class Stage:
+    """A stage of the pipeline
+
+    Args:
+        name  -  the stage name
+        func  -  module level function of `params`
+        deps  -  the names of the stages producing the inputs
+        inputs  -  files or folders hashed into the key
+        outputs  -  files or folders written by the stage
+        params  -  dict of the parameters, hashed into the key
+        settings  -  dict of the parameters that do not change the
+            outputs, e.g. the number of processes, passed to `func`
+            along with `params` but not hashed into the key
+    """
+
+    def __init__(self, name, func, deps, inputs, outputs, params,
+                 settings=None):
+        self.name = name
+        self.func = func
+        self.deps = deps
+        self.inputs = inputs
+        self.outputs = outputs
+        self.params = params
+        self.settings = settings or {}
+
+
+class Fingerprints:
+    """Content hashes of files, cached by (size, mtime)
+
+    Args:
+        cache_file  -  the json file keeping the hashes
+    """
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.cache = {}
+        if os.path.exists(cache_file):
+            with open(cache_file, "r") as fin:
+                self.cache = json.loads(fin.read())
+
+    def file_hash(self, path):
+        stat = os.stat(path)
+        entry = self.cache.get(path)
+        if entry and entry["size"] == stat.st_size \
+                and entry["mtime"] == stat.st_mtime_ns:
+            return entry["sha1"]
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as fin:
+            for block in iter(lambda: fin.read(1 << 20), b""):
+                sha1.update(block)
+        self.cache[path] = {"size": stat.st_size, "mtime": stat.st_mtime_ns,
+                            "sha1": sha1.hexdigest()}
+        return sha1.hexdigest()
+
+    def __call__(self, path):
+        """Hash of a file, or of the names and contents of a folder"""
+        if os.path.isdir(path):
+            sha1 = hashlib.sha1()
+            for name in sorted(os.listdir(path)):
+                sha1.update(name.encode())
+                sha1.update(self(os.path.join(path, name)).encode())
+            return sha1.hexdigest()
+        if not textio.exists(path):
+            return "missing"
+        return self.file_hash(textio.resolve(path))
+
+    def save(self):
+        with open(self.cache_file, "w") as fout:
+            fout.write(json.dumps(self.cache))
+
+
+def stage_key(stage, fingerprints):
+    """The hash of the parameters and input contents of `stage`"""
+    sha1 = hashlib.sha1()
+    sha1.update(stage.name.encode())
+    sha1.update(json.dumps(stage.params, sort_keys=True).encode())
+    for path in stage.inputs:
+        sha1.update(path.encode())
+        sha1.update(fingerprints(path).encode())
+    return sha1.hexdigest()
+
+
+def read_stamp(stamp_dir, name):
+    path = stamp_dir + name + ".json"
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as fin:
+        return json.loads(fin.read())
+
+
+def write_stamp(stamp_dir, stage, key, elapsed):
+    with open(stamp_dir + stage.name + ".json", "w") as fout:
+        fout.write(json.dumps({"key": key, "params": stage.params,
+                               "outputs": stage.outputs, "seconds": elapsed}))
+
+
+def remove_outputs(stage):
+    """Remove the outputs of a stale stage, so that none is reused"""
+    for path in stage.outputs:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            textio.remove(path)
+
+
+# Stage functions, run in the worker processes
+
+def run_split(params):
+    from preprocessing import Context, split_post
+    ctx = Context(params["dataset"])
+    if not os.path.exists(ctx.data_dir):
+        os.makedirs(ctx.data_dir)
+    split_post(ctx.raw_dir, ctx.data_dir, workers=params["workers"],
+               html_parser=params["html_parser"])
+
+
+def run_qa(params):
+    from preprocessing import Context, process_QA, question_stats
+    ctx = Context(params["dataset"])
+    ctx.open_log()
+    try:
+        process_QA(ctx, ctx.data_dir)
+        question_stats(ctx, ctx.data_dir)
+    finally:
+        ctx.close_log()
+
+
+def run_text(params):
+    from preprocessing import Context, load_records, extract_question_content
+    ctx = Context(params["dataset"])
+    if not os.path.exists(ctx.parsed_dir):
+        os.makedirs(ctx.parsed_dir)
+    load_records(ctx, ctx.data_dir)
+    extract_question_content(ctx, ctx.data_dir, ctx.parsed_dir,
+                             workers=params["workers"])
+
+
+def run_test(params):
+    from preprocessing import Context, load_records, build_test_set
+    ctx = Context(params["dataset"])
+    if not os.path.exists(ctx.parsed_dir):
+        os.makedirs(ctx.parsed_dir)
+    load_records(ctx, ctx.data_dir)
+    random.seed(params["seed"])
+    np.random.seed(params["seed"])
+    build_test_set(ctx, ctx.data_dir, ctx.parsed_dir,
+                   threshold=params["threshold"],
+                   test_sample_size=params["sample_size"],
+                   test_proportion=params["prop_test"])
+
+
+def run_relations(params):
+    from preprocessing import Context, extract_relations
+    ctx = Context(params["dataset"])
+    extract_relations(ctx.data_dir, ctx.parsed_dir, binary=True)
+
+
+def run_walks(params):
+    from generate_walk import MetaPathGenerator
+    generator = MetaPathGenerator(dataset=params["dataset"],
+                                  length=params["length"],
+                                  coverage=params["coverage"])
+    generator.generate_metapaths(patterns=params["patterns"],
+                                 alpha=params["alpha"], seed=params["seed"],
+                                 workers=params["workers"])
+    generator.write_metapaths()
+
+
+def run_pairs(params):
+    from generate_walk import MetaPathGenerator
+    generator = MetaPathGenerator(dataset=params["dataset"],
+                                  length=params["length"],
+                                  coverage=params["coverage"],
+                                  build_graph=False)
+    generator.stream_pairs(window_size=params["window_size"],
+                           weighted=params["weighted"], seed=params["seed"])
+
+
+def run_prepare(params):
+    """Prune word2vec to the words of the questions
+
+    The DataLoader then memory-maps the small pruned vectors instead of
+        loading the whole GoogleNews model.
+    """
+    import gensim
+    from data_loader import prune_word2vec
+    parsed_dir = os.getcwd() + "/data/parsed/{}/".format(params["dataset"])
+
+    def sentences():
+        for name in ("Q_title_nsw.txt", "Q_content_nsw.txt"):
+            with textio.open_text(parsed_dir + name, "r") as fin:
+                for line in fin:
+                    yield line.split(" ", 1)[-1]
+
+    model = gensim.models.KeyedVectors.load_word2vec_format(
+        fname=params["word2vec"], binary=True)
+    words, vectors = prune_word2vec(model, sentences())
+    del model
+    pruned = gensim.models.KeyedVectors(vector_size=vectors.shape[1])
+    pruned.add(words, vectors)
+    pruned.save(parsed_dir + "w2v_pruned.kv")
+    print("\tPruned word2vec to {} words".format(len(words)))
+
+
+def run_train(params):
+    from optparse import Values
+    from main import build_pder
+    pder_model = build_pder(Values(params["options"]))
+    pder_model.run()
+    pder_model.test()
+
+
+def build_stages(options, workers=1, seed=0):
+    """The stages of the pipeline of `options`, in topological order
+
+    Args:
+        options  -  the parsed options of `main.get_parser`
+        workers  -  the number of processes cleaning text
+        seed  -  the random seed of the test split, the walks and the
+            pair shuffle
+    """
+    from utils import Utils
+
+    root = os.getcwd()
+    dataset = options.dataset
+    raw_dir = root + "/raw/{}/".format(dataset)
+    data_dir = root + "/data/{}/".format(dataset)
+    parsed_dir = root + "/data/parsed/{}/".format(dataset)
+    walk_name = "{}_{}_{}.txt".format(dataset, options.coverage, options.length)
+    metapath_file = root + "/metapath/" + walk_name
+    corpus_file = root + "/corpus/" + walk_name
+    word2vec = root + "/word2vec_model/GoogleNews-vectors-negative300.bin"
+    performance_file = Utils(dataset=dataset, ID=options.id,
+                             mp_length=options.length,
+                             mp_coverage=options.coverage).performance_file
+
+    posts = [data_dir + name for name in ("Posts_Q.json", "Posts_A.json",
+                                          "Posts_Q.cols", "Posts_A.cols")]
+    record_all = [data_dir + "Record_All.json", data_dir + "Record_All.cols"]
+    record_train = [data_dir + "Record_Train.json", data_dir + "Record_Train.cols"]
+    text = [parsed_dir + name for name in ("Q_title.txt", "Q_title_nsw.txt",
+                                           "Q_content.txt", "Q_content_nsw.txt")]
+    relations = [parsed_dir + name + suffix
+                 for name in ("Q_R", "Q_A", "Q_ACC", "Q_ACC_A", "QA_ID")
+                 for suffix in (".txt", ".npy")]
+    pruned = [parsed_dir + "w2v_pruned.kv"]
+
+    base = {"dataset": dataset}
+    walk_params = dict(base, length=options.length, coverage=options.coverage)
+    train_options = {key: value for key, value in vars(options).items()
+                     if key not in ("jobs", "force", "dry_run", "seed",
+                                   "compression", "walk_workers",
+                                   "preprocess_workers")}
+
+    stages = [
+        Stage("split", run_split, [],
+              [archive.locate(raw_dir) or raw_dir + "Posts.xml"], posts,
+              dict(base, html_parser=options.html_parser),
+              settings={"workers": workers}),
+        Stage("qa", run_qa, ["split"], posts[2:],
+              record_all + [data_dir + "question.stats.raw",
+                            data_dir + "question.stats"], base),
+        Stage("text", run_text, ["qa"], [posts[2], record_all[0]], text,
+              base, settings={"workers": workers}),
+        Stage("test", run_test, ["qa"], [record_all[0]],
+              record_train + [parsed_dir + "test.txt"],
+              dict(base, threshold=options.test_threshold,
+                   prop_test=options.proportion_test,
+                   sample_size=options.test_size, seed=seed)),
+        Stage("relations", run_relations, ["qa", "test"],
+              [record_all[1], record_train[1]], relations, base),
+        Stage("walks", run_walks, ["relations"],
+              [parsed_dir + "Q_R.txt", parsed_dir + "Q_A.txt"],
+              [metapath_file, metapath_file[:-len(".txt")] + "/"],
+              dict(walk_params, patterns=(options.meta_paths or "AQRQA").split(" "),
+                   alpha=options.alpha, seed=seed),
+              settings={"workers": options.walk_workers}),
+        Stage("pairs", run_pairs, ["walks"],
+              [metapath_file[:-len(".txt")] + "/"], [corpus_file],
+              dict(walk_params, window_size=options.window_size, weighted=True,
+                   seed=seed)),
+        Stage("prepare", run_prepare, ["text"], text[1::2] + [word2vec], pruned,
+              dict(base, word2vec=word2vec)),
+        Stage("train", run_train, ["pairs", "prepare", "relations", "test"],
+              [corpus_file, metapath_file, parsed_dir + "test.txt"]
+              + text[1::2] + relations + pruned,
+              [performance_file], dict(base, options=train_options)),
+    ]
+    if options.walk_pairs:
+        # The pairs are generated from the walks while training
+        stages = [stage for stage in stages if stage.name != "pairs"]
+        train = stages[-1]
+        train.deps = ["walks", "prepare", "relations", "test"]
+        train.inputs = [metapath_file[:-len(".txt")] + "/"] + train.inputs[2:]
+    return OrderedDict((stage.name, stage) for stage in stages)
+
+
+def run_pipeline(stages, stamp_dir, jobs=2, force=(), dry_run=False):
+    """Run the stale stages of a DAG, independent ones in parallel
+
+    Args:
+        stages  -  OrderedDict of `Stage`, see `build_stages`
+        stamp_dir  -  the folder of the stamps and the hash cache
+        jobs  -  the number of stages running at the same time
+        force  -  names of the stages to re-run anyway
+        dry_run  -  only print which stages are stale
+    Return:
+        OrderedDict from stage name to (status, seconds)
+    """
+    if not os.path.exists(stamp_dir):
+        os.makedirs(stamp_dir)
+    fingerprints = Fingerprints(stamp_dir + "fingerprints.json")
+    status = OrderedDict()
+    pending, running = list(stages), {}
+    start = time.time()
+
+    with ProcessPoolExecutor(jobs) as executor:
+        while pending or running:
+            progress = False
+            for name in list(pending):
+                stage = stages[name]
+                dep_status = [status.get(dep, (None,))[0] for dep in stage.deps]
+                if any(x in ("failed", "skipped") for x in dep_status):
+                    pending.remove(name)
+                    status[name] = ("skipped", 0.0)
+                    progress = True
+                    continue
+                if dry_run and "stale" in dep_status:
+                    pending.remove(name)
+                    status[name] = ("stale", 0.0)
+                    progress = True
+                    continue
+                if any(x not in ("cached", "done") for x in dep_status):
+                    continue
+
+                pending.remove(name)
+                progress = True
+                key = stage_key(stage, fingerprints)
+                stamp = read_stamp(stamp_dir, name)
+                fresh = stamp is not None and stamp["key"] == key \
+                    and all(textio.exists(x) for x in stage.outputs)
+                if fresh and name not in force:
+                    print("[cached] {}".format(name))
+                    status[name] = ("cached", 0.0)
+                elif dry_run:
+                    print("[stale] {}".format(name))
+                    status[name] = ("stale", 0.0)
+                else:
+                    print("[run] {}".format(name))
+                    remove_outputs(stage)
+                    future = executor.submit(stage.func,
+                                             dict(stage.params, **stage.settings))
+                    running[future] = (stage, key, time.time())
+
+            if not running:
+                # Cached stages may have made others ready
+                if progress:
+                    continue
+                break
+
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage, key, stage_start = running.pop(future)
+                elapsed = time.time() - stage_start
+                try:
+                    future.result()
+                except Exception as e:
+                    print("[failed] {}: {}".format(stage.name, e), file=sys.stderr)
+                    status[stage.name] = ("failed", elapsed)
+                    continue
+                # Outputs are hashed again when they are inputs downstream
+                write_stamp(stamp_dir, stage, key, elapsed)
+                status[stage.name] = ("done", elapsed)
+                print("[done] {} in {:.1f}s".format(stage.name, elapsed))
+            fingerprints.save()
+
+    fingerprints.save()
+    print("Pipeline finished in {:.1f}s".format(time.time() - start))
+    for name in stages:
+        state, elapsed = status.get(name, ("skipped", 0.0))
+        print("\t{:<10} {:<8} {:.1f}s".format(name, state, elapsed))
+    return status
+
+
+if __name__ == "__main__":
+    from main import get_parser
+
+    parser = get_parser()
+    parser.add_option("--jobs", type="int", dest="jobs", default=2,
+                      help="The number of stages running at the same time.")
+    parser.add_option("--force", type="string", dest="force", default="",
+                      help="Comma separated stages to re-run anyway, \"all\" for all.")
+    parser.add_option("--dry-run", default=False, dest="dry_run",
+                      action="store_true", help="Only print the stale stages.")
+    parser.add_option("--seed", type="int", dest="seed", default=0,
+                      help="The random seed of the test split, walks and pair shuffle.")
+    parser.add_option("--compression", type="choice", dest="compression",
+                      choices=["", "gz", "zst"], default=textio.compression,
+                      help="Compress the text files written, \"gz\" or \"zst\".")
+    (options, args) = parser.parse_args()
+
+    textio.set_compression(options.compression)
+
+    force = STAGES if options.force == "all" else \
+        [x for x in options.force.split(",") if x]
+    stages = build_stages(options, workers=options.preprocess_workers,
+                          seed=options.seed)
+    status = run_pipeline(stages,
+                          stamp_dir=os.getcwd() + "/.pipeline/{}/".format(options.dataset),
+                          jobs=options.jobs, force=force, dry_run=options.dry_run)
+    sys.exit(1 if any(x == "failed" for x, _ in status.values()) else 0)
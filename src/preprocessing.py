@@ -12,9 +12,12 @@
 
 import sys, os
 import re
+import time
 import logging
+import resource
 import numpy as np
 from lxml import etree
+import lxml.html
 from bs4 import BeautifulSoup
 
 import nltk
@@ -23,27 +26,222 @@ from nltk.corpus import stopwords
 from nltk.tokenize import word_tokenize
 
 import string, random
-from collections import Counter 
+import shutil
+import filecmp
+import itertools
+import functools
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from multiprocessing import Pool
+
+import archive
+import colstore
+import textio
+from textnorm import normalize_text
+from colstore import ColumnWriter, read_columns, to_int, MISSING
 
 try:
     import ujson as json
 except:
     import json
 
-part_user = set()
-    # Users participated in Asking and Answering
 
-# count how many questions an users asked
-# count how many questions an answerer responded
-count_Q, count_A = {}, {}
+# Columnar tables written next to the JSON files, see `colstore`
+POSTS_Q_COLS = "Posts_Q.cols"
+POSTS_A_COLS = "Posts_A.cols"
+POSTS_Q_SCHEMA = [("Id", "int"), ("OwnerUserId", "int"),
+                  ("AcceptedAnswerId", "int"), ("AnswerCount", "int"),
+                  ("Score", "int"), ("CreationDate", "text"),
+                  ("Title", "text"), ("Body", "text")]
+POSTS_A_SCHEMA = [("Id", "int"), ("ParentId", "int"), ("OwnerUserId", "int"),
+                  ("Score", "int"), ("CreationDate", "text"), ("Body", "text")]
+RECORD_SCHEMA = [("QuestionId", "int"), ("QuestionOwnerId", "int"),
+                 ("AcceptedAnswerId", "int"), ("AcceptedAnswererId", "int"),
+                 ("AnswererIdList", "ints"), ("AnswerIdList", "ints")]
+
+
+
+class Context:
+    """The state of preprocessing one dataset
+
+    Holds what used to be module globals, so that several datasets can
+        be preprocessed in one process or in parallel processes.
+
+    Args:
+        dataset - the name of the dataset
+        root - the dir holding raw/ and data/, default the working dir
+    """
+
+    def __init__(self, dataset, root=None):
+        root = root or os.getcwd()
+        self.dataset = dataset
+        self.raw_dir = root + "/raw/{}/".format(dataset)
+        self.data_dir = root + "/data/{}/".format(dataset)
+        self.parsed_dir = root + "/data/parsed/{}/".format(dataset)
+
+        # Users participated in Asking and Answering
+        self.part_user = set()
+
+        # count how many questions an users asked
+        # count how many questions an answerer responded
+        self.count_Q, self.count_A = {}, {}
+
+        self.qa_map = {}
+        self.test_candidates = set()
+
+        self.logger = logging.getLogger("{}.{}".format(__name__, dataset))
+        self.log_fh = None
+        self.timings = []  # (stage, seconds)
+
+    def open_log(self):
+        """Log to <data_dir>/log.log, replacing the previous log"""
+        if os.path.exists(self.data_dir + "log.log"):
+            os.remove(self.data_dir + "log.log")
+        self.logger.setLevel(logging.DEBUG)
+        self.log_fh = logging.FileHandler(self.data_dir + "log.log")
+        self.log_fh.setLevel(logging.DEBUG)
+        formatter = logging.Formatter(
+            '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        self.log_fh.setFormatter(formatter)
+        self.logger.addHandler(self.log_fh)
+
+    def close_log(self):
+        if self.log_fh is not None:
+            self.logger.removeHandler(self.log_fh)
+            self.log_fh.close()
+            self.log_fh = None
+
+    def run_stage(self, stage, func, *args, **kwargs):
+        """Run a stage and record its wall time"""
+        print("\t[{}] {}".format(self.dataset, stage))
+        start = time.time()
+        result = func(*args, **kwargs)
+        self.timings.append((stage, time.time() - start))
+        return result
+
+
+# The newest post ingested, and the log of records changed since
+# the last full run, see `ingest_incremental`
+WATERMARK = "watermark.json"
+RECORD_DELTA = "Record_Delta.json"
+
+# Stopword set of this process, see `get_stopword_set`
+sw_set = None
 
-qa_map = {}
-test_candidates = set()
 
 def clean_html(x):
     return BeautifulSoup(x, 'lxml').get_text()
 
 
+# Whitespace as BeautifulSoup sees it, and the tags keeping whitespace
+ASCII_SPACES = str.maketrans("", "", "\x20\x0a\x09\x0c\x0d")
+PRESERVE_WHITESPACE_TAGS = {"pre", "textarea"}
+# Tags whose text `get_text()` leaves out, their tails are kept
+DROPPED_TEXT_TAGS = {"script", "style", "template"}
+
+
+def clean_html_lxml(x):
+    """Fast `clean_html` by lxml.html, without building a soup
+
+    Keeps the `get_text()` semantics: all text and tails are joined,
+    comments and the text of <script>, <style> and <template> are
+    dropped, entities are decoded, and whitespace-only
+    strings outside <pre>/<textarea> collapse to "\n" or " " as
+    BeautifulSoup does.
+    """
+    if not x.strip():
+        return ""
+    try:
+        root = lxml.html.document_fromstring(x)
+    except etree.ParserError:
+        return ""
+    parts = []
+    collect_text(root, parts, False)
+    return "".join(parts)
+
+
+def collect_text(elem, parts, preserve):
+    """Append the text under `elem` to `parts`, see `clean_html_lxml`"""
+    preserve = preserve or elem.tag in PRESERVE_WHITESPACE_TAGS
+    if elem.text:
+        parts.append(collapse_blank(elem.text, preserve))
+    for child in elem:
+        # Comments and processing instructions have non-string tags
+        if isinstance(child.tag, str) and child.tag not in DROPPED_TEXT_TAGS:
+            collect_text(child, parts, preserve)
+        if child.tail:
+            parts.append(collapse_blank(child.tail, preserve))
+
+
+def collapse_blank(text, preserve):
+    if preserve or text.translate(ASCII_SPACES):
+        return text
+    return "\n" if "\n" in text else " "
+
+
+HTML_CLEANERS = {"bs4": clean_html, "lxml": clean_html_lxml}
+
+
+def compare_html_cleaners(raw_dir, data_dir, sample_size=10000, max_diffs=50):
+    """Side-by-side benchmark and diff report of the HTML cleaners
+
+    Cleans the bodies of the first `sample_size` posts of Posts.xml by
+    BeautifulSoup and by lxml, prints the throughput of both, and
+    writes the first `max_diffs` differing posts and the totals to
+    `[data_dir]html_cleaner_diff.txt`, i.e. data/[dataset]/ from the
+    `bench-html` mode. Differences that vanish after `normalize_text`
+    do not affect the outputs.
+
+    Args:
+        raw_dir - raw data directory
+        data_dir - the directory of the report, created if missing
+        sample_size - the number of posts to compare
+        max_diffs - the number of diffs written to the report
+
+    Return:
+        (raw differences, differences after normalization)
+    """
+    bodies = []
+    with open_posts(raw_dir) as posts:
+        for attr in iter_post_rows(posts):
+            bodies.append(attr.get('Body', ""))
+            if len(bodies) >= sample_size:
+                break
+
+    outputs, times = {}, {}
+    for name, cleaner in sorted(HTML_CLEANERS.items()):
+        start = time.time()
+        outputs[name] = [cleaner(body) for body in bodies]
+        times[name] = time.time() - start
+
+    sw_set = get_stopword_set()
+    raw_diff, norm_diff = 0, 0
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+    report_file = data_dir + "html_cleaner_diff.txt"
+    with open(report_file, "w") as fout:
+        for body, old, new in zip(bodies, outputs["bs4"], outputs["lxml"]):
+            if old == new:
+                continue
+            raw_diff += 1
+            normalized = normalize_text(old, sw_set) != normalize_text(new, sw_set)
+            norm_diff += normalized
+            if raw_diff <= max_diffs:
+                print("=== {}\n--- html\n{}\n--- bs4\n{!r}\n--- lxml\n{!r}\n"
+                      .format("NORMALIZED DIFF" if normalized else "RAW DIFF",
+                              body, old, new), file=fout)
+        print("Total {}, raw diffs {}, normalized diffs {}"
+              .format(len(bodies), raw_diff, norm_diff), file=fout)
+
+    print("\t\t{} posts, bs4 {:.1f}/s, lxml {:.1f}/s, speedup {:.1f}x, "
+          "{} raw diffs, {} normalized diffs"
+          .format(len(bodies), len(bodies) / max(times["bs4"], 1e-9),
+                  len(bodies) / max(times["lxml"], 1e-9),
+                  times["bs4"] / max(times["lxml"], 1e-9), raw_diff, norm_diff))
+    print("\t\tDiff report written to {}".format(report_file))
+    return raw_diff, norm_diff
+
+
 def clean_str(string):
     """Clean up the string
 
@@ -116,145 +314,534 @@ def remove_stopwords(string, stopword_set):
     return " ".join(filtered_string)
 
 
-def split_post(raw_dir, data_dir):
+# Post bodies of Posts.xml that `bench-normalizer` checks `normalize_text`
+#   on before the dataset sample: contractions, the words split by
+#   `word_tokenize`, code, entities, non-ASCII and punctuation runs
+NORMALIZER_FIXTURE = [
+    "<p>I can't get <code>git rebase -i</code> to work. Isn't there a way "
+    "to squash the last 3 commits?</p>",
+    "<p>You <em>cannot</em> do that; you're gonna need a <strong>lock</strong>"
+    " (or a semaphore), I'd say.</p>\n<pre><code>while (!done) { wait(); }\n"
+    "</code></pre>",
+    "<p>Gimme a sec... lemme check: the O(n log n) bound doesn't hold if "
+    "n &lt; 10 &amp; k &gt; 2!</p>",
+    "<blockquote><p>We'll see, they've said.</p></blockquote><p>Wanna "
+    "know why? Gotta read the 2nd edition's preface.</p>",
+    "<p>Caf\u00e9 na\u00efve r\u00e9sum\u00e9 \u2014 \u201cquoted\u201d "
+    "and \u2018single\u2019 quotes, \u00bd and \u00b2.</p>",
+    "<ul><li>`backticks`</li><li>'single'</li><li>\"double\"</li>"
+    "<li>a,b,,c!!??</li></ul>",
+    "<p>URL: <a href=\"http://example.com/a_b?c=d\">http://example.com/"
+    "a_b?c=d</a> e-mail a.b@c.org, path C:\\tmp\\x_y.txt</p>",
+    "<p>It's the dog's bone; it isn't theirs 'n' won't be.</p>",
+    "<p>   Leading\tand trailing\n\nwhitespace   </p>",
+    "<p>'' `` ''s n't 've 're 'd 'll</p>",
+    "<p>CANNOT Cannot cannot. GONNA gonna! wanna-be can't-stop</p>",
+    "",
+]
+
+
+def check_normalizer(texts, sw_set, show=10):
+    """Check `normalize_text` against `clean_str2` + `remove_stopwords`
+
+    Args:
+        texts - the strings to check
+        sw_set - the set of stopwords
+        show - the number of mismatches printed
+
+    Return:
+        (the number of mismatched strings, time of the former, time of
+            `normalize_text`)
+    """
+    start = time.time()
+    old = [(clean, remove_stopwords(clean, sw_set))
+           for clean in (clean_str2(text) for text in texts)]
+    old_time = time.time() - start
+
+    start = time.time()
+    new = [normalize_text(text, sw_set) for text in texts]
+    new_time = time.time() - start
+
+    mismatch = 0
+    for text, old_out, new_out in zip(texts, old, new):
+        if old_out != new_out:
+            mismatch += 1
+            if mismatch <= show:
+                print("\t\tMismatch: {!r}\n\t\t\t{!r}\n\t\t\t{!r}"
+                      .format(text[:200], old_out, new_out))
+    return mismatch, old_time, new_time
+
+
+def benchmark_normalizer(data_dir, sample_size=10000):
+    """Benchmark and check `normalize_text` on the dataset
+
+    Checks `normalize_text` on NORMALIZER_FIXTURE, cleaned by both HTML
+    cleaners, and then on titles and bodies of the first `sample_size`
+    questions of Posts_Q.cols if the table exists. Prints the
+    throughput of both normalizations on the sample and the mismatches.
+
+    Args:
+        data_dir - the dir of Posts_Q.cols
+        sample_size - the number of questions to check
+
+    Return:
+        the number of mismatched strings
+    """
+    sw_set = get_stopword_set()
+    fixture = [cleaner(body) for body in NORMALIZER_FIXTURE
+               for _, cleaner in sorted(HTML_CLEANERS.items())]
+    mismatch, _, _ = check_normalizer(fixture, sw_set)
+    print("\t\tFixture: {} strings, {} mismatches"
+          .format(len(fixture), mismatch))
+
+    if not colstore.exists(data_dir + POSTS_Q_COLS):
+        print("\t\tNo {} in {}, fixture only".format(POSTS_Q_COLS, data_dir))
+        return mismatch
+
+    cols = read_columns(data_dir + POSTS_Q_COLS, ["Title", "Body"])
+    texts = []
+    for i in range(min(sample_size, len(cols["Title"]))):
+        texts += [cols["Title"][i], cols["Body"][i]]
+    sample_mismatch, old_time, new_time = check_normalizer(texts, sw_set)
+    print("\t\t{} strings, clean_str2+remove_stopwords {:.1f}/s, "
+          "normalize_text {:.1f}/s, speedup {:.1f}x, {} mismatches"
+          .format(len(texts), len(texts) / max(old_time, 1e-9),
+                  len(texts) / max(new_time, 1e-9),
+                  old_time / max(new_time, 1e-9), sample_mismatch))
+    return mismatch + sample_mismatch
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KB on Linux
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / (1 << 10)
+
+
+def report_progress(stage, rows, start):
+    """Print rows, rows per second and peak RSS of a stage"""
+    elapsed = time.time() - start
+    print("\t\t{}: {} rows, {:.1f} rows/s, peak RSS {:.1f} MB"
+          .format(stage, rows, rows / max(elapsed, 1e-9), peak_rss_mb()))
+
+
+def get_stopword_set():
+    """The English stopword set, created once per process"""
+    global sw_set
+    if sw_set is None:
+        sw_set = frozenset(stopwords.words('english'))
+    return sw_set
+
+
+def parallel_map(func, iterable, workers=1, chunk_rows=20000):
+    """Ordered map of `func` over a stream, by a process pool
+
+    The stream is consumed `chunk_rows` items at a time and the next
+    chunk is submitted before the current one is yielded, so memory is
+    bounded by two chunks and the output order equals the input order.
+
+    Args:
+        func  -  a picklable (module level) function
+        iterable  -  the input stream
+        workers  -  the number of processes, 1 for a plain serial map
+        chunk_rows  -  the number of items in a chunk
+    """
+    if workers <= 1:
+        for item in iterable:
+            yield func(item)
+        return
+
+    iterator = iter(iterable)
+    chunksize = max(1, chunk_rows // (4 * workers))
+    with Pool(workers) as pool:
+        chunk = list(itertools.islice(iterator, chunk_rows))
+        pending = pool.map_async(func, chunk, chunksize) if chunk else None
+        while pending is not None:
+            chunk = list(itertools.islice(iterator, chunk_rows))
+            following = pool.map_async(func, chunk, chunksize) if chunk else None
+            for result in pending.get():
+                yield result
+            pending = following
+
+
+def typed_row(attr, schema):
+    """The values of `schema` columns in a post row, ids as int"""
+    return {name: to_int(attr.get(name)) if kind == "int" else attr.get(name)
+            for name, kind in schema}
+
+
+def clean_post(attr, html_parser="bs4"):
+    """Clean the body of a post row
+
+    Return:
+        (PostTypeId, typed columnar row, json line)
+    """
+    attr['Body'] = HTML_CLEANERS[html_parser](attr['Body'])
+    post_type = attr['PostTypeId']
+    schema = POSTS_Q_SCHEMA if post_type == '1' else POSTS_A_SCHEMA
+    return post_type, typed_row(attr, schema), json.dumps(attr) + "\n"
+
+
+def clean_question(data):
+    """Clean title and content of a question
+
+    Return:
+        (qid, content, content_nsw, title, title_nsw), None at errors
+    """
+    try:
+        sw_set = get_stopword_set()
+        content, content_nsw = normalize_text(data.get('Body'), sw_set)
+        title, title_nsw = normalize_text(data.get('Title'), sw_set)
+        return (data.get('Id'), content, content_nsw, title, title_nsw)
+    except:
+        return None
+
+
+def split_post(raw_dir, data_dir, buffer_size=1 << 20, report_every=100000,
+               workers=1, html_parser="bs4", reader="auto"):
     """ Split the post
 
     Split post to question and answer,
     keep all information, output to file
 
+    Posts.xml is streamed with bounded memory: every processed row
+    and its preceding siblings are freed, so lxml never holds the
+    whole tree. Outputs are written through large buffers.
+
+    Besides the JSON files, the posts are written to the columnar
+    tables Posts_Q.cols and Posts_A.cols (see `colstore`), with typed
+    id columns and text columns, which the later stages read instead
+    of decoding JSON.
+
+    If Posts.xml is not extracted, it is streamed out of the .7z dump
+    in raw_dir (see `open_posts`), nothing is written to disk.
+
     Args:
         raw_dir - raw data directory
         data_dir - parsed data directory
+        buffer_size - the write buffer size of each output file
+        report_every - report progress every this many rows
+        workers - the number of processes cleaning HTML
+        html_parser - "bs4" (BeautifulSoup) or "lxml", see `clean_html_lxml`
+        reader - the .7z reader, see `archive.open_member`
     """
-    if os.path.exists(data_dir + "Posts_Q.json") \
-        and os.path.exists(data_dir + "Posts_A.json"):
+    if textio.exists(data_dir + "Posts_Q.json") \
+        and textio.exists(data_dir + "Posts_A.json") \
+        and colstore.exists(data_dir + POSTS_Q_COLS) \
+        and colstore.exists(data_dir + POSTS_A_COLS):
         print("\t\tPosts_Q.json, Posts_A.json already exists."
               "Skipping the split_post.")
         return
 
-    with open(data_dir + "Posts_Q.json", "w") as fout_q, \
-            open(data_dir + "Posts_A.json", "w") as fout_a:
-        parser = etree.iterparse(raw_dir + 'Posts.xml',
-                                 events=('end',), tag='row')
-        for event, elem in parser:
-            attr = dict(elem.attrib)
-            attr['Body'] = clean_html(attr['Body'])
-
+    rows, start = 0, time.time()
+    with open_posts(raw_dir, reader) as posts, \
+            textio.open_text(data_dir + "Posts_Q.json", "w",
+                             buffering=buffer_size) as fout_q, \
+            textio.open_text(data_dir + "Posts_A.json", "w",
+                             buffering=buffer_size) as fout_a, \
+            ColumnWriter(data_dir + POSTS_Q_COLS, POSTS_Q_SCHEMA) as cols_q, \
+            ColumnWriter(data_dir + POSTS_A_COLS, POSTS_A_SCHEMA) as cols_a:
+        cleaner = functools.partial(clean_post, html_parser=html_parser)
+        watermark = {"Id": 0, "CreationDate": ""}
+        for post_type, row, line in parallel_map(
+                cleaner, iter_post_rows(posts), workers=workers):
             # Output to separate files
-            if attr['PostTypeId'] == '1':
-                fout_q.write(json.dumps(attr) + "\n")
-            elif attr['PostTypeId'] == '2':
-                fout_a.write(json.dumps(attr) + "\n")
+            if post_type == '1':
+                fout_q.write(line)
+                cols_q.append(row)
+            elif post_type == '2':
+                fout_a.write(line)
+                cols_a.append(row)
+            update_watermark(watermark, row)
+
+            rows += 1
+            if rows % report_every == 0:
+                report_progress("split_post", rows, start)
+    write_watermark(data_dir, watermark)
+    report_progress("split_post", rows, start)
     return
 
 
-def process_QA(data_dir):
+@contextmanager
+def open_posts(raw_dir, reader="auto"):
+    """Open Posts.xml of raw_dir for `iter_post_rows`
+
+    Yields the path of the extracted Posts.xml, or else a stream of it
+        decompressed from the .7z dump in raw_dir (see `archive`).
+    """
+    path = archive.locate(raw_dir, 'Posts.xml')
+    if path is None:
+        raise IOError("Neither Posts.xml nor a .7z dump found in {}"
+                      .format(raw_dir))
+    if not path.endswith(".7z"):
+        yield path
+        return
+    print("\t\tStreaming Posts.xml from {}".format(path))
+    with archive.open_member(path, 'Posts.xml', reader) as stream:
+        yield stream
+
+
+def iter_post_rows(source):
+    """Stream the attributes of the rows of Posts.xml
+
+    Every row and the rows before it are freed once yielded, so lxml
+        never holds the whole tree.
+
+    Args:
+        source - the path or a binary file object of Posts.xml
+    """
+    parser = etree.iterparse(source, events=('end',), tag='row')
+    for event, elem in parser:
+        yield dict(elem.attrib)
+        # Free the row and the rows before it
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+    del parser
+
+
+def update_watermark(watermark, row):
+    """Raise the watermark to the Id and CreationDate of a typed row"""
+    if row['Id'] != MISSING:
+        watermark["Id"] = max(watermark["Id"], row['Id'])
+    watermark["CreationDate"] = max(watermark["CreationDate"],
+                                    row['CreationDate'] or "")
+
+
+def read_watermark(data_dir):
+    """The watermark of the posts in `data_dir`, None if absent"""
+    if not os.path.exists(data_dir + WATERMARK):
+        return None
+    with open(data_dir + WATERMARK, "r") as fin:
+        return json.loads(fin.read())
+
+
+def write_watermark(data_dir, watermark):
+    with open(data_dir + WATERMARK, "w") as fout:
+        fout.write(json.dumps(watermark))
+
+
+def folder_size(folder):
+    """Total size in bytes of the files under `folder`"""
+    return sum(os.path.getsize(os.path.join(path, name))
+               for path, _, names in os.walk(folder) for name in names)
+
+
+def compare_archive_ingestion(archive_path, work_dir, reader="auto", workers=1,
+                              html_parser="bs4"):
+    """Wall time and disk use of streaming vs. extract-then-parse
+
+    Runs `split_post` on the Posts.xml of a .7z dump in two ways:
+        extract - Posts.xml is first extracted to <work_dir>/extract/raw/
+        stream - Posts.xml is streamed out of the archive
+    and checks that both give the same outputs.
+
+    Args:
+        archive_path - the .7z dump holding Posts.xml
+        work_dir - the dir where both runs write their files
+        (others as in `split_post`)
+
+    Return:
+        dict from the way to its timings in seconds and its peak disk
+            use in bytes
+    """
+    work_dir = os.path.join(work_dir, "")
+    results = {}
+    for way in ["extract", "stream"]:
+        raw_dir = work_dir + way + "/raw/"
+        data_dir = work_dir + way + "/data/"
+        for folder in [raw_dir, data_dir]:
+            if os.path.exists(folder):
+                shutil.rmtree(folder)
+            os.makedirs(folder)
+
+        start = time.time()
+        if way == "extract":
+            archive.extract_member(archive_path, raw_dir, 'Posts.xml', reader)
+        else:
+            os.symlink(os.path.abspath(archive_path),
+                       raw_dir + os.path.basename(archive_path))
+        extract_time = time.time() - start
+
+        start = time.time()
+        split_post(raw_dir, data_dir, workers=workers, html_parser=html_parser,
+                   reader=reader)
+        split_time = time.time() - start
+
+        # The extracted XML is on disk together with the outputs
+        results[way] = {"extract": extract_time, "split": split_time,
+                        "total": extract_time + split_time,
+                        "disk": folder_size(data_dir) + (
+                            folder_size(raw_dir) if way == "extract" else 0)}
+
+    same = all(filecmp.cmp(textio.resolve(work_dir + "extract/data/" + name),
+                           textio.resolve(work_dir + "stream/data/" + name),
+                           shallow=False)
+               for name in ["Posts_Q.json", "Posts_A.json"])
+    for way in ["extract", "stream"]:
+        result = results[way]
+        print("\t\t{:8s} extract {:.1f}s, split {:.1f}s, total {:.1f}s, "
+              "peak disk {:.1f} MB".format(way, result["extract"],
+                                           result["split"], result["total"],
+                                           result["disk"] / 2 ** 20))
+    print("\t\tArchive {:.1f} MB, streaming saves {:.1f}s and {:.1f} MB, "
+          "outputs {}".format(os.path.getsize(archive_path) / 2 ** 20,
+                              results["extract"]["total"]
+                              - results["stream"]["total"],
+                              (results["extract"]["disk"]
+                               - results["stream"]["disk"]) / 2 ** 20,
+                              "identical" if same else "DIFFER"))
+    return results
+
+
+def write_records(ctx, data_dir, name):
+    """Write `qa_map` of `ctx` to <name>.json and the columnar table <name>.cols
+
+    Args:
+        data_dir - the dir of the records
+        name - "Record_All" or "Record_Train"
+    """
+    with textio.open_text(data_dir + name + ".json", "w") as fout, \
+            ColumnWriter(data_dir + name + ".cols", RECORD_SCHEMA) as cols:
+        for q in ctx.qa_map.keys():
+            entry = ctx.qa_map[q]
+            fout.write(json.dumps(entry) + "\n")
+            cols.append({
+                'QuestionId': int(entry['QuestionId']),
+                'QuestionOwnerId': int(entry['QuestionOwnerId']),
+                'AcceptedAnswerId': to_int(entry['AcceptedAnswerId']),
+                'AcceptedAnswererId': to_int(entry['AcceptedAnswererId']),
+                'AnswererIdList': [int(x) for x in entry['AnswererIdList']],
+                'AnswerIdList': [int(x) for _, x in entry['AnswererAnswerTuples']]
+            })
+
+
+def load_records(ctx, data_dir, name="Record_All"):
+    """Rebuild `qa_map`, `count_Q` and `count_A` of `ctx` from <name>.json
+
+    So that the stages after `process_QA` can run in another process.
+    For Record_All, the records changed by `ingest_incremental` are
+        applied on top, the last version of a record wins.
+
+    Return:
+        the ids of the training questions added by `ingest_incremental`
+    """
+    paths = [data_dir + name + ".json"]
+    if name == "Record_All" and textio.exists(data_dir + RECORD_DELTA):
+        paths.append(data_dir + RECORD_DELTA)
+
+    delta_train = set()
+    for path in paths:
+        with textio.open_text(path, "r") as fin:
+            for line in fin:
+                entry = json.loads(line)
+                if path.endswith(RECORD_DELTA):
+                    if entry["Train"]:
+                        delta_train.add(entry["Record"]['QuestionId'])
+                    entry = entry["Record"]
+                entry['AnswererAnswerTuples'] = [
+                    tuple(x) for x in entry['AnswererAnswerTuples']]
+                ctx.qa_map[entry['QuestionId']] = entry
+
+    for entry in ctx.qa_map.values():
+        rid = entry['QuestionOwnerId']
+        ctx.count_Q[rid] = ctx.count_Q.get(rid, 0) + 1
+        for aid in entry['AnswererIdList']:
+            ctx.count_A[aid] = ctx.count_A.get(aid, 0) + 1
+    return delta_train
+
+
+def process_QA(ctx, data_dir):
     """Process QA
 
     Extract attributes used in this project
     Get rid of the text information,
     only record the question-user - answer-user relation
 
+    Only the id columns of Posts_Q.cols and Posts_A.cols are read.
+
     Args:
         data_dir - the dir where primitive data is stored
     """
-    POST_Q = "Posts_Q.json"
-    POST_A = "Posts_A.json"
-    OUTPUT = "Record_All.json"
+    OUTPUT = "Record_All"
     RAW_STATS = "question.stats.raw"
 
     # Get logger to log exceptions
-    logger = logging.getLogger(__name__)
-
-    no_acc_question = 0
+    logger = ctx.logger
 
-    raw_question_stats = []
+    if not colstore.exists(data_dir + POSTS_Q_COLS):
+        raise IOError("table {} does NOT exist".format(data_dir + POSTS_Q_COLS))
 
-    if not os.path.exists(data_dir + POST_Q):
-        raise IOError("file {} does NOT exist".format(data_dir + POST_Q))
+    if not colstore.exists(data_dir + POSTS_A_COLS):
+        raise IOError("table {} does NOT exist".format(data_dir + POSTS_A_COLS))
 
-    if not os.path.exists(data_dir + POST_A):
-        raise IOError("file {} does NOT exist".format(data_dir + POST_A))
+    # A full run supersedes the incremental changes
+    textio.remove(data_dir + RECORD_DELTA)
 
     # Process question information
-    with open(data_dir + POST_Q, 'r') as fin_q:
-        for line in fin_q:
-            data = json.loads(line)
-            try:
-                qid, rid = data.get('Id', None), data.get('OwnerUserId', None)
-                # If such 
-                if qid and rid:
-                    acc_id = data.get('AcceptedAnswerId', None)
-                    answer_count = int(data.get('AnswerCount', -1))
-                    if acc_id:
-                        qa_map[qid] = {
-                            'QuestionId': qid,
-                            'QuestionOwnerId': rid,
-                            'AcceptedAnswerId': acc_id,
-                            'AcceptedAnswererId': None,
-                            'AnswererIdList': [],
-                            'AnswererAnswerTuples': []
-                        }
-                        count_Q[rid] = count_Q.get(rid, 0) + 1
-                    else:
-                        no_acc_question += 1
-
-                    if answer_count >= 0:
-                        raw_question_stats.append(answer_count)
-            except:
-                logger.error("Error at process_QA 1: " + str(data))
-                continue
+    cols = read_columns(data_dir + POSTS_Q_COLS,
+                        ["Id", "OwnerUserId", "AcceptedAnswerId", "AnswerCount"])
+    qids, rids = cols["Id"], cols["OwnerUserId"]
+    acc_ids, answer_counts = cols["AcceptedAnswerId"], cols["AnswerCount"]
+
+    valid = (qids != MISSING) & (rids != MISSING)
+    has_acc = valid & (acc_ids != MISSING)
+    no_acc_question = int((valid & ~has_acc).sum())
+
+    for qid, rid, acc_id in zip(qids[has_acc].tolist(), rids[has_acc].tolist(),
+                                acc_ids[has_acc].tolist()):
+        qid, rid = str(qid), str(rid)
+        ctx.qa_map[qid] = {
+            'QuestionId': qid,
+            'QuestionOwnerId': rid,
+            'AcceptedAnswerId': str(acc_id),
+            'AcceptedAnswererId': None,
+            'AnswererIdList': [],
+            'AnswererAnswerTuples': []
+        }
+        ctx.count_Q[rid] = ctx.count_Q.get(rid, 0) + 1
     print("\t\t{} questions do not have accepted answer!"
           .format(no_acc_question))
-    
+
     # Count raw question statistics
-    raw_question_stats_cntr = Counter(raw_question_stats)
-    with open(data_dir + RAW_STATS, "w") as fout:
-        for x in sorted(list(raw_question_stats_cntr.keys())):
-            print("{}\t{}".format(x, raw_question_stats_cntr[x]), file=fout)
-        print("Total\t{}".format(sum(raw_question_stats)), file=fout)
+    raw_question_stats = answer_counts[valid]
+    raw_question_stats = raw_question_stats[raw_question_stats >= 0]
+    values, counts = np.unique(raw_question_stats, return_counts=True)
+    with textio.open_text(data_dir + RAW_STATS, "w") as fout:
+        for x, count in zip(values.tolist(), counts.tolist()):
+            print("{}\t{}".format(x, count), file=fout)
+        print("Total\t{}".format(int(raw_question_stats.sum())), file=fout)
 
     # Process answer information
-    with open(data_dir + POST_A, 'r') as fin_a:
-        for line in fin_a:
-            data = json.loads(line)
-            try:
-                answer_id = data.get('Id', None)
-                aid = data.get('OwnerUserId', None)
-                qid = data.get('ParentId', None)
-                entry = qa_map.get(qid, None)
-                if answer_id and aid and qid and entry:
-                    entry['AnswererAnswerTuples'].append((aid, answer_id))
-                    entry['AnswererIdList'].append(aid)
-                    count_A[aid] = count_A.get(aid, 0) + 1
-
-                    # Check if we happen to hit the accepted answer
-                    if answer_id == entry['AcceptedAnswerId']:
-                        entry['AcceptedAnswererId'] = aid
-                else:
-                    logger.error(
-                        "Answer {} belongs to unknown Question {} at Process QA"
-                        .format(answer_id, qid))
-            except IndexError as e:
-                logger.error(e)
-                logger.info("Error at process_QA 2: " + str(data))
-                continue
-
-    # Fill in the blanks of `AcceptedAnswererId`
-    # for qid in qa_map.keys():
-    #    acc_id = qa_map[qid]['AcceptedAnswerId']
-    #    for aid, answer_id in qa_map[qid]['AnswererAnswerTuples']:
-    #        if answer_id == acc_id:
-    #            qa_map[qid]['AcceptedAnswererId'] = aid
-    #            break
+    cols = read_columns(data_dir + POSTS_A_COLS, ["Id", "OwnerUserId", "ParentId"])
+    answer_ids, aids, parent_ids = cols["Id"], cols["OwnerUserId"], cols["ParentId"]
+    known = np.isin(parent_ids, qids[has_acc]) \
+        & (answer_ids != MISSING) & (aids != MISSING)
+
+    for answer_id, qid in zip(answer_ids[~known].tolist(),
+                              parent_ids[~known].tolist()):
+        logger.error(
+            "Answer {} belongs to unknown Question {} at Process QA"
+            .format(answer_id, None if qid == MISSING else qid))
+
+    for answer_id, aid, qid in zip(answer_ids[known].tolist(),
+                                   aids[known].tolist(),
+                                   parent_ids[known].tolist()):
+        answer_id, aid = str(answer_id), str(aid)
+        entry = ctx.qa_map[str(qid)]
+        entry['AnswererAnswerTuples'].append((aid, answer_id))
+        entry['AnswererIdList'].append(aid)
+        ctx.count_A[aid] = ctx.count_A.get(aid, 0) + 1
+
+        # Check if we happen to hit the accepted answer
+        if answer_id == entry['AcceptedAnswerId']:
+            entry['AcceptedAnswererId'] = aid
 
     print("\t\tWriting the Record for ALL to disk.")
-    with open(data_dir + OUTPUT, 'w') as fout:
-        for q in qa_map.keys():
-            fout.write(json.dumps(qa_map[q]) + "\n")
+    write_records(ctx, data_dir, OUTPUT)
 
 
-def question_stats(data_dir):
+def question_stats(ctx, data_dir):
     """Find the question statistics for `Introduction`
 
     Args:
@@ -263,25 +850,69 @@ def question_stats(data_dir):
     """
     OUTPUT = "question.stats"
     count = []
-    for qid in qa_map.keys():
-        ans_count = len(qa_map[qid]['AnswererIdList'])
+    for qid in ctx.qa_map.keys():
+        ans_count = len(ctx.qa_map[qid]['AnswererIdList'])
         count.append(ans_count)
         if ans_count == 0:
             print("0 answer id list", qid)
     question_stats_cntr = Counter(count)
 
-    with open(data_dir + OUTPUT, "w") as fout:
+    with textio.open_text(data_dir + OUTPUT, "w") as fout:
         for x in sorted(list(question_stats_cntr.keys())):
             print("{}\t{}".format(x, question_stats_cntr[x]), file=fout)
         print("Total\t{}".format(sum(count), file=fout), file=fout)
     return
 
 
-def build_test_set(data_dir, parsed_dir, threshold, test_sample_size,
+def sample_negatives(pool_size, n_rows, width, max_keys=1 << 22):
+    """Indices into a pool, `width` distinct ones in each of `n_rows` rows
+
+    All rows are drawn with replacement at once and only the rows with
+        duplicates are redrawn, so every row is a uniform sample without
+        replacement, as `random.sample`. A row of a pool larger than
+        width ** 2 / 4 has no duplicate with probability above exp(-2),
+        so few redraws are needed. Smaller pools are shuffled instead, a
+        block of rows at a time so that at most `max_keys` sort keys are
+        in memory.
+
+    Args:
+        pool_size - the size of the pool
+        n_rows - the number of rows
+        width - the number of indices in a row
+        max_keys - the largest number of sort keys of a block
+    Return:
+        n_rows x width int array
+    """
+    if pool_size < width:
+        raise ValueError("Sample larger than population")
+    if 4 * pool_size <= width * width:
+        samples = np.empty((n_rows, width), dtype=np.int64)
+        block = max(1, max_keys // max(pool_size, 1))
+        for lo in range(0, n_rows, block):
+            keys = np.random.random_sample((min(block, n_rows - lo), pool_size))
+            samples[lo: lo + len(keys)] = np.argsort(keys, axis=1)[:, :width]
+        return samples
+
+    samples = np.random.randint(pool_size, size=(n_rows, width))
+    redraw = np.arange(n_rows)
+    while len(redraw):
+        rows = np.sort(samples[redraw], axis=1)
+        redraw = redraw[(rows[:, 1:] == rows[:, :-1]).any(axis=1)]
+        samples[redraw] = np.random.randint(pool_size, size=(len(redraw), width))
+    return samples
+
+
+def build_test_set(ctx, data_dir, parsed_dir, threshold, test_sample_size,
                    test_proportion):
     """
     Building test datase,
     test_proportiont
+
+    The questions are handled as arrays in the order of `qa_map`: test
+        candidates and the training records are selected by boolean
+        masks, and the negative samples of all test questions are drawn
+        from `ordered_aid` in bulk.
+
     Args:
         parse_dir - the directory to save parsed set.
         threshold - the selection threshold
@@ -289,71 +920,159 @@ def build_test_set(data_dir, parsed_dir, threshold, test_sample_size,
     Return:
     """
     TEST = "test.txt"
-    OUTPUT_TRAIN = "Record_Train.json"
-
-    accept_no_answerer = 0
+    OUTPUT_TRAIN = "Record_Train"
 
     ordered_count_A = sorted(
-        count_A.items(), key=lambda x:x[1], reverse=True)
+        ctx.count_A.items(), key=lambda x:x[1], reverse=True)
     ordered_aid = [x[0] for x in ordered_count_A]
-    ordered_aid = ordered_aid[: int(len(ordered_aid) * 0.1)]
-
-    question_count = len(qa_map)
-
-    for qid in qa_map.keys():
-        accaid = qa_map[qid]['AcceptedAnswererId']
-        rid = qa_map[qid]['QuestionOwnerId']
-        if not accaid:
-            accept_no_answerer += 1
-            continue
-        if count_Q[rid] >= threshold and count_A[accaid] >= threshold:
-            test_candidates.add(qid)
+    ordered_aid = np.array(ordered_aid[: int(len(ordered_aid) * 0.1)])
+
+    qids = list(ctx.qa_map.keys())
+    entries = [ctx.qa_map[qid] for qid in qids]
+    question_count = len(qids)
+
+    accaids = [entry['AcceptedAnswererId'] for entry in entries]
+    has_accaid = np.array([bool(x) for x in accaids], dtype=bool)
+    accept_no_answerer = int((~has_accaid).sum())
+    count_r = np.array([ctx.count_Q[entry['QuestionOwnerId']]
+                        for entry in entries], dtype=np.int64)
+    count_acc = np.array([ctx.count_A.get(x, 0) if x else 0 for x in accaids],
+                         dtype=np.int64)
+    candidates = np.flatnonzero(
+        has_accaid & (count_r >= threshold) & (count_acc >= threshold))
+    ctx.test_candidates.update(qids[i] for i in candidates.tolist())
 
     print("\t\tSample table size {}. Using {} instances for test."
-          .format(len(test_candidates), int(question_count * test_proportion)))
+          .format(len(candidates), int(question_count * test_proportion)))
 
-    test = np.random.choice(list(test_candidates),
+    test = np.random.choice(candidates,
                             size=int(question_count * test_proportion),
                             replace=False)
 
     print("\t\tAccepted answer without Answerer {}".format(accept_no_answerer))
 
+    # Negative samples of the questions with few answers, in bulk
+    n_answers = np.array([len(entries[i]['AnswererIdList']) for i in test],
+                         dtype=np.int64)
+    short = n_answers <= test_sample_size
+    neg_sizes = test_sample_size - n_answers[short]
+    width = int(neg_sizes.max()) if len(neg_sizes) else 0
+    negatives = sample_negatives(len(ordered_aid), len(neg_sizes), width) \
+        if width else np.zeros((len(neg_sizes), 0), dtype=np.int64)
+
     print("\t\tWriting the sampled test set to disk")
-    with open(parsed_dir + TEST, "w") as fout:
-        for qid in test:
-            rid = qa_map[qid]['QuestionOwnerId']
-            accaid = qa_map[qid]['AcceptedAnswererId']
-            aid_list = qa_map[qid]['AnswererIdList']
-            if len(aid_list) <= test_sample_size:
-                neg_sample_size = test_sample_size - len(aid_list)
-                neg_samples = random.sample(ordered_aid, neg_sample_size)
+    with textio.open_text(parsed_dir + TEST, "w") as fout:
+        row = 0
+        for i, is_short in zip(test.tolist(), short.tolist()):
+            rid = entries[i]['QuestionOwnerId']
+            accaid = accaids[i]
+            aid_list = entries[i]['AnswererIdList']
+            if is_short:
+                neg_samples = ordered_aid[
+                    negatives[row, :test_sample_size - len(aid_list)]].tolist()
                 samples = neg_samples + aid_list
+                row += 1
             else:
                 samples = random.sample(aid_list, test_sample_size)
                 if accaid not in samples:
                     samples.pop()
                     samples.append(accaid)
             samples = " ".join(samples)
-            print("{} {} {} {}".format(rid, qid, accaid, samples),
+            print("{} {} {} {}".format(rid, qids[i], accaid, samples),
                   file=fout)
 
     # if qid is a test instance or qid doesn't have an answer
-    qid_list = list(qa_map.keys())
-    for qid in qid_list:
-        if qid in test\
-            or not len(qa_map[qid]['AnswererIdList'])\
-            or not qa_map[qid]['AcceptedAnswererId']:
-            del qa_map[qid]
+    keep = has_accaid & np.array([bool(entry['AnswererIdList'])
+                                  for entry in entries], dtype=bool)
+    keep[test] = False
+    for i in np.flatnonzero(~keep).tolist():
+        del ctx.qa_map[qids[i]]
 
     # Write QA pair to file
     print("\t\tWriting the Record for training to disk")
-    with open(data_dir + OUTPUT_TRAIN, 'w') as fout:
-        for q in qa_map.keys():
-            fout.write(json.dumps(qa_map[q]) + "\n")
+    write_records(ctx, data_dir, OUTPUT_TRAIN)
     return
 
 
-def extract_question_user(data_dir, parsed_dir):
+def synthetic_site(ctx, n_questions, n_users=None, max_answers=6, seed=0):
+    """Fill `qa_map`, `count_Q` and `count_A` of `ctx` with a synthetic site
+
+    Askers are uniform and answerers follow a Zipf law, every question
+        has 1 to `max_answers` answers and the first one is accepted.
+    """
+    rand = np.random.RandomState(seed)
+    n_users = n_users or max(n_questions // 10, 100)
+    rids = rand.randint(1, n_users + 1, size=n_questions).astype(str).tolist()
+    n_answers = rand.randint(1, max_answers + 1, size=n_questions)
+    aids = ((rand.zipf(1.3, size=n_answers.sum()) - 1) % n_users + 1) \
+        .astype(str).tolist()
+    offsets = np.concatenate([[0], np.cumsum(n_answers)]).tolist()
+
+    answer_id = n_questions
+    for q in range(n_questions):
+        qid, rid = str(q + 1), rids[q]
+        aid_list = aids[offsets[q]: offsets[q + 1]]
+        tuples = [(aid, str(answer_id + k + 1)) for k, aid in enumerate(aid_list)]
+        answer_id += len(aid_list)
+        ctx.qa_map[qid] = {
+            'QuestionId': qid,
+            'QuestionOwnerId': rid,
+            'AcceptedAnswerId': tuples[0][1],
+            'AcceptedAnswererId': aid_list[0],
+            'AnswererIdList': aid_list,
+            'AnswererAnswerTuples': tuples
+        }
+        ctx.count_Q[rid] = ctx.count_Q.get(rid, 0) + 1
+        for aid in aid_list:
+            ctx.count_A[aid] = ctx.count_A.get(aid, 0) + 1
+
+
+def bench_build_test_set(work_dir, n_questions=1000000, threshold=5,
+                         test_sample_size=20, test_proportion=0.05):
+    """Time `build_test_set` on a synthetic site of `n_questions`
+
+    The cost of the former `qid in test` scan over the test array is
+        measured on a sample of questions and extrapolated.
+
+    Args:
+        work_dir - the dir where the outputs are written
+    Return:
+        dict of timings in seconds
+    """
+    ctx = Context("synthetic")
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+
+    start = time.time()
+    synthetic_site(ctx, n_questions)
+    generate_time = time.time() - start
+    print("\t\tSynthetic site: {} questions, {} users in {:.1f}s"
+          .format(len(ctx.qa_map), len(set(ctx.count_Q) | set(ctx.count_A)),
+                  generate_time))
+
+    # The former membership test, on a sample of questions
+    qids = list(ctx.qa_map.keys())
+    test = np.random.choice(qids, size=int(n_questions * test_proportion),
+                            replace=False)
+    sample = qids[:1000]
+    start = time.time()
+    for qid in sample:
+        qid in test
+    scan_time = (time.time() - start) * len(qids) / len(sample)
+
+    start = time.time()
+    build_test_set(ctx, work_dir, work_dir, threshold, test_sample_size,
+                   test_proportion)
+    build_time = time.time() - start
+
+    print("\t\tbuild_test_set {:.1f}s (incl. writing), former membership "
+          "scan alone ~{:.0f}s, peak RSS {:.1f} MB"
+          .format(build_time, scan_time, peak_rss_mb()))
+    return {"generate": generate_time, "build_test_set": build_time,
+            "former_scan_estimate": scan_time}
+
+
+def extract_question_user(ctx, data_dir, parsed_dir):
     """Extract Question User pairs and output to file.
     Extract "Q" and "R". Format:
         <Qid> <Rid>
@@ -365,24 +1084,21 @@ def extract_question_user(data_dir, parsed_dir):
         data_dir - data directory
         parsed_dir - parsed file directory
     """
-    # INPUT = "Record_Train.json"
-    INPUT = "Record_All.json"
+    # INPUT = "Record_Train.cols"
+    INPUT = "Record_All.cols"
     OUTPUT = "Q_R.txt"
 
-    if not os.path.exists(data_dir + INPUT):
-        IOError("Can NOT find {}".format(data_dir + INPUT))
+    if not colstore.exists(data_dir + INPUT):
+        raise IOError("Can NOT find {}".format(data_dir + INPUT))
 
-    with open(data_dir + INPUT, "r") as fin:
-        with open(parsed_dir + OUTPUT, "w") as fout:
-            for line in fin:
-                data = json.loads(line)
-                qid = data['QuestionId']
-                rid = data['QuestionOwnerId']
-                part_user.add(int(rid))  # Adding participated questioners
-                print("{} {}".format(str(qid), str(rid)), file=fout)
+    cols = read_columns(data_dir + INPUT, ["QuestionId", "QuestionOwnerId"])
+    qids, rids = cols["QuestionId"], cols["QuestionOwnerId"]
+    ctx.part_user.update(np.unique(rids).tolist())  # Adding participated questioners
+    with textio.open_text(parsed_dir + OUTPUT, "w") as fout:
+        np.savetxt(fout, np.column_stack([qids, rids]), fmt="%d")
 
 
-def extract_question_answer_user(data_dir, parsed_dir):
+def extract_question_answer_user(ctx, data_dir, parsed_dir):
     """Extract Question, Answer User pairs and output to file.
 
     (1) Extract "Q" - "A"
@@ -400,28 +1116,27 @@ def extract_question_answer_user(data_dir, parsed_dir):
         data_dir - data directory
         parsed_dir - parsed file directory
     """
-    INPUT = "Record_Train.json"
+    INPUT = "Record_Train.cols"
     OUTPUT_A = "Q_A.txt"
     OUTPUT_ACC = "Q_ACC.txt"
 
-    if not os.path.exists(data_dir + INPUT):
-        IOError("Can NOT find {}".format(data_dir + INPUT))
+    if not colstore.exists(data_dir + INPUT):
+        raise IOError("Can NOT find {}".format(data_dir + INPUT))
+
+    cols = read_columns(data_dir + INPUT, ["QuestionId", "AnswererIdList",
+                                           "AcceptedAnswererId"])
+    qids, aid_lists = cols["QuestionId"], cols["AnswererIdList"]
+    ctx.part_user.update(np.unique(aid_lists.values).tolist())
 
-    with open(data_dir + INPUT, "r") as fin, \
-            open(parsed_dir + OUTPUT_A, "w") as fout_a, \
-            open(parsed_dir + OUTPUT_ACC, "w") as fout_acc:
-        for line in fin:
-            data = json.loads(line)
-            qid = data['QuestionId']
-            aid_list = data['AnswererIdList']
-            accaid = data['AcceptedAnswererId']
-            for aid in aid_list:
-                part_user.add(int(aid))
-                print("{} {}".format(str(qid), str(aid)), file=fout_a)
-            print("{} {}".format(str(qid), str(accaid)), file=fout_acc)
+    with textio.open_text(parsed_dir + OUTPUT_A, "w") as fout_a, \
+            textio.open_text(parsed_dir + OUTPUT_ACC, "w") as fout_acc:
+        np.savetxt(fout_a, np.column_stack(
+            [np.repeat(qids, aid_lists.lengths()), aid_lists.values]), fmt="%d")
+        np.savetxt(fout_acc, np.column_stack(
+            [qids, cols["AcceptedAnswererId"]]), fmt="%d")
 
 
-def extract_question_content(data_dir, parsed_dir):
+def extract_question_content(ctx, data_dir, parsed_dir, workers=1):
     """Extract questions, content pairs from question file
 
     Question content pair format:
@@ -432,53 +1147,52 @@ def extract_question_content(data_dir, parsed_dir):
     Args:
         data_dir - data directory
         parsed_dir - parsed file directory
+        workers - the number of processes normalizing text
     """
-    INPUT = "Posts_Q.json"
     OUTPUT_T = "Q_title.txt"  # Question title
     OUTPUT_T_NSW = "Q_title_nsw.txt"  # Question title, no stop word
     OUTPUT_C = "Q_content.txt"  # Question content
     OUTPUT_C_NSW = "Q_content_nsw.txt"  # Question content, no stop word
 
-    logger = logging.getLogger(__name__)
+    logger = ctx.logger
+
+    if not colstore.exists(data_dir + POSTS_Q_COLS):
+        raise IOError("Can NOT locate {}".format(data_dir + POSTS_Q_COLS))
 
-    if not os.path.exists(data_dir + INPUT):
-        IOError("Can NOT locate {}".format(data_dir + INPUT))
+    cols = read_columns(data_dir + POSTS_Q_COLS, ["Id", "Title", "Body"])
+    qids, titles, bodies = cols["Id"], cols["Title"], cols["Body"]
+    selected = np.flatnonzero(np.isin(
+        qids, np.array([int(qid) for qid in ctx.qa_map], dtype=np.int64)))
 
-    sw_set = set(stopwords.words('english'))  # Create the stop word set
+    def questions_of(rows):
+        for i in rows.tolist():
+            yield {'Id': str(qids[i]), 'Title': titles[i], 'Body': bodies[i]}
 
+    rows, start = 0, time.time()
 
     # We will try both with or without stopwords to
     # check out the performance.
-    with open(data_dir + INPUT, "r") as fin, \
-            open(parsed_dir + OUTPUT_T, "w") as fout_t, \
-            open(parsed_dir + OUTPUT_T_NSW, "w") as fout_t_nsw, \
-            open(parsed_dir + OUTPUT_C, "w") as fout_c, \
-            open(parsed_dir + OUTPUT_C_NSW, "w") as fout_c_nsw:
-        for line in fin:
-            data = json.loads(line)
-            try:
-                qid = data.get('Id')
-                if qid not in qa_map:
-                    continue
-                title = data.get('Title')
-                content = data.get('Body')
-
-                content, title = clean_str2(content), clean_str2(title)
-                content_nsw = remove_stopwords(content, sw_set)
-                title_nsw = remove_stopwords(title, sw_set)
-
-                print("{} {}".format(qid, content_nsw),
-                      file=fout_c_nsw)  # Without stopword
-                print("{} {}".format(qid, content),
-                      file=fout_c)  # With stopword
-                print("{} {}".format(qid, title_nsw),
-                      file=fout_t_nsw)  # Without stopword
-                print("{} {}".format(qid, title),
-                      file=fout_t)  # With stopword
-            except:
-                logger.info("Error at Extracting question content and title: "
-                            + str(data))
+    with textio.open_text(parsed_dir + OUTPUT_T, "w") as fout_t, \
+            textio.open_text(parsed_dir + OUTPUT_T_NSW, "w") as fout_t_nsw, \
+            textio.open_text(parsed_dir + OUTPUT_C, "w") as fout_c, \
+            textio.open_text(parsed_dir + OUTPUT_C_NSW, "w") as fout_c_nsw:
+        for result in parallel_map(clean_question, questions_of(selected),
+                                   workers=workers):
+            rows += 1
+            if result is None:
+                logger.info("Error at Extracting question content and title")
                 continue
+            qid, content, content_nsw, title, title_nsw = result
+
+            print("{} {}".format(qid, content_nsw),
+                  file=fout_c_nsw)  # Without stopword
+            print("{} {}".format(qid, content),
+                  file=fout_c)  # With stopword
+            print("{} {}".format(qid, title_nsw),
+                  file=fout_t_nsw)  # Without stopword
+            print("{} {}".format(qid, title),
+                  file=fout_t)  # With stopword
+    report_progress("extract_question_content", rows, start)
 
 
 def extract_answer_score(data_dir, parsed_dir):
@@ -491,87 +1205,60 @@ def extract_answer_score(data_dir, parsed_dir):
         data_dir - Input data dir
         parsed_dir - Output data dir
     """
-    INPUT = "Posts_A.json"
     OUTPUT = "A_score.txt"
 
-    logger = logging.getLogger(__name__)
-
-    if not os.path.exists(data_dir + INPUT):
-        IOError("Cannot find file{}".format(data_dir + INPUT))
-
-    with open(data_dir + INPUT, "r") as fin, \
-        open(parsed_dir + OUTPUT, "w") as fout:
-        for line in fin:
-            data = json.loads(line)
-            try:
-                aid = data.get('Id')
-                score = data.get('Score')
-                print("{} {}".format(aid, score), file=fout)
-            except:
-                logging.info("Error at Extracting answer score: "
-                             + str(data))
-                continue
+    if not colstore.exists(data_dir + POSTS_A_COLS):
+        raise IOError("Cannot find file{}".format(data_dir + POSTS_A_COLS))
+
+    cols = read_columns(data_dir + POSTS_A_COLS, ["Id", "Score"])
+    with textio.open_text(parsed_dir + OUTPUT, "w") as fout:
+        np.savetxt(fout, np.column_stack([cols["Id"], cols["Score"]]), fmt="%d")
 
 
 def extract_question_best_answerer(data_dir, parsed_dir):
     """Extract the question-best-answerer relation
 
+    The best answer is the accepted one, or the one of the highest
+        score if none is accepted.
+
     Args:
         data_dir  - as usual
         parsed_dir  -  as usual
     """
-    INPUT_A = "Posts_A.json"
-    INPUT_MAP = "Record_Train.json"
+    INPUT_MAP = "Record_Train.cols"
     OUTPUT = "Q_ACC_A.txt"
 
-    if not os.path.exists(data_dir + INPUT_A):
-        IOError("Cannot find file {}".format(data_dir + INPUT_A))
-    if not os.path.exists(data_dir + INPUT_MAP):
-        IOError("Cannot find file {}".format(data_dir + INPUT_MAP))
-
-    accanswerid_uaid = {}  # Accepted answer id to Answering user id
-    answerid_score = {}  # Answer id to answer scores
-    with open(data_dir + INPUT_A, "r") as fin_a, \
-        open(data_dir + INPUT_MAP, "r") as fin_map, \
-        open(parsed_dir + OUTPUT, "w") as fout:
-
-        # build acc-a dict
-        for line in fin_a:
-            data = json.loads(line)
-            try:
-                answerid = data.get("Id")
-                if answerid == "5":
-                    print(100)
-                score = data.get("Score")
-                uaid = data.get("OwnerUserId")
-                answerid_score[answerid] = score
-                accanswerid_uaid[answerid] = uaid  # uaid is rid
-            except:
-                logging.info(
-                    "Error at Extracting question, best answer user: "
-                    + str(data))
-
-        print(len(accanswerid_uaid))
-        for line in fin_map:
-            data = json.loads(line)
-            try:
-                qid = data.get('QuestionId')
-                if "AcceptedAnswerID" in data:  # If acc answer exists
-                    acc_answerid = data.get('AcceptedAnswerId')
-                else:
-                # If acc answer doesn't exist, choose highest score answer
-                    ans = data.get('AnswerIdList')
-                    ans = list(zip(*ans))[0]
-                    scores = [answerid_score[answerid] for answerid in ans]
-                    max_ind = scores.index(max(scores))
-                    acc_answerid = ans[max_ind]
-                uaccid = accanswerid_uaid[acc_aid]
-                print("{} {}".format(qid, uaccid), file=fout)
-            except:
-                print(1)
-                logging.info(
-                    "Error at Extracting question, best answer user: "
-                     + str(data))
+    if not colstore.exists(data_dir + POSTS_A_COLS):
+        raise IOError("Cannot find file {}".format(data_dir + POSTS_A_COLS))
+    if not colstore.exists(data_dir + INPUT_MAP):
+        raise IOError("Cannot find file {}".format(data_dir + INPUT_MAP))
+
+    # Answer id to score and to answering user id, by binary search
+    answers = read_columns(data_dir + POSTS_A_COLS, ["Id", "Score", "OwnerUserId"])
+    order = np.argsort(answers["Id"], kind="mergesort")
+    answer_ids = answers["Id"][order]
+    scores, uaids = answers["Score"][order], answers["OwnerUserId"][order]
+
+    def lookup(ids):
+        pos = np.searchsorted(answer_ids, ids).clip(max=len(answer_ids) - 1)
+        return pos, answer_ids[pos] == ids
+
+    records = read_columns(data_dir + INPUT_MAP, ["QuestionId", "AcceptedAnswerId",
+                                                  "AnswerIdList"])
+    qids, acc_ids = records["QuestionId"], np.array(records["AcceptedAnswerId"])
+    answer_lists = records["AnswerIdList"]
+
+    # If acc answer doesn't exist, choose highest score answer
+    for i in np.flatnonzero(acc_ids == MISSING).tolist():
+        pos, found = lookup(answer_lists[i])
+        if found.any():
+            acc_ids[i] = answer_lists[i][found][np.argmax(scores[pos[found]])]
+
+    pos, found = lookup(acc_ids)
+    found &= uaids[pos] != MISSING
+    with textio.open_text(parsed_dir + OUTPUT, "w") as fout:
+        np.savetxt(fout, np.column_stack([qids[found], uaids[pos[found]]]),
+                   fmt="%d")
 
 
 def extract_question_best_answerer_2(data_dir, parsed_dir):
@@ -581,57 +1268,363 @@ def extract_question_best_answerer_2(data_dir, parsed_dir):
         data_dir  - as usual
         parsed_dir  -  as usual
     """
-    INPUT_A = "Posts_A.json"
-    # INPUT_MAP = "Record_Train.json"
+    # INPUT_MAP = "Record_Train.cols"
     # Uncomment this when running NeRank
-    INPUT_MAP = "Record_All.json"
+    INPUT_MAP = "Record_All.cols"
     OUTPUT = "Q_ACC_A.txt"
 
-    if not os.path.exists(data_dir + INPUT_A):
-        IOError("Cannot find file {}".format(data_dir + INPUT_A))
-    if not os.path.exists(data_dir + INPUT_MAP):
-        IOError("Cannot find file {}".format(data_dir + INPUT_MAP))
-
-    accanswerid_uaid = {}  # Accepted answer id to Answering user id
-    answerid_score = {}  # Answer id to answer scores
-    with open(data_dir + INPUT_MAP, "r") as fin_map, \
-        open(parsed_dir + OUTPUT, "w") as fout:
-
-        for line in fin_map:
-            data = json.loads(line)
-            try:
-                qid = data.get('QuestionId')
-                acc_aid = data.get("AcceptedAnswererId")
-                if qid and acc_aid:
-                    print("{} {}".format(qid, acc_aid), file=fout)
-            except:
-                print(1)
-                logging.info(
-                    "Error at Extracting question, best answer user: "
-                     + str(data))
-
-def write_part_users(parsed_dir):
+    if not colstore.exists(data_dir + INPUT_MAP):
+        raise IOError("Cannot find file {}".format(data_dir + INPUT_MAP))
+
+    cols = read_columns(data_dir + INPUT_MAP, ["QuestionId", "AcceptedAnswererId"])
+    qids, acc_aids = cols["QuestionId"], cols["AcceptedAnswererId"]
+    has_acc = acc_aids != MISSING
+    with textio.open_text(parsed_dir + OUTPUT, "w") as fout:
+        np.savetxt(fout, np.column_stack([qids[has_acc], acc_aids[has_acc]]),
+                   fmt="%d")
+
+def extract_relations(data_dir, parsed_dir, binary=False, chunk_rows=1 << 20,
+                      buffer_size=1 << 20):
+    """Extract all Q, R, A relations in one pass over Record_All
+
+    Fuses `extract_question_user`, `extract_question_answer_user`,
+        `extract_question_best_answerer_2` and `write_part_users`. The
+        training questions are the rows of Record_All that are also in
+        Record_Train, so the records are scanned once, `chunk_rows` rows
+        at a time, and the participants are collected locally instead
+        of in `Context.part_user`. The text outputs are the same as the
+        ones of the separate functions.
+
+    With `binary`, every relation is also saved as an N x 2 int64 .npy
+        array (QA_ID.npy holds the sorted user ids, the index of a user
+        is its position + 1), which `DataLoader` memory-maps.
+
+    Args:
+        data_dir - data directory
+        parsed_dir - parsed file directory
+        binary - whether to write the .npy arrays too
+        chunk_rows - the number of records processed at a time
+        buffer_size - the write buffer size of each text output
+    """
+    INPUT_ALL = "Record_All.cols"
+    INPUT_TRAIN = "Record_Train.cols"
+    NAMES = ["Q_R", "Q_A", "Q_ACC", "Q_ACC_A"]
+
+    for name in (INPUT_ALL, INPUT_TRAIN):
+        if not colstore.exists(data_dir + name):
+            raise IOError("Can NOT find {}".format(data_dir + name))
+
+    cols = read_columns(data_dir + INPUT_ALL,
+                        ["QuestionId", "QuestionOwnerId", "AcceptedAnswererId",
+                         "AnswererIdList"])
+    qids, rids = cols["QuestionId"], cols["QuestionOwnerId"]
+    acc_aids, aid_lists = cols["AcceptedAnswererId"], cols["AnswererIdList"]
+    train_ids = read_columns(data_dir + INPUT_TRAIN, ["QuestionId"])["QuestionId"]
+    train = np.isin(qids, train_ids)
+    has_acc = acc_aids != MISSING
+    lengths = aid_lists.lengths()
+
+    # The walk graph of the former relations, see `csr_graph`
+    if os.path.exists(parsed_dir + "graph"):
+        shutil.rmtree(parsed_dir + "graph")
+
+    arrays = {}
+    if binary:
+        sizes = {"Q_R": len(qids), "Q_A": int(lengths[train].sum()),
+                 "Q_ACC": int(train.sum()), "Q_ACC_A": int(has_acc.sum())}
+        arrays = {name: np.lib.format.open_memmap(
+            parsed_dir + name + ".npy", mode="w+", dtype=np.int64,
+            shape=(sizes[name], 2)) for name in NAMES}
+    else:
+        # Stale arrays would shadow the new text files in `DataLoader`
+        for name in NAMES + ["QA_ID"]:
+            if os.path.exists(parsed_dir + name + ".npy"):
+                os.remove(parsed_dir + name + ".npy")
+    filled = dict.fromkeys(NAMES, 0)
+
+    def write(name, fout, rows):
+        np.savetxt(fout, rows, fmt="%d")
+        if binary:
+            arrays[name][filled[name]: filled[name] + len(rows)] = rows
+        filled[name] += len(rows)
+
+    users = []
+    rows, start = 0, time.time()
+    fouts = {name: textio.open_text(parsed_dir + name + ".txt", "w",
+                                    buffering=buffer_size)
+             for name in NAMES}
+    try:
+        for lo in range(0, len(qids), chunk_rows):
+            hi = min(lo + chunk_rows, len(qids))
+            q, r, t = qids[lo:hi], rids[lo:hi], train[lo:hi]
+            acc, has = acc_aids[lo:hi], has_acc[lo:hi]
+            off = aid_lists.offsets[lo: hi + 1]
+            a = aid_lists.values[off[0]: off[-1]]
+            a_train = np.repeat(t, lengths[lo:hi])
+
+            write("Q_R", fouts["Q_R"], np.column_stack([q, r]))
+            write("Q_A", fouts["Q_A"], np.column_stack(
+                [np.repeat(q, lengths[lo:hi])[a_train], a[a_train]]))
+            write("Q_ACC", fouts["Q_ACC"], np.column_stack([q[t], acc[t]]))
+            write("Q_ACC_A", fouts["Q_ACC_A"], np.column_stack([q[has], acc[has]]))
+            users += [np.unique(r), np.unique(a[a_train])]
+            rows = hi
+            report_progress("extract_relations", rows, start)
+    finally:
+        for fout in fouts.values():
+            fout.close()
+    for array in arrays.values():
+        array.flush()
+
+    uids = np.unique(np.concatenate(users)) if users \
+        else np.zeros(0, dtype=np.int64)
+    with textio.open_text(parsed_dir + "QA_ID.txt", "w",
+                          buffering=buffer_size) as fout:
+        np.savetxt(fout, np.column_stack(
+            [np.arange(1, len(uids) + 1), uids]), fmt="%d")
+    if binary:
+        np.save(parsed_dir + "QA_ID.npy", uids)
+    print("\t\t{} users, {}".format(
+        len(uids), ", ".join("{} {}".format(name, filled[name]) for name in NAMES)))
+    return uids
+
+
+def write_part_users(ctx, parsed_dir):
     OUTPUT = "QA_ID.txt"
-    with open(parsed_dir + OUTPUT, "w") as fout:
-        IdList = list(part_user)
+    with textio.open_text(parsed_dir + OUTPUT, "w") as fout:
+        IdList = list(ctx.part_user)
         IdList.sort()
         for index, user_id in enumerate(IdList):
             print("{} {}".format(index + 1, user_id), file=fout)
 
 
-def preprocess_(dataset, threshold, prop_test, sample_size):
-    DATASET = dataset
-    RAW_DIR = os.getcwd() + "/raw/{}/".format(DATASET)
-    DATA_DIR= os.getcwd() + "/data/{}/".format(DATASET)
-    PARSED_DIR = os.getcwd() + "/data/parsed/{}/".format(DATASET)
+def append_pairs(path, pairs):
+    """Append "<id> <id>" lines to a relation file"""
+    with textio.open_text(path, "a") as fout:
+        for x, y in pairs:
+            print("{} {}".format(x, y), file=fout)
+
+
+def ingest_incremental(ctx, by="Id", workers=1, html_parser="bs4"):
+    """Ingest the posts newer than the watermark into the parsed dataset
+
+    Posts.xml is streamed again but only rows past the watermark (by
+        `Id` or `CreationDate`) are cleaned. Everything is appended:
+        the posts to Posts_*.json and Posts_*.cols; the changed records
+        to Record_Delta.json, which `load_records` applies on top of
+        Record_All.json; new lines to the relation files, the question
+        text files and QA_ID.txt, where existing users keep their index.
+        The test set is kept. A question joins the training set once it
+        has answers and an accepted answerer.
+
+    A post is ingested as it is in the first dump where it passes the
+        watermark, later edits of older posts are not picked up. The
+        .npy relation arrays cannot be appended and are removed, so
+        `DataLoader` reads the text files until the next full run.
+
+    Args:
+        ctx - the `Context` of a dataset preprocessed in full before
+        by - "Id" or "CreationDate", the watermark field
+        workers - the number of processes cleaning text
+        html_parser - "bs4" or "lxml"
+
+    Return:
+        the changed entities, also written to changes/<n>.json in the
+            parsed dir:
+            Q - new or updated questions
+            R, A - askers and answerers of the new relation lines
+            new_users - users appended to QA_ID.txt
+    """
+    data_dir, parsed_dir = ctx.data_dir, ctx.parsed_dir
+    watermark = read_watermark(data_dir)
+    if watermark is None:
+        raise IOError("No {} in {}, run the full preprocessing first"
+                      .format(WATERMARK, data_dir))
+    if by not in ("Id", "CreationDate"):
+        raise ValueError("Unknown watermark field {}".format(by))
+
+    def is_new(attr):
+        if by == "Id":
+            return int(attr['Id']) > watermark["Id"]
+        return attr.get('CreationDate', "") > watermark["CreationDate"]
+
+    # Append the new posts
+    start = time.time()
+    new_watermark = dict(watermark)
+    new_questions, new_answers = [], []
+    cleaner = functools.partial(clean_post, html_parser=html_parser)
+    with open_posts(ctx.raw_dir) as posts, \
+            textio.open_text(data_dir + "Posts_Q.json", "a") as fout_q, \
+            textio.open_text(data_dir + "Posts_A.json", "a") as fout_a, \
+            ColumnWriter(data_dir + POSTS_Q_COLS, POSTS_Q_SCHEMA,
+                         append=True) as cols_q, \
+            ColumnWriter(data_dir + POSTS_A_COLS, POSTS_A_SCHEMA,
+                         append=True) as cols_a:
+        new_rows = (attr for attr in iter_post_rows(posts) if is_new(attr))
+        for post_type, row, line in parallel_map(cleaner, new_rows,
+                                                  workers=workers):
+            if post_type == '1':
+                fout_q.write(line)
+                cols_q.append(row)
+                new_questions.append(row)
+            elif post_type == '2':
+                fout_a.write(line)
+                cols_a.append(row)
+                new_answers.append(row)
+            update_watermark(new_watermark, row)
+    report_progress("ingest_incremental", len(new_questions) + len(new_answers),
+                    start)
+
+    # The current state
+    delta_train = load_records(ctx, data_dir)
+    train = set(str(x) for x in read_columns(
+        data_dir + "Record_Train.cols", ["QuestionId"])["QuestionId"].tolist())
+    train |= delta_train
+    with textio.open_text(parsed_dir + "test.txt", "r") as fin:
+        test = set(line.split(" ", 2)[1] for line in fin)
+    with textio.open_text(parsed_dir + "QA_ID.txt", "r") as fin:
+        uid2ind = {uid: int(ind) for ind, uid in
+                   (line.split() for line in fin)}
+
+    relations = {"Q_R": [], "Q_A": [], "Q_ACC": [], "Q_ACC_A": []}
+    changed = OrderedDict()
+
+    for row in new_questions:
+        if MISSING in (row['Id'], row['OwnerUserId'], row['AcceptedAnswerId']):
+            continue
+        qid, rid = str(row['Id']), str(row['OwnerUserId'])
+        ctx.qa_map[qid] = changed[qid] = {
+            'QuestionId': qid,
+            'QuestionOwnerId': rid,
+            'AcceptedAnswerId': str(row['AcceptedAnswerId']),
+            'AcceptedAnswererId': None,
+            'AnswererIdList': [],
+            'AnswererAnswerTuples': []
+        }
+        ctx.count_Q[rid] = ctx.count_Q.get(rid, 0) + 1
+        relations["Q_R"].append((qid, rid))
+
+    for row in new_answers:
+        qid = str(row['ParentId'])
+        entry = ctx.qa_map.get(qid)
+        if entry is None or MISSING in (row['Id'], row['OwnerUserId']):
+            ctx.logger.error("Answer {} belongs to unknown Question {} at "
+                             "ingest_incremental".format(row['Id'], qid))
+            continue
+        answer_id, aid = str(row['Id']), str(row['OwnerUserId'])
+        entry['AnswererAnswerTuples'].append((aid, answer_id))
+        entry['AnswererIdList'].append(aid)
+        ctx.count_A[aid] = ctx.count_A.get(aid, 0) + 1
+        changed[qid] = entry
+        if answer_id == entry['AcceptedAnswerId']:
+            entry['AcceptedAnswererId'] = aid
+            relations["Q_ACC_A"].append((qid, aid))
+        if qid in train:
+            relations["Q_A"].append((qid, aid))
+
+    # Questions joining the training set bring all their answerers
+    for qid, entry in changed.items():
+        if qid not in train and qid not in test \
+                and entry['AnswererIdList'] and entry['AcceptedAnswererId']:
+            train.add(qid)
+            relations["Q_A"] += [(qid, aid) for aid in entry['AnswererIdList']]
+            relations["Q_ACC"].append((qid, entry['AcceptedAnswererId']))
+
+    with textio.open_text(data_dir + RECORD_DELTA, "a") as fout:
+        for qid, entry in changed.items():
+            fout.write(json.dumps({"Record": entry, "Train": qid in train}) + "\n")
+
+    for name, pairs in relations.items():
+        append_pairs(parsed_dir + name + ".txt", pairs)
+
+    # Same participants as `extract_relations`: askers and training answerers
+    new_users = []
+    for uid in itertools.chain((r for _, r in relations["Q_R"]),
+                               (a for _, a in relations["Q_A"])):
+        if uid not in uid2ind:
+            uid2ind[uid] = len(uid2ind) + 1
+            new_users.append(uid)
+    append_pairs(parsed_dir + "QA_ID.txt",
+                 [(uid2ind[uid], uid) for uid in new_users])
+
+    # Text of the new questions
+    text_files = ["Q_content_nsw.txt", "Q_content.txt",
+                  "Q_title_nsw.txt", "Q_title.txt"]
+    fouts = [textio.open_text(parsed_dir + name, "a") for name in text_files]
+    try:
+        questions = ({'Id': str(row['Id']), 'Title': row['Title'],
+                      'Body': row['Body']} for row in new_questions
+                     if str(row['Id']) in ctx.qa_map)
+        for result in parallel_map(clean_question, questions, workers=workers):
+            if result is None:
+                ctx.logger.info("Error at Extracting question content and title")
+                continue
+            qid, content, content_nsw, title, title_nsw = result
+            for fout, text in zip(fouts, (content_nsw, content,
+                                          title_nsw, title)):
+                print("{} {}".format(qid, text), file=fout)
+    finally:
+        for fout in fouts:
+            fout.close()
+
+    # Stale binary relations and walk graph, see `extract_relations`
+    for name in list(relations) + ["QA_ID"]:
+        if os.path.exists(parsed_dir + name + ".npy"):
+            os.remove(parsed_dir + name + ".npy")
+    if os.path.exists(parsed_dir + "graph"):
+        shutil.rmtree(parsed_dir + "graph")
+
+    changes = {
+        "by": by,
+        "from": watermark,
+        "to": new_watermark,
+        "Q": list(changed.keys()),
+        "R": sorted(set(r for _, r in relations["Q_R"])),
+        "A": sorted(set(a for _, a in relations["Q_A"])),
+        "new_users": new_users,
+        "edges": {name: len(pairs) for name, pairs in relations.items()}
+    }
+    changes_dir = parsed_dir + "changes/"
+    if not os.path.exists(changes_dir):
+        os.makedirs(changes_dir)
+    changes_file = changes_dir + "{:05d}.json".format(len(os.listdir(changes_dir)))
+    with open(changes_file, "w") as fout:
+        fout.write(json.dumps(changes))
+
+    # Last, so that a failed run is redone from the same watermark
+    write_watermark(data_dir, new_watermark)
+    print("\t\t{} new questions, {} new answers, {} changed questions, "
+          "{} new users, edges {}".format(
+              len(new_questions), len(new_answers), len(changed),
+              len(new_users), changes["edges"]))
+    return changes
+
+
+def preprocess_(dataset, threshold, prop_test, sample_size, workers=1,
+                html_parser="bs4", root=None):
+    """Preprocess one dataset
+
+    Args:
+        dataset - the name of the dataset, raw data in raw/<dataset>/
+        threshold - the selection threshold of test questions
+        prop_test - the proportion of test questions
+        sample_size - the number of candidate answerers of a test question
+        workers - the number of processes cleaning text
+        html_parser - "bs4" or "lxml"
+        root - the dir holding raw/ and data/, default the working dir
+
+    Return:
+        the list of (stage, seconds)
+    """
+    ctx = Context(dataset, root=root)
+    RAW_DIR, DATA_DIR, PARSED_DIR = ctx.raw_dir, ctx.data_dir, ctx.parsed_dir
 
     print("Preprocessing {} ...".format(dataset))
 
-    if not os.path.exists(RAW_DIR):
-        print("{} dir or path doesn't exist.\n"
-              "Please download the raw data set into the /raw."
-              .format(RAW_DIR), file=sys.stderr)
-        sys.exit()
+    if archive.locate(RAW_DIR, 'Posts.xml') is None:
+        raise IOError("{} dir or path doesn't exist.\n"
+                      "Please download the raw data set into the /raw."
+                      .format(RAW_DIR))
 
     if not os.path.exists(DATA_DIR):
         print("{} data dir not found.\n"
@@ -645,59 +1638,260 @@ def preprocess_(dataset, threshold, prop_test, sample_size):
               .format(PARSED_DIR))
         os.makedirs(PARSED_DIR)
 
-    if os.path.exists(DATA_DIR + "log.log"):
-        os.remove(DATA_DIR + "log.log")
-
     # Setting up loggers
-    logger = logging.getLogger(__name__)
-    logger.setLevel(logging.DEBUG)
+    ctx.open_log()
+    try:
+        # Split contest to question and answer
+        ctx.run_stage("Spliting post", split_post,
+                      raw_dir=RAW_DIR, data_dir=DATA_DIR, workers=workers,
+                      html_parser=html_parser)
 
-    log_fh = logging.FileHandler(DATA_DIR + "log.log")
-    log_fh.setLevel(logging.DEBUG)
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    log_fh.setFormatter(formatter)
-    logger.addHandler(log_fh)
+        # Extract question-user, answer-user, and question-answer information
+        # Generate Question and Answer/User map
+        ctx.run_stage("Processing QA", process_QA, ctx, data_dir=DATA_DIR)
 
-    # Split contest to question and answer
-    print("\tSpliting post")
-    # split_post(raw_dir=RAW_DIR, data_dir=DATA_DIR)
+        ctx.run_stage("Generating question statistics", question_stats,
+                      ctx, data_dir=DATA_DIR)
 
-    # Extract question-user, answer-user, and question-answer information
-    # Generate Question and Answer/User map
-    print("\tProcessing QA")
-    # process_QA(data_dir=DATA_DIR)
+        ctx.run_stage("Extracting question content", extract_question_content,
+                      ctx, data_dir=DATA_DIR, parsed_dir=PARSED_DIR,
+                      workers=workers)
 
-    print("\tGenerating question statistics...")
-    # question_stats(data_dir=DATA_DIR)
+        ctx.run_stage("Building test sets", build_test_set,
+                      ctx, data_dir=DATA_DIR, parsed_dir=PARSED_DIR,
+                      threshold=threshold, test_sample_size=sample_size,
+                      test_proportion=prop_test)
 
-    print("\tExtracting question content ...")
-    # extract_question_content(data_dir=DATA_DIR, parsed_dir=PARSED_DIR)
+        ctx.run_stage("Extracting Q, R, A relations", extract_relations,
+                      data_dir=DATA_DIR, parsed_dir=PARSED_DIR, binary=True)
 
-    print("\tBuilding test sets")
-    # build_test_set(data_dir=DATA_DIR, parsed_dir=PARSED_DIR,
-    #                threshold=threshold, test_sample_size=sample_size,
-    #                test_proportion=prop_test)
+        # extract_answer_score(data_dir=DATA_DIR, parsed_dir=PARSED_DIR)
+    finally:
+        ctx.close_log()
 
-    print("\tExtracting Q, R, A relations ...")
-    extract_question_user(data_dir=DATA_DIR, parsed_dir=PARSED_DIR)
+    print("Done {}! {:.1f}s".format(dataset, sum(t for _, t in ctx.timings)))
+    return ctx.timings
 
-    # extract_question_answer_user(data_dir=DATA_DIR, parsed_dir=PARSED_DIR)
 
+def bench_compression(dataset, work_dir, threshold, prop_test, sample_size,
+                      kinds=("", "gz", "zst"), workers=1, html_parser="bs4"):
+    """Disk footprint and time of preprocessing with each compression
 
-    # extract_answer_score(data_dir=DATA_DIR, parsed_dir=PARSED_DIR)
-    # extract_question_best_answerer_2(data_dir=DATA_DIR, parsed_dir=PARSED_DIR)
+    `preprocess_` runs once per compression under <work_dir>/<kind>/,
+        e.g. on a network-attached disk, then all text files written
+        are read back once as the later stages do.
 
-    # write_part_users(parsed_dir=PARSED_DIR)
+    Args:
+        dataset - the dataset, raw data in raw/<dataset>/
+        work_dir - the dir of the runs
+        kinds - the compressions to compare, see `textio`
+        (others as in `preprocess_`)
 
-    print("Done!")
+    Return:
+        dict from compression to {"preprocess", "read" seconds,
+            "text" bytes of the text files, "disk" bytes in total}
+    """
+    raw_dir = os.path.abspath(Context(dataset).raw_dir)
+    default, results = textio.compression, {}
+    try:
+        for kind in kinds:
+            textio.set_compression(kind)
+            root = os.path.join(os.path.abspath(work_dir), kind or "plain")
+            if os.path.exists(root):
+                shutil.rmtree(root)
+            os.makedirs(root + "/raw")
+            os.symlink(raw_dir, root + "/raw/" + dataset)
+
+            start = time.time()
+            preprocess_(dataset, threshold, prop_test, sample_size,
+                        workers=workers, html_parser=html_parser, root=root)
+            preprocess_time = time.time() - start
+
+            start, text_size = time.time(), 0
+            for path, _, names in os.walk(root + "/data"):
+                # The columnar tables are memory-mapped, never compressed
+                if path.endswith(".cols"):
+                    continue
+                for name in names:
+                    plain = os.path.join(path, name)
+                    for suffix in (".gz", ".zst"):
+                        if plain.endswith(suffix):
+                            plain = plain[:-len(suffix)]
+                    if not plain.endswith((".json", ".txt")):
+                        continue
+                    text_size += os.path.getsize(os.path.join(path, name))
+                    with textio.open_text(plain) as fin:
+                        for _ in fin:
+                            pass
+            results[kind] = {"preprocess": preprocess_time,
+                             "read": time.time() - start, "text": text_size,
+                             "disk": folder_size(root + "/data")}
+    finally:
+        textio.set_compression(default)
+
+    for kind in kinds:
+        result = results[kind]
+        print("\t\t{:6s} preprocess {:.1f}s, read back {:.1f}s, text files "
+              "{:.1f} MB, data dir {:.1f} MB".format(
+                  kind or "plain", result["preprocess"], result["read"],
+                  result["text"] / 2 ** 20, result["disk"] / 2 ** 20))
+    return results
+
+
+def preprocess_site(args):
+    """Run `preprocess_` in a pool worker, return (dataset, timings, error)"""
+    dataset = args[0]
+    try:
+        return dataset, preprocess_(*args), None
+    except Exception as e:
+        return dataset, [], "{}: {}".format(
+            type(e).__name__, " ".join(str(e).split()))
+
+
+def preprocess_many(datasets, threshold, prop_test, sample_size, processes=4,
+                    html_parser="bs4", root=None, summary_file=None):
+    """Preprocess many datasets concurrently in a process pool
+
+    Every dataset is processed by one worker with its own `Context`, and
+        a worker handles one dataset only, so its memory is returned
+        when the dataset is done. Text cleaning inside a dataset is
+        serial, as pool workers cannot start pools of their own.
+
+    Args:
+        datasets - the list of dataset names
+        processes - the number of datasets processed at the same time
+        summary_file - the per-site timing summary, tab separated,
+            default data/preprocess_timing.tsv
+        (others as in `preprocess_`)
+
+    Return:
+        dict from dataset to (timings, error)
+    """
+    root = root or os.getcwd()
+    summary_file = summary_file or root + "/data/preprocess_timing.tsv"
+    tasks = [(dataset, threshold, prop_test, sample_size, 1, html_parser, root)
+             for dataset in datasets]
+
+    results, start = {}, time.time()
+    with Pool(processes, maxtasksperchild=1) as pool:
+        for dataset, timings, error in pool.imap_unordered(preprocess_site,
+                                                           tasks):
+            results[dataset] = (timings, error)
+            print("{} {} in {:.1f}s ({} of {} sites)".format(
+                dataset, "FAILED" if error else "finished",
+                sum(t for _, t in timings), len(results), len(tasks)))
+    elapsed = time.time() - start
+
+    stages = []
+    for timings, _ in results.values():
+        stages += [stage for stage, _ in timings if stage not in stages]
+
+    folder = os.path.dirname(summary_file)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    with open(summary_file, "w") as fout:
+        print("\t".join(["dataset", "status", "total"] + stages), file=fout)
+        for dataset in datasets:
+            timings, error = results[dataset]
+            timings = dict(timings)
+            print("\t".join([dataset, error or "ok",
+                             "{:.2f}".format(sum(timings.values()))]
+                            + ["{:.2f}".format(timings[stage])
+                               if stage in timings else "-"
+                               for stage in stages]), file=fout)
+        print("# {} sites, {} processes, wall time {:.2f}s"
+              .format(len(datasets), processes, elapsed), file=fout)
+    print("Timing summary written to {}".format(summary_file))
+    return results
 
 
 if __name__ == "__main__":
-    if len(sys.argv) < 3 + 1:
+    incremental = len(sys.argv) > 2 and sys.argv[2] == "incremental"
+    bench_archive = len(sys.argv) > 2 and sys.argv[2] == "bench-archive"
+    bench_normalizer = len(sys.argv) > 2 and sys.argv[2] == "bench-normalizer"
+    bench_html = len(sys.argv) > 2 and sys.argv[2] == "bench-html"
+    bench_split = len(sys.argv) > 2 and sys.argv[2] == "bench-split"
+    bench = len(sys.argv) > 5 and sys.argv[5] == "bench-compression"
+    if len(sys.argv) < 3 + 1 and not incremental and not bench_archive \
+            and not bench_normalizer and not bench_html and not bench_split:
         print("\t Usage: {} [name of dataset] [threshold] [prop of test] [test sample size]"
-              .format(sys.argv[0]), file=sys.stderr)
+              " [workers (optional)]\n"
+              "\t Comma separated dataset names are preprocessed in a pool,"
+              " then the last argument is the number of processes.\n"
+              "\t {} [name of dataset] incremental [Id or CreationDate] [workers]"
+              " ingests the posts after the watermark.\n"
+              "\t {} [name of dataset] bench-archive [reader] [workers]"
+              " compares streaming the .7z dump with extracting it.\n"
+              "\t {} [name of dataset] bench-normalizer [sample size]"
+              " checks and times normalize_text, exits 1 at mismatches.\n"
+              "\t {} [name of dataset] bench-html [sample size]"
+              " compares the bs4 and lxml HTML cleaners on Posts.xml, the diffs"
+              " are written to data/[name of dataset]/html_cleaner_diff.txt.\n"
+              "\t {} [name of dataset] bench-split [questions] [work dir]"
+              " times build_test_set on a synthetic site of 1M questions.\n"
+              "\t {} [name of dataset] [threshold] [prop of test] [test sample size]"
+              " bench-compression [work dir] [workers] compares the compressions"
+              " of the text files, set by PDER_COMPRESSION=gz or zst otherwise."
+              .format(*[sys.argv[0]] * 7),
+              file=sys.stderr)
+        sys.exit(0)
+    if incremental:
+        # [name of dataset] incremental [Id or CreationDate] [workers]
+        by = sys.argv[3] if len(sys.argv) > 3 else "Id"
+        workers = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+        ingest_incremental(Context(sys.argv[1]), by=by, workers=workers)
+        sys.exit(0)
+    if bench_archive:
+        # [name of dataset] bench-archive [reader] [workers]
+        reader = sys.argv[3] if len(sys.argv) > 3 else "auto"
+        workers = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+        ctx = Context(sys.argv[1])
+        archive_path = archive.find_archive(ctx.raw_dir)
+        if archive_path is None:
+            print("No .7z dump in {}".format(ctx.raw_dir), file=sys.stderr)
+            sys.exit(1)
+        compare_archive_ingestion(archive_path, ctx.data_dir + "archive_bench/",
+                                  reader=reader, workers=workers)
+        sys.exit(0)
+    if bench_normalizer:
+        # [name of dataset] bench-normalizer [sample size]
+        sample_size = int(sys.argv[3]) if len(sys.argv) > 3 else 10000
+        mismatch = benchmark_normalizer(Context(sys.argv[1]).data_dir,
+                                        sample_size=sample_size)
+        sys.exit(1 if mismatch else 0)
+    if bench_html:
+        # [name of dataset] bench-html [sample size]
+        sample_size = int(sys.argv[3]) if len(sys.argv) > 3 else 10000
+        ctx = Context(sys.argv[1])
+        compare_html_cleaners(ctx.raw_dir, ctx.data_dir, sample_size=sample_size)
+        sys.exit(0)
+    if bench_split:
+        # [name of dataset] bench-split [questions] [work dir]
+        n_questions = int(sys.argv[3]) if len(sys.argv) > 3 else 1000000
+        work_dir = sys.argv[4] if len(sys.argv) > 4 \
+            else Context(sys.argv[1]).data_dir + "split_bench/"
+        bench_build_test_set(os.path.join(work_dir, ""), n_questions=n_questions)
         sys.exit(0)
     threshold = int(sys.argv[2])
     test_proportion = float(sys.argv[3])
     sample_size = int(sys.argv[4])
-    preprocess_(sys.argv[1], threshold, test_proportion, sample_size)
+    if bench:
+        # ... bench-compression [work dir] [workers]
+        work_dir = sys.argv[6] if len(sys.argv) > 6 else "compression_bench"
+        workers = int(sys.argv[7]) if len(sys.argv) > 7 else 1
+        kinds = ["", "gz", "zst"] if textio.zstd_available() else ["", "gz"]
+        bench_compression(sys.argv[1], work_dir, threshold, test_proportion,
+                          sample_size, kinds=kinds, workers=workers)
+        sys.exit(0)
+    workers = int(sys.argv[5]) if len(sys.argv) > 5 else 1
+    datasets = [x for x in sys.argv[1].split(",") if x]
+    if len(datasets) > 1:
+        preprocess_many(datasets, threshold, test_proportion, sample_size,
+                        processes=workers)
+    else:
+        try:
+            preprocess_(datasets[0], threshold, test_proportion, sample_size,
+                        workers)
+        except IOError as e:
+            print(e, file=sys.stderr)
+            sys.exit()
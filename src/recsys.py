@@ -105,37 +105,60 @@ class RecSys(nn.Module):
 
         return rank_loss
 
+    def encode_question(self, q, q_len):
+        """Encode padded questions by the LSTM encoder
+
+        Args:
+            q  -  batch x PAD_LEN x 300 question word vectors
+            q_len  -  LongTensor (batch), the length of each question
+        Return:
+            batch x emb_dim question encodings, taken at the same
+                positions as in `test`
+        """
+        emb = self.embedding_manager
+        q_output, _ = emb.ubirnn(q, emb.init_hc(q.size(0)))
+        q_len = q_len.clamp(max=q_output.size(1) - 1)
+        ind = q_len.view(-1, 1, 1).expand(-1, 1, self.emb_dim)
+        return q_output.gather(1, ind).squeeze(1)
+
+    def score(self, emb_r, emb_q, emb_a):
+        """Score (R, Q, A) triples by the ranking CNN
+
+        Args:
+            emb_r, emb_q, emb_a  -  batch x emb_dim embeddings
+        Return:
+            score  -  batch scores
+        """
+        emb_rank_mat = torch.stack(
+            [emb_r, emb_q, emb_a], dim=1) \
+            .unsqueeze(1)
+
+        # batch x channel x 6 x 1 => batch x channel x 6
+        score = torch.cat([
+            self.convnet1(emb_rank_mat)
+            , self.convnet2(emb_rank_mat)
+            , self.convnet3(emb_rank_mat)]
+            , dim=2).squeeze(3)
+
+        return self.fc_new_2(
+            self.fc_new_1(score).squeeze(2)).squeeze(1)
+
     def test(self, test_data):
         # test_a, _r, _q all variables
         emb = self.embedding_manager
         test_a, test_r, test_q, test_q_len = test_data
         a_size = test_a.size(0)
-        # print(test_a)
-        # print(test_r)
 
         emb_rank_a = emb.au_embeddings(test_a)
         emb_rank_r = emb.ru_embeddings(test_r)
 
-        test_q_output, _ = emb.ubirnn(test_q.unsqueeze(0), emb.init_hc(1))
-
-        ind = Variable(torch.LongTensor([test_q_len])).cuda()
-        test_q_target_output = torch.index_select(test_q_output.squeeze(), 0, ind)
-
-        emb_rank_q = test_q_target_output.squeeze() \
-            .repeat(a_size).view(a_size, emb.emb_dim)
-
-        emb_rank_mat = torch.stack(
-            [emb_rank_r, emb_rank_q, emb_rank_a], dim=1) \
-            .unsqueeze(1)
-
-        score = torch.cat([
-            self.convnet1(emb_rank_mat)
-            , self.convnet2(emb_rank_mat)
-            , self.convnet3(emb_rank_mat)]
-            , dim=2).squeeze()
+        ind = Variable(torch.LongTensor([test_q_len]))
+        if test_q.is_cuda:
+            ind = ind.cuda()
+        emb_rank_q = self.encode_question(test_q.unsqueeze(0), ind) \
+            .expand(a_size, self.emb_dim)
 
-        score = self.fc_new_2(
-            self.fc_new_1(score.squeeze()).squeeze()).squeeze()
+        score = self.score(emb_rank_r, emb_rank_q, emb_rank_a)
 
-        ret_score = score.data.squeeze().tolist()
+        ret_score = score.data.tolist()
         return ret_score
@@ -0,0 +1,303 @@
+"""
+    Bulk offline routing
+
+    author: Zeyu Li <zyli@cs.ucla.edu> or <zeyuli@g.ucla.edu>
+
+    Route a large file of questions to answerers with a process pool.
+    The model is first exported to a bundle folder of `.npy` arrays
+    which every worker memory-maps, so that the answerer embeddings
+    and word vectors are shared by all workers through the page cache.
+
+    Input:  one "<rid>\\t<question text>" record per line
+    Output: one "<rid>\\t<aid>:<score> <aid>:<score> ..." line per record,
+            in the order of the input
+
+    Run:
+        python src/route_batch.py --export --checkpoint [rs checkpoint] [PDER options]
+        python src/route_batch.py --bundle [bundle dir] --input [file] --output [file]
+"""
+
+import os, sys
+import time
+import itertools
+from collections import deque
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+
+try:
+    import ujson as json
+except:
+    import json
+
+# The routing state of a worker process, set by `init_worker`
+_router = None
+
+
+def export_bundle(pder, folder):
+    """Export a trained PDER model to a memory-mappable bundle
+
+    Args:
+        pder  -  the PDER model with trained (loaded) parameters
+        folder  -  the bundle folder
+    """
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    dl, emb, recsys = pder.dl, pder.embedding_manager, pder.recsys
+    print("Exporting bundle to {} ...".format(folder))
+
+    np.save(folder + "au.npy", emb.au_embeddings.weight.data.cpu().numpy())
+    np.save(folder + "ru.npy", emb.ru_embeddings.weight.data.cpu().numpy())
+    np.save(folder + "aids.npy", pder.all_aid)
+
+    uids = np.array(sorted(dl.uid2ind.keys()), dtype=np.int64)
+    np.save(folder + "uids.npy", uids)
+    np.save(folder + "inds.npy",
+            np.array([dl.uid2ind[uid] for uid in uids], dtype=np.int64))
+
+    # The embedding tables are memory-mapped from the .npy files instead
+    state_dict = {k: v.cpu() for k, v in recsys.state_dict().items()
+                  if not k.startswith("embedding_manager.") or "birnn" in k}
+    torch.save(state_dict, folder + "recsys.pt")
+
+    # Large arrays are stored separately as .npy, so that they can be mmap'ed
+    dl.w2vmodel.save(folder + "w2v.kv")
+
+    if pder.index is not None:
+        pder.index.save(folder + "index.npz")
+
+    with open(folder + "meta.json", "w") as fout:
+        fout.write(json.dumps({"embedding_dim": pder.embedding_dim,
+                               "cnn_channel": recsys.out_channel,
+                               "lstm_layers": pder.lstm_layers,
+                               "pad_len": dl.PAD_LEN}))
+    print("Done!")
+
+
+class BundleRouter:
+    """Route questions with a model bundle exported by `export_bundle`
+
+    Args:
+        folder  -  the bundle folder
+    """
+
+    def __init__(self, folder):
+        import gensim
+        from nltk.corpus import stopwords
+        from embed import Embed
+        from recsys import RecSys
+        from ann_index import IVFPQIndex
+
+        with open(folder + "meta.json", "r") as fin:
+            meta = json.loads(fin.read())
+        self.emb_dim = meta["embedding_dim"]
+        self.pad_len = meta["pad_len"]
+
+        self.au = np.load(folder + "au.npy", mmap_mode="r")
+        self.ru = np.load(folder + "ru.npy", mmap_mode="r")
+        self.aids = np.load(folder + "aids.npy")
+        self.uids = np.load(folder + "uids.npy", mmap_mode="r")
+        self.inds = np.load(folder + "inds.npy", mmap_mode="r")
+        self.aid_rows = self.uid2index(self.aids)
+        self.w2v = gensim.models.KeyedVectors.load(folder + "w2v.kv", mmap="r")
+
+        self.index = None
+        if os.path.exists(folder + "index.npz"):
+            self.index = IVFPQIndex.load(folder + "index.npz")
+
+        # Embedding tables are not used here, so a vocabulary of 1 suffices
+        self.recsys = RecSys(embedding_dim=self.emb_dim,
+                             cnn_channel=meta["cnn_channel"],
+                             embeddings=Embed(vocab_size=1,
+                                              embedding_dim=self.emb_dim,
+                                              lstm_layers=meta["lstm_layers"]))
+        self.recsys.load_state_dict(torch.load(folder + "recsys.pt"), strict=False)
+        self.recsys.eval()
+
+        self.sw_set = frozenset(stopwords.words('english'))
+
+    def uid2index(self, uids):
+        """Map user ids to rows of the embedding tables, unknown to 0"""
+        uids = np.asarray(uids, dtype=np.int64)
+        pos = np.searchsorted(self.uids, uids).clip(max=len(self.uids) - 1)
+        return np.where(self.uids[pos] == uids, self.inds[pos], 0)
+
+    def encode(self, texts):
+        """Normalize and encode texts in one encoder pass"""
+        from textnorm import normalize_text
+        q = np.zeros((len(texts), self.pad_len, 300), dtype=np.float32)
+        q_len = np.zeros(len(texts), dtype=np.int64)
+        for i, text in enumerate(texts):
+            words = [w for w in normalize_text(text, self.sw_set)[1]
+                     .split(" ") if w in self.w2v.vocab][:self.pad_len]
+            if words:
+                q[i, :len(words)] = self.w2v[words]
+                q_len[i] = len(words)
+        with torch.no_grad():
+            return self.recsys.encode_question(torch.from_numpy(q),
+                                               torch.from_numpy(q_len))
+
+    def route(self, records, top_k=10, candidate_size=300):
+        """Route a list of (rid, text) records
+
+        Return:
+            list of [(aid, score), ...] for each record, best first
+        """
+        rids = [rid for rid, _ in records]
+        q_embs = self.encode([text for _, text in records])
+        rrows = self.uid2index(rids)
+        results = []
+        with torch.no_grad():
+            for rrow, q_emb in zip(rrows, q_embs):
+                emb_r = np.array(self.ru[rrow], dtype=np.float32)
+                if self.index is not None:
+                    aids, _ = self.index.search(emb_r + q_emb.numpy(), candidate_size)
+                    arows = self.uid2index(aids)
+                else:
+                    aids, arows = self.aids, self.aid_rows
+                emb_a = torch.from_numpy(
+                    np.ascontiguousarray(self.au[np.sort(arows)], dtype=np.float32))
+                aids = aids[np.argsort(arows, kind="mergesort")]
+                size = emb_a.size(0)
+                scores = self.recsys.score(
+                    torch.from_numpy(emb_r).unsqueeze(0).expand(size, self.emb_dim),
+                    q_emb.unsqueeze(0).expand(size, self.emb_dim),
+                    emb_a).numpy()
+                top = np.argsort(-scores, kind="mergesort")[:top_k]
+                results.append([(int(aids[i]), float(scores[i])) for i in top])
+        return results
+
+
+def init_worker(folder):
+    global _router
+    torch.set_num_threads(1)
+    _router = BundleRouter(folder)
+
+
+def route_chunk(args):
+    """Route a chunk of records in a worker, return output lines"""
+    records, top_k, candidate_size = args
+    results = _router.route(records, top_k, candidate_size)
+    return ["{}\t{}".format(rid, " ".join("{}:{:.6f}".format(aid, score)
+                                          for aid, score in result))
+            for (rid, _), result in zip(records, results)]
+
+
+def read_records(input_file, skipped=None):
+    """Stream (rid, text) records from a "<rid>\\t<text>" file
+
+    Malformed lines, i.e. without a tab or with a non-integer rid, are
+        skipped instead of aborting the run. Blank lines are ignored.
+
+    Args:
+        input_file  -  the record file
+        skipped  -  a list to append the numbers of the skipped lines to
+    """
+    with open(input_file, "r") as fin:
+        for lineno, line in enumerate(fin, 1):
+            line = line.rstrip("\n")
+            if not line.strip():
+                continue
+            rid, sep, text = line.partition("\t")
+            if sep and rid.strip().lstrip("-").isdigit():
+                yield int(rid), text
+                continue
+            if skipped is not None:
+                if len(skipped) < 10:
+                    print("\tSkipping malformed line {}: {!r}"
+                          .format(lineno, line[:80]), file=sys.stderr)
+                skipped.append(lineno)
+
+
+def route_file(folder, input_file, output_file, workers=4, chunk_size=256,
+               top_k=10, candidate_size=300):
+    """Route all records of `input_file` to `output_file`
+
+    Records are read and routed chunk by chunk, and at most 2 chunks
+        per worker are in flight, so the memory does not grow with the
+        size of the input. The output keeps the order of the input.
+        Malformed input lines are skipped and counted, see `read_records`.
+
+    Args:
+        folder  -  the bundle folder
+        input_file, output_file  -  the record and the result files
+        workers  -  the number of worker processes
+        chunk_size  -  the number of records in a task
+        top_k  -  the number of answerers per question
+        candidate_size  -  the number of ANN candidates to re-rank
+    """
+    skipped = []
+    records = read_records(input_file, skipped)
+    pending = deque()
+    count, start = 0, time.time()
+
+    with Pool(workers, initializer=init_worker, initargs=(folder,)) as pool, \
+            open(output_file, "w", buffering=1 << 20) as fout:
+        while True:
+            while len(pending) < 2 * workers:
+                chunk = list(itertools.islice(records, chunk_size))
+                if not chunk:
+                    break
+                pending.append(pool.apply_async(
+                    route_chunk, ((chunk, top_k, candidate_size),)))
+            if not pending:
+                break
+            lines = pending.popleft().get()
+            fout.write("\n".join(lines) + "\n")
+            count += len(lines)
+            if count % (chunk_size * workers * 10) < chunk_size:
+                elapsed = time.time() - start
+                print("\t{} records, {:.1f} records/s".format(count, count / elapsed))
+
+    elapsed = time.time() - start
+    print("Routed {} records in {:.2f}s, {:.1f} records/s"
+          .format(count, elapsed, count / max(elapsed, 1e-9)))
+    if skipped:
+        print("Skipped {} malformed lines of {}".format(len(skipped), input_file),
+              file=sys.stderr)
+    return count
+
+
+if __name__ == "__main__":
+    from main import get_parser, build_pder
+    from utils import Utils
+
+    parser = get_parser()
+    parser.add_option("--export", default=False, dest="export",
+                      action="store_true",
+                      help="Export the model of --checkpoint to a bundle.")
+    parser.add_option("--bundle", type="string", dest="bundle", default=None,
+                      help="The bundle folder, default model/bundle_[dataset]_[id]/.")
+    parser.add_option("--input", type="string", dest="input", default=None,
+                      help="The \"<rid>\\t<question text>\" file to route.")
+    parser.add_option("--output", type="string", dest="output", default=None,
+                      help="The file of routed answerers.")
+    parser.add_option("--workers", type="int", dest="workers", default=4)
+    parser.add_option("--chunk-size", type="int", dest="chunk_size", default=256)
+    parser.add_option("--top-k", type="int", dest="top_k", default=10)
+    parser.add_option("--candidate-size", type="int", dest="candidate_size",
+                      default=300, help="The number of ANN candidates to re-rank.")
+    (options, args) = parser.parse_args()
+
+    bundle = options.bundle or Utils(dataset=options.dataset, ID=options.id,
+                                     mp_length=options.length,
+                                     mp_coverage=options.coverage).bundle_folder
+    bundle = os.path.join(bundle, "")
+
+    if options.export:
+        if not options.checkpoint:
+            print("--checkpoint is required by --export", file=sys.stderr)
+            sys.exit(1)
+        pder_model = build_pder(options)
+        pder_model.load_model(options.checkpoint)
+        pder_model.load_index()
+        export_bundle(pder_model, bundle)
+        sys.exit(0)
+
+    if not options.input or not options.output:
+        print("--input and --output are required", file=sys.stderr)
+        sys.exit(1)
+    route_file(bundle, options.input, options.output,
+               workers=options.workers, chunk_size=options.chunk_size,
+               top_k=options.top_k, candidate_size=options.candidate_size)
@@ -0,0 +1,249 @@
+"""
+    TorchScript export
+
+    author: Zeyu Li <zyli@cs.ucla.edu> or <zeyuli@g.ucla.edu>
+
+    Export the question encoder and the ranking CNN of a trained model
+    into one self-contained TorchScript file. The user embedding tables
+    and the word vectors of the training questions are bundled in, and
+    the vocabulary, user ids and stopwords go to the extra files, so
+    inference neither imports the training stack nor loads word2vec.
+
+    Run:
+        python src/scripted.py --checkpoint [rs checkpoint] [PDER options]
+"""
+
+import os, sys
+import time
+import subprocess
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+try:
+    import ujson as json
+except:
+    import json
+
+from textnorm import normalize_text
+
+EXTRA_FILES = ["vocab.json", "users.json", "meta.json"]
+
+
+class ScriptedRanker(nn.Module):
+    """The scriptable encoder and ranking path of `RecSys`
+
+    Args:
+        recsys  -  the trained RecSys
+        word_vectors  -  V x 300 float array of the pruned vocabulary
+        cand_rows  -  rows of the candidate answerers in the embedding tables
+    """
+
+    def __init__(self, recsys, word_vectors, cand_rows):
+        super(ScriptedRanker, self).__init__()
+        emb = recsys.embedding_manager
+        self.emb_dim = recsys.emb_dim
+        self.lstm_layers = emb.lstm_layers
+
+        # Row 0 is the zero padding word
+        vectors = torch.zeros(len(word_vectors) + 1, 300)
+        vectors[1:] = torch.from_numpy(np.asarray(word_vectors, dtype=np.float32))
+        self.word_embeddings = nn.Embedding.from_pretrained(vectors)
+        self.ru_embeddings = nn.Embedding.from_pretrained(
+            emb.ru_embeddings.weight.data.cpu().clone())
+        self.au_embeddings = nn.Embedding.from_pretrained(
+            emb.au_embeddings.weight.data.cpu().clone())
+        self.register_buffer("cand_rows", torch.LongTensor(cand_rows))
+
+        self.ubirnn = emb.ubirnn
+        self.convnet1 = recsys.convnet1
+        self.convnet2 = recsys.convnet2
+        self.convnet3 = recsys.convnet3
+        self.fc_new_1 = recsys.fc_new_1
+        self.fc_new_2 = recsys.fc_new_2
+
+    @torch.jit.export
+    def encode(self, word_ids, q_len):
+        """Same as `RecSys.encode_question` over word ids
+
+        Args:
+            word_ids  -  batch x L word ids, padded by 0 to at least q_len + 1
+            q_len  -  batch question lengths
+        """
+        q = self.word_embeddings(word_ids)
+        h = torch.zeros(self.lstm_layers, q.size(0), self.emb_dim)
+        c = torch.zeros(self.lstm_layers, q.size(0), self.emb_dim)
+        q_output, _ = self.ubirnn(q, (h, c))
+        q_len = q_len.clamp(max=q_output.size(1) - 1)
+        ind = q_len.view(-1, 1, 1).expand(-1, 1, self.emb_dim)
+        return q_output.gather(1, ind).squeeze(1)
+
+    @torch.jit.export
+    def score(self, emb_r, emb_q, emb_a):
+        """Same as `RecSys.score`"""
+        emb_rank_mat = torch.stack([emb_r, emb_q, emb_a], dim=1).unsqueeze(1)
+        score = torch.cat([self.convnet1(emb_rank_mat),
+                           self.convnet2(emb_rank_mat),
+                           self.convnet3(emb_rank_mat)], dim=2).squeeze(3)
+        return self.fc_new_2(self.fc_new_1(score).squeeze(2)).squeeze(1)
+
+    @torch.jit.export
+    def score_rows(self, q_emb, r_row, a_rows):
+        """Score answerers `a_rows` for a 1 x emb_dim question of `r_row`"""
+        size = a_rows.size(0)
+        emb_r = self.ru_embeddings(r_row.view(1)).expand(size, self.emb_dim)
+        return self.score(emb_r, q_emb.expand(size, self.emb_dim),
+                          self.au_embeddings(a_rows))
+
+    def forward(self, word_ids, q_len, r_row):
+        """Scores of all candidate answerers for one question"""
+        q_emb = self.encode(word_ids, q_len)
+        return self.score_rows(q_emb, r_row, self.cand_rows)
+
+
+def export_script(pder, path):
+    """Script the model of `pder` and save it with its vocabulary
+
+    Args:
+        pder  -  the PDER model with trained (loaded) parameters
+        path  -  the output file
+    """
+    from data_loader import prune_word2vec
+    from nltk.corpus import stopwords
+
+    dl, recsys = pder.dl, pder.recsys
+    print("Exporting TorchScript model to {} ...".format(path))
+    words, vectors = prune_word2vec(dl.w2vmodel, dl.question_text.values())
+    print("\tPruned vocabulary to {} words".format(len(words)))
+
+    recsys.cpu().eval()
+    cand_rows = dl.uid2index(pder.all_aid).tolist()
+    module = torch.jit.script(ScriptedRanker(recsys, vectors, cand_rows))
+
+    uids = sorted(dl.uid2ind.keys())
+    extra_files = {
+        "vocab.json": json.dumps(words),
+        "users.json": json.dumps({"uids": uids,
+                                  "rows": [dl.uid2ind[uid] for uid in uids],
+                                  "aids": [int(x) for x in pder.all_aid]}),
+        "meta.json": json.dumps({"pad_len": dl.PAD_LEN,
+                                 "stopwords": sorted(stopwords.words('english'))})
+    }
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    torch.jit.save(module, path, _extra_files=extra_files)
+    if torch.cuda.is_available():
+        recsys.cuda()
+    print("Done!")
+
+
+class ScriptedRouter:
+    """Route questions with a model exported by `export_script`
+
+    Args:
+        path  -  the exported TorchScript file
+        index_file  -  optional ANN index file to pre-select candidates
+    """
+
+    def __init__(self, path, index_file=None):
+        start = time.time()
+        extra_files = {name: "" for name in EXTRA_FILES}
+        self.module = torch.jit.load(path, map_location="cpu",
+                                     _extra_files=extra_files)
+        self.module.eval()
+
+        words = json.loads(extra_files["vocab.json"])
+        self.word2id = {word: i + 1 for i, word in enumerate(words)}
+        users = json.loads(extra_files["users.json"])
+        self.uid2row = dict(zip(users["uids"], users["rows"]))
+        self.aids = np.array(users["aids"], dtype=np.int64)
+        meta = json.loads(extra_files["meta.json"])
+        self.pad_len = meta["pad_len"]
+        self.sw_set = frozenset(meta["stopwords"])
+
+        self.index = None
+        if index_file:
+            from ann_index import IVFPQIndex
+            self.index = IVFPQIndex.load(index_file)
+        self.load_time = time.time() - start
+
+    def tokenize(self, text):
+        """Text to word ids, following `Q_title_nsw.txt` normalization"""
+        _, text_nsw = normalize_text(text, self.sw_set)
+        words = [self.word2id[w] for w in text_nsw.split() if w in self.word2id]
+        return words[:self.pad_len]
+
+    def encode(self, texts):
+        """Encode a list of texts in one pass, return batch x emb_dim"""
+        ids = [self.tokenize(text) for text in texts]
+        q_len = torch.LongTensor([len(x) for x in ids])
+        # The encoding is read at position q_len, so pad one more word
+        width = min(max(len(x) for x in ids) + 1, self.pad_len)
+        word_ids = torch.zeros(len(ids), width, dtype=torch.long)
+        for i, x in enumerate(ids):
+            word_ids[i, :len(x)] = torch.LongTensor(x)
+        with torch.no_grad():
+            return self.module.encode(word_ids, q_len)
+
+    def route(self, rid, text, top_k=10, candidate_size=300):
+        """Recommend answerers for question `text` raised by `rid`
+
+        Return:
+            list of (aid, score), best first
+        """
+        q_emb = self.encode([text])
+        r_row = torch.LongTensor([self.uid2row.get(rid, 0)])
+        with torch.no_grad():
+            if self.index is not None:
+                query = self.module.ru_embeddings(r_row) + q_emb
+                aids, _ = self.index.search(query.squeeze(0).numpy(), candidate_size)
+                a_rows = torch.LongTensor([self.uid2row.get(int(x), 0) for x in aids])
+                scores = self.module.score_rows(q_emb, r_row, a_rows).numpy()
+            else:
+                aids = self.aids
+                scores = self.module.score_rows(
+                    q_emb, r_row, self.module.cand_rows).numpy()
+        top = np.argsort(-scores, kind="mergesort")[:top_k]
+        return [(int(aids[i]), float(scores[i])) for i in top]
+
+
+def cold_load_time(path, index_file=None):
+    """Seconds to import this module and load `path` in a fresh process
+
+    `ScriptedRouter.load_time` only covers the loading, with the
+        imports already paid for by the process.
+    """
+    code = ("import time; start = time.time(); "
+            "from scripted import ScriptedRouter; "
+            "ScriptedRouter({!r}, {!r}); "
+            "print(time.time() - start)").format(
+        os.path.abspath(path), index_file and os.path.abspath(index_file))
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.check_output([sys.executable, "-c", code], env=env)
+    return float(output.decode().split()[-1])
+
+
+if __name__ == "__main__":
+    from main import get_parser, build_pder
+    from utils import Utils
+
+    parser = get_parser()
+    parser.add_option("--output", type="string", dest="output", default=None,
+                      help="The exported file, default model/script_[dataset]_[id].pt.")
+    (options, args) = parser.parse_args()
+
+    if not options.checkpoint:
+        print("--checkpoint is required by the export", file=sys.stderr)
+        sys.exit(1)
+    path = options.output or Utils(dataset=options.dataset, ID=options.id,
+                                   mp_length=options.length,
+                                   mp_coverage=options.coverage).script_file
+    pder_model = build_pder(options)
+    pder_model.load_model(options.checkpoint)
+    export_script(pder_model, path)
+
+    router = ScriptedRouter(path)
+    print("Loaded exported model in {:.3f}s, {:.3f}s with the imports "
+          "in a fresh process".format(router.load_time, cold_load_time(path)))
@@ -0,0 +1,361 @@
+"""
+    Ranking service
+
+    author: Zeyu Li <zyli@cs.ucla.edu> or <zeyuli@g.ucla.edu>
+
+    A small asyncio HTTP service routing incoming questions to answerers.
+    Concurrent requests are gathered into micro-batches so that the
+    questions of a batch go through the LSTM encoder in one pass.
+
+    Endpoints:
+        POST /route  -  {"rid": <raiser id>, "text": <question>, "k": <top k>}
+                        returns {"answerers": [[aid, score], ...]}
+        GET  /stats  -  latency percentiles, batch size histogram and the
+                        number of responses per HTTP status
+                        (400 malformed request, 500 server failure)
+
+    Run:
+        python src/service.py --checkpoint [rs checkpoint] [PDER options]
+        python src/service.py --load-test --requests 2000 --concurrency 64
+"""
+
+import sys
+import time
+import asyncio
+import random
+from collections import OrderedDict, Counter, deque
+
+import numpy as np
+import torch
+from torch.autograd import Variable
+
+try:
+    import ujson as json
+except:
+    import json
+
+from nltk.corpus import stopwords
+from textnorm import normalize_text
+
+
+class LRUCache:
+    """Least recently used cache of bounded size"""
+
+    def __init__(self, size):
+        self.size = size
+        self.data = OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    def get(self, key):
+        if key in self.data:
+            self.data.move_to_end(key)
+            self.hits += 1
+            return self.data[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if len(self.data) > self.size:
+            self.data.popitem(last=False)
+
+
+class RankingService:
+    """Micro-batching wrapper of `PDER.route`
+
+    Args:
+        pder  -  a PDER model with trained (loaded) parameters
+        max_batch  -  the largest number of requests in a batch
+        max_wait  -  seconds to wait for a batch to fill up
+        cache_size  -  the number of question encodings to cache
+        candidate_size  -  the number of ANN candidates to re-rank
+    """
+
+    def __init__(self, pder, max_batch=32, max_wait=0.005,
+                 cache_size=10000, candidate_size=300):
+        self.pder = pder
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.candidate_size = candidate_size
+        self.cache = LRUCache(cache_size)
+        self.sw_set = frozenset(stopwords.words('english'))
+
+        self.queue = None
+        self.latencies = deque(maxlen=100000)
+        self.batch_hist = Counter()
+        self.status_hist = Counter()
+
+    def normalize(self, text):
+        """Normalize question text the same way as `Q_title_nsw.txt`"""
+        return normalize_text(text, self.sw_set)[1]
+
+    def encode(self, texts):
+        """Encode normalized texts, uncached ones in one encoder pass
+
+        Args:
+            texts  -  the list of normalized question texts
+        Return:
+            the list of 1 x emb_dim encodings
+        """
+        encodings = [self.cache.get(text) for text in texts]
+        missing = list(OrderedDict.fromkeys(
+            text for text, enc in zip(texts, encodings) if enc is None))
+        if missing:
+            dl, recsys = self.pder.dl, self.pder.recsys
+            q_lens, q_vecs = zip(*[dl.sentence_len_emb(text) for text in missing])
+            q = Variable(torch.FloatTensor(list(q_vecs)))
+            q_len = Variable(torch.LongTensor(list(q_lens)))
+            if torch.cuda.is_available():
+                q, q_len = q.cuda(), q_len.cuda()
+            recsys.eval()
+            with torch.no_grad():
+                output = recsys.encode_question(q, q_len)
+            fresh = {}
+            for i, text in enumerate(missing):
+                # A copy, a view would keep the whole batch output alive
+                fresh[text] = output[i: i + 1].clone()
+                self.cache.put(text, fresh[text])
+            encodings = [fresh[text] if enc is None else enc
+                         for text, enc in zip(texts, encodings)]
+        return encodings
+
+    def process_batch(self, batch):
+        """Encode and route a batch of (rid, text, k) requests
+
+        Return:
+            the result of every request, or the exception it raised, so
+                that a bad request only fails itself
+        """
+        results = [None] * len(batch)
+        texts = {}
+        for i, (_, text, _) in enumerate(batch):
+            try:
+                texts[i] = self.normalize(text)
+            except Exception as e:
+                results[i] = e
+        encodings = dict(zip(texts, self.encode(list(texts.values()))))
+        for i, q_emb in encodings.items():
+            rid, _, k = batch[i]
+            try:
+                results[i] = self.pder.route(
+                    rid, q_emb, top_k=k,
+                    candidate_size=max(k, self.candidate_size))
+            except Exception as e:
+                results[i] = e
+        return results
+
+    async def route(self, rid, text, k=10):
+        """Route a question, resolved when its batch is processed"""
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put(((rid, text, k), future, time.time()))
+        return await future
+
+    async def batch_loop(self):
+        """Gather requests into micro-batches and process them"""
+        loop = asyncio.get_event_loop()
+        while True:
+            items = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(items) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            self.batch_hist[len(items)] += 1
+            try:
+                results = await loop.run_in_executor(
+                    None, self.process_batch, [item[0] for item in items])
+            except Exception as e:
+                for _, future, _ in items:
+                    future.set_exception(e)
+                continue
+            now = time.time()
+            for (_, future, start), result in zip(items, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                    continue
+                self.latencies.append(now - start)
+                future.set_result(result)
+
+    def stats(self):
+        """Latency percentiles (ms), batch size histogram, cache hits and
+        the number of responses per HTTP status"""
+        latencies = np.array(self.latencies) * 1000
+        percentiles = {}
+        if len(latencies):
+            for p in (50, 90, 95, 99):
+                percentiles["p{}".format(p)] = float(np.percentile(latencies, p))
+        return {"requests": len(latencies),
+                "latency_ms": percentiles,
+                "batch_size": {str(x): self.batch_hist[x]
+                               for x in sorted(self.batch_hist)},
+                "cache": {"hits": self.cache.hits,
+                          "misses": self.cache.misses},
+                "status": dict(self.status_hist)}
+
+    async def handle(self, reader, writer):
+        """Handle one HTTP/1.1 request
+
+        Malformed requests get 400, failures of the model, the index or
+            the device get 500.
+        """
+        try:
+            request_line = await reader.readline()
+            method, path, _ = request_line.decode().split(" ", 2)
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                key, value = line.decode().split(":", 1)
+                if key.strip().lower() == "content-length":
+                    length = int(value)
+            body = await reader.readexactly(length) if length else b""
+            if method == "POST" and path == "/route":
+                request = parse_route_request(body)
+        except (ValueError, KeyError) as e:
+            status, payload = "400 Bad Request", {"error": str(e)}
+        except Exception as e:
+            status, payload = "500 Internal Server Error", {"error": str(e)}
+        else:
+            try:
+                if method == "GET" and path == "/stats":
+                    status, payload = "200 OK", self.stats()
+                elif method == "POST" and path == "/route":
+                    answerers = await self.route(*request)
+                    status, payload = "200 OK", {"answerers": answerers}
+                else:
+                    status, payload = "404 Not Found", {"error": path}
+            except Exception as e:
+                status, payload = "500 Internal Server Error", {"error": str(e)}
+        self.status_hist[status.split(" ", 1)[0]] += 1
+
+        response = json.dumps(payload).encode()
+        writer.write("HTTP/1.1 {}\r\nContent-Type: application/json\r\n"
+                     "Content-Length: {}\r\nConnection: close\r\n\r\n"
+                     .format(status, len(response)).encode() + response)
+        await writer.drain()
+        writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8080):
+        """Serve forever on host:port"""
+        self.queue = asyncio.Queue()
+        asyncio.ensure_future(self.batch_loop())
+        server = await asyncio.start_server(self.handle, host, port)
+        print("Serving on http://{}:{}".format(host, port))
+        async with server:
+            await server.serve_forever()
+
+
+def parse_route_request(body):
+    """Parse and validate the JSON body of POST /route
+
+    Return:
+        (rid, text, k)
+    Raise:
+        ValueError or KeyError at a malformed body
+            (json.JSONDecodeError is a ValueError)
+    """
+    data = json.loads(body)
+    if not isinstance(data, dict):
+        raise ValueError("the body must be a JSON object")
+    rid, text, k = int(data["rid"]), data["text"], int(data.get("k", 10))
+    if not isinstance(text, str):
+        raise ValueError("text must be a string")
+    return rid, text, k
+
+
+async def http_request(host, port, method, path, payload=None):
+    """Send a request to the service, return the decoded JSON response"""
+    reader, writer = await asyncio.open_connection(host, port)
+    body = json.dumps(payload).encode() if payload is not None else b""
+    writer.write("{} {} HTTP/1.1\r\nHost: {}\r\nContent-Length: {}\r\n\r\n"
+                 .format(method, path, host, len(body)).encode() + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return json.loads(response.split(b"\r\n\r\n", 1)[1])
+
+
+async def load_test(host, port, questions, n_requests=1000, concurrency=32):
+    """Local load generator
+
+    Args:
+        questions  -  list of (rid, text) to sample requests from
+        n_requests  -  the total number of requests
+        concurrency  -  the number of requests in flight
+    Return:
+        the /stats of the service after the load test
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(rid, text):
+        async with semaphore:
+            await http_request(host, port, "POST", "/route",
+                               {"rid": rid, "text": text, "k": 10})
+
+    start = time.time()
+    await asyncio.gather(*[one(*random.choice(questions))
+                           for _ in range(n_requests)])
+    elapsed = time.time() - start
+    print("{} requests in {:.2f}s, {:.1f} req/s"
+          .format(n_requests, elapsed, n_requests / elapsed))
+    stats = await http_request(host, port, "GET", "/stats")
+    print(json.dumps(stats))
+    return stats
+
+
+if __name__ == "__main__":
+    from main import get_parser, build_pder
+
+    parser = get_parser()
+    parser.add_option("--host", type="string", dest="host", default="127.0.0.1")
+    parser.add_option("--port", type="int", dest="port", default=8080)
+    parser.add_option("--max-batch", type="int", dest="max_batch", default=32,
+                      help="The largest number of requests in a batch.")
+    parser.add_option("--max-wait", type="float", dest="max_wait", default=0.005,
+                      help="Seconds to wait for a batch to fill up.")
+    parser.add_option("--cache-size", type="int", dest="cache_size", default=10000,
+                      help="The number of question encodings to cache.")
+    parser.add_option("--candidate-size", type="int", dest="candidate_size",
+                      default=300, help="The number of ANN candidates to re-rank.")
+    parser.add_option("--load-test", default=False, dest="load_test",
+                      action="store_true",
+                      help="Run the load generator against a running service.")
+    parser.add_option("--requests", type="int", dest="requests", default=1000)
+    parser.add_option("--concurrency", type="int", dest="concurrency", default=32)
+    parser.add_option("--questions", type="string", dest="questions", default=None,
+                      help="File of \"<rid> <question text>\" lines for load test.")
+    (options, args) = parser.parse_args()
+
+    if options.load_test:
+        if not options.questions:
+            print("--questions is required by --load-test", file=sys.stderr)
+            sys.exit(1)
+        with open(options.questions, "r") as fin:
+            questions = [line.strip().split(" ", 1) for line in fin]
+            questions = [(int(rid), text) for rid, text in questions]
+        asyncio.get_event_loop().run_until_complete(
+            load_test(options.host, options.port, questions,
+                      options.requests, options.concurrency))
+        sys.exit(0)
+
+    if not options.checkpoint:
+        print("--checkpoint is required to serve", file=sys.stderr)
+        sys.exit(1)
+    pder_model = build_pder(options)
+    pder_model.load_model(options.checkpoint)
+    pder_model.load_index()
+
+    service = RankingService(pder_model,
+                             max_batch=options.max_batch,
+                             max_wait=options.max_wait,
+                             cache_size=options.cache_size,
+                             candidate_size=options.candidate_size)
+    asyncio.get_event_loop().run_until_complete(
+        service.serve(options.host, options.port))
@@ -0,0 +1,116 @@
+"""
+    Compressed text files
+
+    Author:
+        Zeyu Li <zyli@cs.ucla.edu> or <zeyuli@ucla.edu>
+
+    Description:
+        Open the text files of the pipeline, e.g. Posts_Q.json, the
+        metapath and the corpus files, whether they are compressed or
+        not. Files are always named by their plain name:
+
+            a reader opens whichever of <name>, <name>.gz or <name>.zst
+                exists, decompressing it as a stream;
+            a writer writes <name> + the suffix of the compression set
+                by `set_compression`, and removes the other variants.
+
+        Compressions:
+            ""     - plain text
+            "gz"   - gzip
+            "zst"  - zstd, needs the optional `zstandard` package
+
+        The default compression is read from the PDER_COMPRESSION
+        environment variable, so that it is inherited by the worker
+        processes.
+"""
+
+import os
+import io
+import gzip
+
+SUFFIXES = {"": "", "gz": ".gz", "zst": ".zst"}
+GZIP_LEVEL = 3
+ZSTD_LEVEL = 3
+
+compression = os.environ.get("PDER_COMPRESSION", "")
+
+
+def set_compression(kind):
+    """Compress the files written from now on by `kind`, "", "gz" or "zst"
+
+    Also exported to the environment for processes started afterwards.
+    """
+    global compression
+    if kind not in SUFFIXES:
+        raise ValueError("Unknown compression {}".format(kind))
+    if kind == "zst":
+        import zstandard
+    compression = kind
+    os.environ["PDER_COMPRESSION"] = kind
+
+
+def zstd_available():
+    try:
+        import zstandard
+        return True
+    except ImportError:
+        return False
+
+
+def variants(path):
+    return [path + suffix for suffix in ("", ".gz", ".zst")]
+
+
+def resolve(path):
+    """The file on disk of `path`, `path` itself if none exists"""
+    for variant in variants(path):
+        if os.path.exists(variant):
+            return variant
+    return path
+
+
+def exists(path):
+    return any(os.path.exists(variant) for variant in variants(path))
+
+
+def remove(path):
+    """Remove every variant of `path`"""
+    for variant in variants(path):
+        if os.path.exists(variant):
+            os.remove(variant)
+
+
+def open_text(path, mode="r", buffering=1 << 20):
+    """Open the text file `path` of any compression
+
+    Args:
+        path  -  the plain name of the file
+        mode  -  "r", "w" or "a"; "a" appends to the existing variant
+            (gzip members and zstd frames can be concatenated)
+        buffering  -  the buffer size of the file
+    """
+    if mode == "r" or (mode == "a" and exists(path)):
+        real = resolve(path)
+    else:
+        remove(path)
+        real = path + SUFFIXES[compression]
+
+    if real.endswith(".gz"):
+        stream = gzip.open(real, mode + "b", compresslevel=GZIP_LEVEL)
+    elif real.endswith(".zst"):
+        import zstandard
+        raw = open(real, mode + "b")
+        if mode == "r":
+            stream = zstandard.ZstdDecompressor().stream_reader(
+                raw, read_size=buffering, read_across_frames=True,
+                closefd=True)
+        else:
+            stream = zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(
+                raw, closefd=True)
+    else:
+        return open(real, mode, buffering=buffering)
+    if mode == "r":
+        stream = io.BufferedReader(stream, buffering)
+    else:
+        stream = io.BufferedWriter(stream, buffering)
+    return io.TextIOWrapper(stream, encoding="utf-8")
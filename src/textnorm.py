@@ -0,0 +1,50 @@
+"""
+    Text normalization
+
+    Author:
+        Zeyu Li <zyli@cs.ucla.edu> or <zeyuli@ucla.edu>
+
+    Description:
+        The normalization of the question text, `normalize_text`, by
+        the standard library only, so that the inference paths, e.g.
+        `scripted` and `service`, do not import the preprocessing stack.
+"""
+
+import re
+
+# Precompiled patterns of `normalize_text`
+NON_KEPT_CHARS = re.compile(r"[^A-Za-z0-9(),!?\'\`]+")
+KEPT_PUNCTUATION = str.maketrans("", "", "(),!?'`")
+# Words that `word_tokenize` splits into two tokens
+TOKENIZER_SPLITS = {"cannot": ("can", "not"), "gimme": ("gim", "me"),
+                    "gonna": ("gon", "na"), "gotta": ("got", "ta"),
+                    "lemme": ("lem", "me"), "wanna": ("wan", "na")}
+
+
+def normalize_text(s, stopword_set):
+    """Clean up the string and remove stopwords in one pass
+
+    Same output as `preprocessing.clean_str2` and then
+    `preprocessing.remove_stopwords`.
+    In `clean_str2` the contraction rules only drop apostrophes, which
+    the final `translate` drops anyway, and the kept punctuation is
+    deleted after whitespace is collapsed. So one substitution of the
+    other characters plus one `translate` does the cleaning. After the
+    cleaning only [a-z0-9 ] is left, on which `word_tokenize` equals
+    `split` except for the words in TOKENIZER_SPLITS.
+
+    Args:
+        s - the string to clean
+        stopword_set - the set (frozenset) of stopwords
+
+    Return:
+        clean - the cleaned string, as `clean_str2`
+        clean_nsw - the cleaned string without stopwords
+    """
+    clean = NON_KEPT_CHARS.sub(" ", s).translate(KEPT_PUNCTUATION).strip().lower()
+    tokens = []
+    for word in clean.split():
+        for token in TOKENIZER_SPLITS.get(word, (word,)):
+            if token not in stopword_set:
+                tokens.append(token)
+    return clean, " ".join(tokens)
@@ -11,6 +11,12 @@ class Utils:
         self.performance_file = self.PERF_DIR + \
                                 "{}_{}_{}_{}.txt".format(self.dataset, str(self.id),
                                                          str(mp_length), str(mp_coverage))
+        self.index_file = self.model_folder + \
+                          "ann_{}_{}.npz".format(self.dataset, str(self.id))
+        self.bundle_folder = self.model_folder + \
+                             "bundle_{}_{}/".format(self.dataset, str(self.id))
+        self.script_file = self.model_folder + \
+                           "script_{}_{}.pt".format(self.dataset, str(self.id))
         pass
 
     def performance_metrics(self, aid_list, score_list, accid, k):
@@ -43,6 +49,20 @@ class Utils:
                    "{}{}_{}_E{}I{}".format(self.model_folder, model_name, str(self.id), epoch, iter))
         return
 
+    def load_model(self, model, path):
+        """Load a checkpoint dumped by `save_model` into `model`
+
+        Args:
+            model  -  the model to load into
+            path  -  path of the checkpoint
+        """
+        state_dict = torch.load(path, map_location=lambda storage, loc: storage)
+        # Checkpoints dumped from nn.DataParallel have "module." prefix
+        state_dict = {(k[len("module."):] if k.startswith("module.") else k): v
+                      for k, v in state_dict.items()}
+        model.load_state_dict(state_dict)
+        return
+
     def write_performance(self, msg):
         if not os.path.exists(self.PERF_DIR):
             os.mkdir(self.PERF_DIR)